@@ -96,12 +96,10 @@ class XboxStageCommands():
             self.publisher.send("hub _teensy_commands_movez 0")
 
         elif tokens[0] == "left_stick":
-            self.publisher.send("hub _teensy_commands_movex {}".format(int(tokens[1]) // 50))
-            self.publisher.send("hub _teensy_commands_movey {}".format(int(tokens[2]) // 50))
+            self.publisher.send("hub _teensy_commands_set_velocity {} {} None".format(int(tokens[1]) // 50, int(tokens[2]) // 50))
 
         elif tokens[0] == "right_stick":
-            self.publisher.send("hub _teensy_commands_movex {}".format(int(tokens[1])))
-            self.publisher.send("hub _teensy_commands_movey {}".format(int(tokens[2])))
+            self.publisher.send("hub _teensy_commands_set_velocity {} {} None".format(int(tokens[1]), int(tokens[2])))
 
         return
 
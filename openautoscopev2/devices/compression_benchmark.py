@@ -0,0 +1,129 @@
+# Copyright 2025
+# Authors: Sina Rasouli, Mahdi Torkashvand
+
+"""
+Benchmarks the compression codecs of `oas_writer` on recorded frames.
+
+Frames of a recording, e.g. `<data_directory>/<timestamp>_flircamera_behavior`,
+are written with each codec the same way the writer does, then read back.
+Reports the write and read throughput of raw frames in MB/s, the compression
+ratio and the bytes per frame.
+
+Usage:
+    compression_benchmark.py <recording> [options]
+
+Options:
+    -h --help                           Show this help.
+    --codecs=CODECS                     Comma separated codecs, see `oas_writer --help`.
+                                            [default: lzf,gzip,blosc_lz4,blosc_zstd,blosc_lz4_bitshuffle,blosc_zstd_bitshuffle,bitshuffle_lz4,bitshuffle_zstd,lz4,zstd]
+    --level=N                           Compression level, empty for the default level of each codec.
+                                            [default: ]
+    --threads=N                         Number of threads used by Blosc codecs.
+                                            [default: 1]
+    --n_frames=N                        Number of consecutive frames from the start of the recording.
+                                            [default: 500]
+    --buffer_size=N                     Number of frames buffered in memory before writing them to the file.
+                                            [default: 16]
+    --chunk_frames=N                    Number of frames in each HDF5 chunk.
+                                            [default: 1]
+    --compression_workers=N             Number of processes compressing chunks in parallel, 0 compresses while writing.
+                                            [default: 0]
+    --tmp_dir=DIR                       Directory of the benchmark files, should be on the recording disk.
+                                            [default: .]
+"""
+
+import os
+import time
+
+import h5py
+import numpy as np
+from docopt import docopt
+
+from openautoscopev2.devices.utils_data import load_files_data_times, SerializeDatas
+from openautoscopev2.writers.array_writer import (
+    ArrayWriter,
+    compression_options,
+    set_compression_threads,
+    make_compression_executor
+)
+
+
+def load_consecutive_frames(fp_recording, n_frames):
+    """Consecutive frames from the start of a recording folder with `.h5` files,
+    compression depends on how similar neighbouring frames are."""
+
+    files, datas, _ = load_files_data_times(fp_recording)
+    if len(datas) == 0:
+        raise FileNotFoundError(f"No recorded frames in {fp_recording}")
+    data = SerializeDatas(datas)
+    frames = np.stack([ data[i] for i in range(min(n_frames, len(data))) ])
+    for file in files:
+        file.close()
+    return frames
+
+
+def benchmark_codec(frames, fp_output, codec, level=None, buffer_size=16, chunk_frames=1, executor=None):
+    """Write and read back frames with a codec, returns the write and read
+    durations in seconds and the file size in bytes. Chunks are compressed on
+    `executor` if given."""
+
+    if os.path.exists(fp_output):
+        os.remove(fp_output)
+    _start = time.time()
+    writer = ArrayWriter(
+        None, fp_output, frames.shape[1:], frames.dtype,
+        buffer_size=buffer_size,
+        chunk_frames=chunk_frames,
+        executor=executor,
+        **compression_options(codec, level)
+    )
+    for frame in frames:
+        writer.append_data(frame)
+    writer.close()
+    duration_write = time.time() - _start
+    nbytes = os.path.getsize(fp_output)
+
+    _start = time.time()
+    with h5py.File(fp_output, "r") as in_file:
+        frames_read = in_file['data'][:]
+    duration_read = time.time() - _start
+    os.remove(fp_output)
+    if not np.array_equal(frames, frames_read):
+        raise ValueError(f"Frames read back with {codec} differ from the written ones")
+    return duration_write, duration_read, nbytes
+
+
+def main():
+    args = docopt(__doc__)
+    level = int(args["--level"]) if args["--level"] else None
+    set_compression_threads(int(args["--threads"]))
+
+    frames = load_consecutive_frames(args["<recording>"], int(args["--n_frames"]))
+    mb = frames.nbytes / 1e6
+    print(f"{len(frames)} frames of {frames.shape[1:]} {frames.dtype} from {args['<recording>']}, {mb:.1f} MB")
+
+    n_workers = int(args["--compression_workers"])
+    executor = make_compression_executor(n_workers) if n_workers > 0 else None
+    if executor is not None:
+        # Start the workers before timing
+        list(executor.map(abs, range(n_workers)))
+
+    fp_output = os.path.join(args["--tmp_dir"], "compression_benchmark.h5")
+    print("{:<24} {:>12} {:>12} {:>8} {:>14}".format("codec", "write MB/s", "read MB/s", "ratio", "bytes/frame"))
+    for codec in args["--codecs"].split(","):
+        duration_write, duration_read, nbytes = benchmark_codec(
+            frames, fp_output, codec.strip(),
+            level=level,
+            buffer_size=int(args["--buffer_size"]),
+            chunk_frames=int(args["--chunk_frames"]),
+            executor=executor
+        )
+        print("{:<24} {:>12.1f} {:>12.1f} {:>8.2f} {:>14.0f}".format(
+            codec.strip(), mb / duration_write, mb / duration_read,
+            frames.nbytes / nbytes, nbytes / len(frames)
+        ))
+    if executor is not None:
+        executor.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+# Copyright 2025
+# Authors: Sina Rasouli, Mahdi Torkashvand
+
+"""
+Converts raw segments recorded with `oas_writer --backend=raw` to the HDF5
+layout of the writer, i.e. `data`, `times`, `frame_ids`, `gaps` and the
+per-frame metadata, compressed.
+
+Each `.bin` segment of a recording, e.g. `<data_directory>/<timestamp>_flircamera_behavior`,
+and its `.json` sidecar become an `.h5` file with the same name in the same folder.
+Segments are converted in parallel, and already converted ones are skipped.
+
+Usage:
+    convert_segments.py <recording>... [options]
+
+Options:
+    -h --help                           Show this help.
+    --compression=CODEC                 Compression of frames, see `oas_writer --help`.
+                                            [default: lzf]
+    --compression_level=N               Compression level, empty for the default level of the codec.
+                                            [default: ]
+    --chunk_frames=N                    Number of frames in each HDF5 chunk.
+                                            [default: 1]
+    --buffer_size=N                     Number of frames buffered in memory before writing them to the file.
+                                            [default: 64]
+    --n_workers=N                       Number of segments converted in parallel.
+                                            [default: 2]
+    --remove=BOOL                       Remove segments and sidecars after converting them.
+                                            [default: False]
+"""
+
+import os
+from glob import glob
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from docopt import docopt
+
+from openautoscopev2.writers.array_writer import FrameIndexedArrayWriter, compression_options
+from openautoscopev2.writers.segment_writer import load_segment, sidecar_filename, SEGMENT_EXTENSION
+
+
+def convert_segment(fp_segment, fp_output, compression, compression_level, writer_kwargs, remove=False):
+    """Convert one segment, returns the number of frames. The file is written
+    under a temporary name first, so interrupted conversions are redone."""
+
+    records, sidecar = load_segment(fp_segment)
+    metadata_fields = sidecar.get("metadata_fields", [])
+    fp_tmp = fp_output + ".part"
+    if os.path.exists(fp_tmp):
+        os.remove(fp_tmp)
+    writer = FrameIndexedArrayWriter(
+        None, fp_tmp, tuple(sidecar["shape"]), records.dtype["data"].base,
+        **compression_options(compression, compression_level),
+        **writer_kwargs,
+        metadata_fields=metadata_fields
+    )
+    for i, (frame_id, t, frame) in enumerate(zip(records["frame_ids"], records["times"], records["data"])):
+        metadata = records["metadata"][i] if len(metadata_fields) > 0 else None
+        writer.append_data((frame_id, t, frame), metadata)
+    for first, last in sidecar["gaps"]:
+        writer.add_gap(first, last)
+    writer.close()
+    os.replace(fp_tmp, fp_output)
+
+    n_frames = len(records)
+    if remove:
+        del records
+        os.remove(fp_segment)
+        os.remove(sidecar_filename(fp_segment))
+    return n_frames
+
+
+def main():
+    args = docopt(__doc__)
+    compression = args["--compression"]
+    compression_level = int(args["--compression_level"]) if args["--compression_level"] else None
+    writer_kwargs = dict(
+        buffer_size=int(args["--buffer_size"]),
+        chunk_frames=int(args["--chunk_frames"])
+    )
+    remove = args["--remove"].lower() == 'true'
+    # Fail early on unknown codecs
+    compression_options(compression, compression_level)
+
+    jobs = []
+    for fp_recording in args["<recording>"]:
+        for fp_segment in sorted(glob(os.path.join(fp_recording, "*" + SEGMENT_EXTENSION))):
+            fp_output = os.path.splitext(fp_segment)[0] + ".h5"
+            if os.path.exists(fp_output):
+                print(f"Already converted: {fp_segment}")
+                continue
+            jobs.append((fp_segment, fp_output))
+
+    with ProcessPoolExecutor(max_workers=int(args["--n_workers"])) as executor:
+        futures = {
+            executor.submit(convert_segment, fp_segment, fp_output, compression, compression_level, writer_kwargs, remove): fp_segment
+            for fp_segment, fp_output in jobs
+        }
+        for i, future in enumerate(as_completed(futures)):
+            fp_segment = futures[future]
+            try:
+                n_frames = future.result()
+                print(f"[{i+1}/{len(jobs)}] {n_frames} frames converted: {fp_segment}")
+            except Exception as e:
+                print(f"[{i+1}/{len(jobs)}] Error in converting {fp_segment}: {e}")
+
+if __name__ == "__main__":
+    main()
@@ -31,6 +31,9 @@ Options:
                                             [default: 19]
     --gain=NUMBER                 Camera signal gain. Default -1.0 means continuous automatic gain adjusment by the camera.
                                             [default: -1.0]
+    --hwm=N                             Number of frames held by ZMQ before dropping them, e.g. for lossless recording.
+                                        Empty for the ZMQ default of 1000.
+                                            [default: ]
 """
 
 import json
@@ -42,7 +45,7 @@ from docopt import docopt
 
 from openautoscopev2.zmq.publisher import Publisher as Publisher
 from openautoscopev2.zmq.subscriber import ObjectSubscriber
-from openautoscopev2.zmq.array import TimestampedPublisher as Timestamped_Array_Publisher
+from openautoscopev2.zmq.array import FrameIndexedPublisher as FrameIndexed_Array_Publisher
 from openautoscopev2.zmq.utils import parse_host_and_port
 
 
@@ -61,7 +64,8 @@ class  FlirCamera():
             exposure_time: float,
             frame_rate: float,
             gain: float,
-            name="flircamera"):
+            name="flircamera",
+            hwm=None):
         
 
 
@@ -91,12 +95,13 @@ class  FlirCamera():
             port=status_out[1],
             bound=status_out[2])
 
-        self.data_publisher = Timestamped_Array_Publisher(
+        self.data_publisher = FrameIndexed_Array_Publisher(
             host=data_out[0],
             port=data_out[1],
             bound=data_out[2],
             datatype=self.dtype,
-            shape=(1, height, width))
+            shape=(1, height, width),
+            hwm=hwm)
 
         self.cam, self.nodemap, self.tldevice_nodemap, self.processor, self.cam_list, self.system = self._spinnaker_camera(serial_number)
         if self.cam:
@@ -346,8 +351,10 @@ class  FlirCamera():
                     cam_buffer_image = self.cam.GetNextImage(1000)
                     if not cam_buffer_image.IsIncomplete():
                         data = self.processor.Convert(cam_buffer_image, PySpin.PixelFormat_Mono8)
+                    # Camera frame counter, gaps in it are dropped frames
+                    frame_id = cam_buffer_image.GetFrameID()
                     cam_buffer_image.Release()
-                    self.data_publisher.send(data.GetData())
+                    self.data_publisher.send(data.GetData(), frame_id)
                     del data
                 except Exception as _:
                     pass
@@ -368,7 +375,8 @@ def main():
         exposure_time=float(args["--exposure_time"]),
         frame_rate=float(args["--frame_rate"]),
         gain=float(args["--gain"]),
-        name=args["--name"]
+        name=args["--name"],
+        hwm=int(args["--hwm"]) if args["--hwm"] else None
     )
 
     if flir_camera.initiated:
@@ -0,0 +1,62 @@
+# Copyright 2025
+# Authors: Sina Rasouli, Mahdi Torkashvand
+
+"""Crops recorded frames around the tracked worm, and downsamples whole frames
+as context images. Worm coordinates are the ones the tracker logs, which are
+in its resized image, see `TRACKER_IMAGE_SHAPE`."""
+
+from typing import Tuple
+
+import numpy as np
+
+# Frames are resized to 512*512 before tracking, see `tracker.py`
+TRACKER_IMAGE_SHAPE = (512, 512)
+
+
+def bin_frame(frame: np.ndarray, binning: int) -> np.ndarray:
+    """Mean of `binning`*`binning` blocks of the last two axes, rows and columns
+    left over are dropped."""
+
+    if binning == 1:
+        return frame
+    ny, nx = frame.shape[-2] // binning, frame.shape[-1] // binning
+    blocks = frame[..., :ny*binning, :nx*binning].reshape(*frame.shape[:-2], ny, binning, nx, binning)
+    return blocks.mean(axis=(-3, -1)).astype(frame.dtype)
+
+
+class FrameCropper():
+    """Square crops of `crop_size` from the last two axes of frames of
+    `frame_shape`, centred on the worm. While the worm is not found the last
+    crop position is kept, starting from the centre of the frame."""
+
+    def __init__(self, frame_shape: Tuple[int, ...], crop_size: int, context_binning: int = 8):
+        self.frame_shape = tuple(frame_shape)
+        height, width = self.frame_shape[-2:]
+        self.crop_size = min(crop_size, height, width)
+        self.shape = (*self.frame_shape[:-2], self.crop_size, self.crop_size)
+        self.scale_y = height / TRACKER_IMAGE_SHAPE[0]
+        self.scale_x = width / TRACKER_IMAGE_SHAPE[1]
+        self.offset = ((height - self.crop_size) // 2, (width - self.crop_size) // 2)
+        self.context_binning = context_binning
+        self.context_shape = (*self.frame_shape[:-2], height // context_binning, width // context_binning)
+
+    def get_offset(self, x_worm: float, y_worm: float) -> Tuple[int, int]:
+        if np.isnan(x_worm) or np.isnan(y_worm):
+            return self.offset
+        height, width = self.frame_shape[-2:]
+        y = int(round(y_worm * self.scale_y)) - self.crop_size // 2
+        x = int(round(x_worm * self.scale_x)) - self.crop_size // 2
+        return (
+            min(max(y, 0), height - self.crop_size),
+            min(max(x, 0), width - self.crop_size)
+        )
+
+    def crop(self, frame: np.ndarray, x_worm: float, y_worm: float):
+        """Crop of the frame and its offset (y, x) in the frame."""
+        self.offset = self.get_offset(x_worm, y_worm)
+        y, x = self.offset
+        # A copy, so the whole frame is not kept while the crop is queued
+        return np.ascontiguousarray(frame[..., y:y+self.crop_size, x:x+self.crop_size]), self.offset
+
+    def context(self, frame: np.ndarray) -> np.ndarray:
+        return bin_frame(frame, self.context_binning)
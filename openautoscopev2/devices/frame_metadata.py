@@ -0,0 +1,81 @@
+# Copyright 2025
+# Authors: Sina Rasouli, Mahdi Torkashvand
+
+"""Keeps the latest stage, LED, tracking and camera values from the messages
+published to the logger, to save them with each recorded frame. Messages are
+parsed the same way `utils_data.load_process_log_files` parses the log files."""
+
+import json
+
+import numpy as np
+
+METADATA_FIELDS = (
+    "stage_x", "stage_y", "stage_z",
+    "stage_vx", "stage_vy", "stage_vz",
+    "led_b", "led_g", "led_o",
+    "worm_x", "worm_y",
+    "z_worm_focus",
+    "exposure", "gain",
+)
+
+TEENSY_EXECUTING = "<TEENSY COMMANDS> executing: "
+
+
+def try_float(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+class FrameMetadata():
+    """Values of `METADATA_FIELDS`, NaN until known. Camera values are taken
+    from the status of `camera_name`."""
+
+    def __init__(self, camera_name: str = None):
+        self.camera_name = camera_name
+        self.fields = METADATA_FIELDS
+        self.idx = { field: i for i, field in enumerate(self.fields) }
+        self.values = np.full(len(self.fields), np.nan, dtype=np.float32)
+
+    def get(self) -> np.ndarray:
+        return self.values.copy()
+
+    def value(self, field: str) -> float:
+        return self.values[self.idx[field]]
+
+    def set(self, field: str, value):
+        self.values[self.idx[field]] = try_float(value)
+
+    def update(self, msg: str):
+        """Update values from a message of the `logger` topic, without the
+        topic. Other messages are ignored."""
+
+        if msg.startswith("{"):
+            msg_dict = json.loads(msg)
+            if "position" in msg_dict:  # sample message: {"position": [26848, -4874, -21668]}
+                for field, value in zip(("stage_x", "stage_y", "stage_z"), msg_dict["position"]):
+                    self.set(field, value)
+            elif self.camera_name in msg_dict:
+                status = msg_dict[self.camera_name]
+                self.set("exposure", status.get("exposure"))
+                self.set("gain", status.get("gain"))
+        elif msg.startswith(TEENSY_EXECUTING):
+            command = msg[len(TEENSY_EXECUTING):]
+            if command[:2] in ("sx", "sy", "sz"):
+                self.set(f"stage_v{command[1]}", command[2:])
+            elif command.startswith("sv"):  # sample message: <TEENSY COMMANDS> executing: sv12 -4 n
+                for field, value in zip(("stage_vx", "stage_vy", "stage_vz"), command[2:].split()):
+                    if value != 'n':
+                        self.set(field, value)
+            elif command.startswith("l") and command[1:2] in ("b", "g", "o"):
+                self.set(f"led_{command[1]}", command[2:])
+        elif "<TRACKER-WORM-COORDS>" in msg:  # sample message: <TRACKER-WORM-COORDS> frame 12 x-y coords: (250,261)
+            x, y = msg[msg.rfind('(')+1:-1].split(',')
+            if try_float(x) < 0:  # Worm not found
+                x, y = np.nan, np.nan
+            self.set("worm_x", x)
+            self.set("worm_y", y)
+        elif "<TRACKER-WORM-FOCUS>" in msg:  # sample message: <TRACKER-WORM-FOCUS> z-focus, offsetted: (0.1, 0.3)
+            z_focus = msg[msg.rfind('(')+1:-1].split(',')[0]
+            self.set("z_worm_focus", z_focus)
@@ -122,6 +122,13 @@ class WormTrackerHub(Hub):
     def _teensy_commands_movez(self, zvel):
         self.send("teensy_commands movez {}".format(zvel * self.z_sign))
 
+    def _teensy_commands_set_velocity(self, xvel, yvel, zvel):
+        # Non-numeric values, e.g. 'None', leave the axis unchanged
+        xvel = xvel * self.x_sign if isinstance(xvel, (int, float)) else None
+        yvel = yvel * self.y_sign if isinstance(yvel, (int, float)) else None
+        zvel = zvel * self.z_sign if isinstance(zvel, (int, float)) else None
+        self.send("teensy_commands set_velocity {} {} {}".format(xvel, yvel, zvel))
+
     def _tennsy_commands_set_motor_limit(self, motor, direction):
         self.send("teensy_commands set_motor_limit {} {}".format(motor, direction))
 
@@ -151,6 +158,11 @@ class WormTrackerHub(Hub):
         self.send("writer_behavior set_write_every_n_frames {}".format(write_every_n_frames))
         self.send("writer_gcamp set_write_every_n_frames {}".format(write_every_n_frames))
 
+    def _writer_set_compression(self, codec, level=None):
+        level = "" if level is None else " {}".format(level)
+        self.send("writer_behavior set_compression {}{}".format(codec, level))
+        self.send("writer_gcamp set_compression {}{}".format(codec, level))
+
     def _tracker_set_point(self, i):
         self.send("tracker_behavior set_point {}".format(i))
 
@@ -186,6 +198,12 @@ class WormTrackerHub(Hub):
     def _tracker_set_z_autofocus_tracking_offset(self, offset):
         self.send("tracker_behavior set_z_autofocus_tracking_offset {}".format(offset))
 
+    def _tracker_set_predictive_tracking(self, yes_no):
+        self.send("tracker_behavior set_predictive_tracking {}".format(yes_no))
+
+    def _tracking_models_set_model_status(self, model_key, status):
+        self.send("guiclient set_model_status {} {}".format(model_key, status))
+
     def _flir_camera_set_region_behavior(self, z, y, x, b, offsety, offsetx):
         self.send("FlirCameraBehavior set_region {} {} {} {} {} {}".format(z, y, x, b, offsety, offsetx))
 
@@ -0,0 +1,77 @@
+# Copyright 2025
+# Authors: Mahdi Torkashvand, Sina Rasouli
+
+import numpy as np
+
+
+class KalmanFilter():
+    """Constant-velocity Kalman filter for a 2D point (x, y), with an
+    independent position/velocity state per axis. Known displacements, e.g.
+    caused by the commanded stage velocity, are added during prediction."""
+
+    def __init__(self, q=2000.0, r=4.0, v_std=50.0):
+
+        self.q = q  # process noise, variance of the acceleration (pixels/s^2)^2
+        self.r = r  # measurement noise, variance of the detection (pixels^2)
+        self.v_std = v_std  # initial uncertainty of the velocity (pixels/s)
+
+        self.reset()
+        return
+
+    def reset(self):
+        self.initialized = False
+        self.t = None
+
+        self.p = np.zeros(2)
+        self.v = np.zeros(2)
+        self.P = np.zeros((2, 2, 2))  # one 2x2 covariance per axis
+        return
+
+    def _propagate(self, dt, displacement):
+        F = np.array([[1.0, dt], [0.0, 1.0]])
+        Q = self.q * np.array([
+            [dt**4 / 4, dt**3 / 2],
+            [dt**3 / 2, dt**2]
+        ])
+        p = self.p + self.v * dt + displacement
+        P = F @ self.P @ F.T + Q
+        return p, P
+
+    def predict(self, t, displacement=0.0):
+        if not self.initialized:
+            return
+        dt = max(t - self.t, 0.0)
+        self.p, self.P = self._propagate(dt, displacement)
+        self.t = max(t, self.t)
+        return
+
+    def update(self, t, z, displacement=0.0):
+        z = np.asarray(z, dtype=np.float64)
+
+        # First detection initializes the state
+        if not self.initialized:
+            self.p = z.copy()
+            self.v = np.zeros(2)
+            self.P = np.zeros((2, 2, 2))
+            self.P[:, 0, 0] = self.r
+            self.P[:, 1, 1] = self.v_std**2
+            self.t = t
+            self.initialized = True
+            return
+
+        self.predict(t, displacement)
+
+        # Only the position is observed, H = [1, 0]
+        S = self.P[:, 0, 0] + self.r
+        K = self.P[:, :, 0] / S[:, np.newaxis]
+        innovation = z - self.p
+
+        self.p = self.p + K[:, 0] * innovation
+        self.v = self.v + K[:, 1] * innovation
+        self.P = self.P - K[:, :, np.newaxis] * self.P[:, np.newaxis, 0, :]
+        return
+
+    def extrapolate(self, t, displacement=0.0):
+        """Position at time t, without changing the state of the filter."""
+        dt = max(t - self.t, 0.0)
+        return self.p + self.v * dt + displacement
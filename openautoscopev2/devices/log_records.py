@@ -0,0 +1,74 @@
+# Copyright 2025
+# Authors: Sina Rasouli, Mahdi Torkashvand
+
+"""Parses messages published to the logger into structured log records of
+`writers.log_writer`. Stage, LED and tracking messages, which come with every
+frame, get numeric values; all other messages are saved as text."""
+
+import json
+from typing import Tuple
+
+import numpy as np
+
+from openautoscopev2.devices.frame_metadata import TEENSY_EXECUTING, try_float
+
+# Event types and the names of their values
+LOG_EVENTS = {
+    "message": ("line", ),
+    "position": ("x", "y", "z"),
+    "velocity": ("sx", "sy", "sz"),  # NaN for unchanged velocities
+    "led": ("led", "state"),  # LED index in `LEDS`
+    "worm_coords": ("frame", "x", "y"),  # camera frame index as in `frame_ids` of recordings, x and y are -1 while the worm is not found
+    "worm_focus": ("z", "offset"),
+}
+LEDS = "bgo"
+
+
+def parse_log_message(msg: str) -> Tuple[float, str, str, Tuple[float, ...]]:
+    """Timestamp, source, event and values of a message of the `logger` topic,
+    without the topic. Timestamp is NaN and source is empty if the message has
+    none, values are empty for `message` events."""
+
+    time_message, source, body = np.nan, "", msg
+    # Messages of devices: <timestamp> <name> <message>
+    parts = msg.split(maxsplit=2)
+    if len(parts) == 3 and not np.isnan(try_float(parts[0])):
+        time_message, source, body = try_float(parts[0]), parts[1], parts[2]
+
+    if body.startswith("{"):
+        try:
+            msg_dict = json.loads(body)
+        except ValueError:
+            return time_message, source, "message", ()
+        position = msg_dict.get("position")
+        if isinstance(position, list) and len(position) == 3:  # sample message: {"position": [26848, -4874, -21668]}
+            return time_message, source or "teensy_commands", "position", tuple(map(try_float, position))
+        # Statuses of devices
+        if "device" in msg_dict:
+            source = source or str(msg_dict["device"])
+        elif len(msg_dict) == 1:
+            source = source or str(next(iter(msg_dict)))
+        return time_message, source, "message", ()
+
+    if body.startswith("<") and ">" in body:
+        source = source or body[1:body.index(">")]
+    if body.startswith(TEENSY_EXECUTING):
+        command = body[len(TEENSY_EXECUTING):]
+        if command[:2] in ("sx", "sy", "sz"):
+            values = [np.nan, np.nan, np.nan]
+            values["xyz".index(command[1])] = try_float(command[2:])
+            return time_message, source, "velocity", tuple(values)
+        elif command.startswith("sv"):  # sample message: <TEENSY COMMANDS> executing: sv12 -4 n
+            return time_message, source, "velocity", tuple(try_float(value) for value in command[2:].split()[:3])
+        elif command.startswith("l") and command[1:2] in LEDS:
+            return time_message, source, "led", (LEDS.index(command[1]), try_float(command[2:]))
+    elif "<TRACKER-WORM-COORDS>" in body:  # sample message: <TRACKER-WORM-COORDS> frame 12 x-y coords: (250,261)
+        frame = body.split("frame", 1)[1].split()[:1] if "frame" in body else []
+        coords = body[body.rfind('(')+1:-1].split(',')
+        if len(coords) == 2:
+            return time_message, source, "worm_coords", (try_float(frame[0]) if frame else np.nan, *map(try_float, coords))
+    elif "<TRACKER-WORM-FOCUS>" in body:  # sample message: <TRACKER-WORM-FOCUS> z-focus, offsetted: (0.1, 0.3)
+        values = body[body.rfind('(')+1:-1].split(',')
+        if len(values) == 2:
+            return time_message, source, "worm_focus", tuple(map(try_float, values))
+    return time_message, source, "message", ()
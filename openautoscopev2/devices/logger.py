@@ -4,6 +4,9 @@
 """
 Logger to save published messages to a file.
 
+Messages are saved as structured binary records, see `writers/log_writer.py`,
+and as lines of a text file. Both are written in batches.
+
 Usage:
     logger.py             [options]
 
@@ -14,8 +17,21 @@ Options:
                            [default: 5001]
     --directory=PATH       Location to store published messages.
                            [default: ]
+    --binary=BOOL          Save structured binary records of messages.
+                           [default: True]
+    --text=BOOL            Save messages as text, human-readable and read by `utils_data.load_process_log_files`.
+                           [default: True]
+    --buffer_size=N        Number of records buffered in memory before writing them to the file.
+                           [default: 4096]
+    --flush_interval=SECONDS
+                           Interval between writing buffered messages to the files.
+                           [default: 1]
+    --fsync_interval=SECONDS
+                           Interval between syncing the files to the disk.
+                           [default: 10]
 """
 
+import os
 import time
 
 import zmq
@@ -23,13 +39,20 @@ from docopt import docopt
 
 from openautoscopev2.zmq.utils import get_last
 from openautoscopev2.devices.utils import make_timestamped_filename
+from openautoscopev2.devices.log_records import LOG_EVENTS, parse_log_message
+from openautoscopev2.writers.log_writer import LogWriter, LOG_EXTENSION
 
 class Logger():
 
     def __init__(
             self,
             port: int,
-            directory: str):
+            directory: str,
+            binary=True,
+            text=True,
+            buffer_size=4096,
+            flush_interval=1.0,
+            fsync_interval=10.0):
 
         self.context = zmq.Context.instance()
         self.socket = self.context.socket(zmq.SUB)
@@ -37,37 +60,92 @@ class Logger():
         self.socket.connect("tcp://localhost:{}".format(port))
         self.socket.setsockopt(zmq.SUBSCRIBE, b"logger")
 
-        self.filename = make_timestamped_filename(directory, "log", "txt")
-        self.file = open(self.filename, 'w+')
+        self.binary = binary.lower() == 'true' if isinstance(binary, str) else binary
+        self.text = text.lower() == 'true' if isinstance(text, str) else text
+        self.buffer_size = int(buffer_size)
+        self.flush_interval = float(flush_interval)
+        self.fsync_interval = float(fsync_interval)
+        self.time_flush = time.time()
+        self.time_fsync = time.time()
+
+        self.file = None
+        self.log_writer = None
+        self.open(directory)
 
         self.running = False
 
+    def open(self, directory: str):
+        self.filename = make_timestamped_filename(directory, "log", "txt")
+        if self.text:
+            # Buffered, written every `flush_interval` instead of every message
+            self.file = open(self.filename, 'w+')
+        if self.binary:
+            self.log_writer = LogWriter(
+                os.path.splitext(self.filename)[0] + LOG_EXTENSION,
+                LOG_EVENTS,
+                buffer_size=self.buffer_size,
+                fsync_interval=self.fsync_interval
+            )
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.log_writer is not None:
+            self.log_writer.close()
+            self.log_writer = None
+
     def _run(self):
 
         _ = get_last(self.socket.recv_string)
         self.running = True
 
         while self.running:
-            msg = self.socket.recv_string()[7:]
-            msg_parts = msg.split(maxsplit=1)
-            func = msg_parts[0]
-            if func == "shutdown":
-                self.running = False
-            elif func == "set_directory":
-                 self.set_directory(msg_parts[1])
-
-            msg = self._prepend_timestamp(msg)
-            print(msg, file=self.file, flush=True)
-
-        self.file.close()
-
-    def _prepend_timestamp(self, msg: str) -> str:
-        return "{} {}".format(str(time.time()), msg)
+            if self.socket.poll(timeout=int(1000 * self.flush_interval)):
+                self.handle(self.socket.recv_string()[7:])
+            self.flush()
+
+        self.close()
+
+    def handle(self, msg: str):
+        msg_parts = msg.split(maxsplit=1)
+        func = msg_parts[0] if len(msg_parts) > 0 else ""
+        if func == "shutdown":
+            self.running = False
+        elif func == "set_directory":
+             self.set_directory(msg_parts[1])
+
+        t = time.time()
+        if self.file is not None:
+            print(self._prepend_timestamp(msg, t), file=self.file)
+        if self.log_writer is not None:
+            try:
+                time_message, source, event, values = parse_log_message(msg)
+            except Exception:
+                # Malformed messages are kept as text instead of stopping the logger
+                time_message, source, event, values = float("nan"), "", "message", ()
+            self.log_writer.append(t, time_message, source, event, values, text=msg if event == "message" else None)
+
+    def flush(self):
+        if time.time() < self.time_flush + self.flush_interval:
+            return
+        self.time_flush = time.time()
+        fsync = self.time_flush >= self.time_fsync + self.fsync_interval
+        if fsync:
+            self.time_fsync = self.time_flush
+        if self.file is not None:
+            self.file.flush()
+            if fsync:
+                os.fsync(self.file.fileno())
+        if self.log_writer is not None:
+            self.log_writer.flush(fsync=fsync)
+
+    def _prepend_timestamp(self, msg: str, t: float) -> str:
+        return "{} {}".format(str(t), msg)
     
     def set_directory(self, directory: str):
-        self.file.close()
-        self.filename = make_timestamped_filename(directory, "log", "txt")
-        self.file = open(self.filename, 'w+')
+        self.close()
+        self.open(directory)
 
 def main():
 
@@ -75,7 +153,14 @@ def main():
     inbound = int(args["--inbound"])
     directory = args["--directory"]
 
-    logger = Logger(inbound, directory)
+    logger = Logger(
+        inbound,
+        directory,
+        binary=args["--binary"],
+        text=args["--text"],
+        buffer_size=int(args["--buffer_size"]),
+        flush_interval=float(args["--flush_interval"]),
+        fsync_interval=float(args["--fsync_interval"]))
     logger._run()
 
 if __name__ == "__main__":
@@ -0,0 +1,216 @@
+# Copyright 2025
+# Authors: Sina Rasouli, Mahdi Torkashvand
+
+"""
+Converts tracking/focus models listed in `models.json` to lower precisions
+and benchmarks them against the float model on recorded frames.
+
+`convert` writes `<model>_<precision>.onnx` next to the float model and adds
+a `<model_key>_<precision>` entry to `models.json`. INT8 models are statically
+quantized, with activation ranges calibrated on frames of a recording, e.g.
+`<data_directory>/<timestamp>_flircamera_behavior`. `benchmark` should be run
+on a different recording than the one used for calibration.
+
+Usage:
+    model_precision.py convert <model_key> <precision> [<recording>] [options]
+    model_precision.py benchmark <model_key> <recording> [options]
+
+Options:
+    -h --help                           Show this help.
+    --gui_fp=DIR                        GUI directory with `models.json`.
+                                            [default: .]
+    --n_frames=N                        Number of frames, evenly spaced over the recording.
+                                            [default: 500]
+    --reference=MODEL_KEY               Float model to compare with, defaults to the `source` field of the entry.
+                                            [default: ]
+    --intra_op_threads=N                ONNX runtime threads used within an operator, 0 lets the runtime decide.
+                                            [default: 0]
+"""
+
+import os
+import json
+
+import numpy as np
+from docopt import docopt
+
+from openautoscopev2.devices.onnx_model import OnnxModel
+from openautoscopev2.devices.utils_data import load_files_data_times, SerializeDatas
+from openautoscopev2.devices.retrack import resize_batch
+
+PRECISIONS = [ "fp16", "int8" ]
+
+
+def load_recording_frames(fp_recording, n_frames):
+    """Evenly spaced frames of a recording folder with `.h5` files, resized
+like `tracker.py` does before the live models."""
+
+    files, datas, _ = load_files_data_times(fp_recording)
+    if len(datas) == 0:
+        raise FileNotFoundError(f"No recorded frames in {fp_recording}")
+    data = SerializeDatas(datas)
+    indices = np.unique(np.linspace(0, len(data) - 1, min(n_frames, len(data))).astype(np.int64))
+    frames = resize_batch(np.stack([ data[i] for i in indices ]))
+    for file in files:
+        file.close()
+    return frames
+
+
+def center_crop(frames, image_shape):
+    """Crop the center of resized frames to the input size of a model, e.g. for crop-trained models."""
+
+    ny, nx = frames.shape[1:]
+    ny_crop, nx_crop = image_shape
+    y_offset, x_offset = (ny - ny_crop) // 2, (nx - nx_crop) // 2
+    return frames[:, y_offset:y_offset+ny_crop, x_offset:x_offset+nx_crop]
+
+
+class RecordingDataReader():
+    """Feeds recorded frames to the static quantization calibration."""
+
+    def __init__(self, input_name, input_shape, frames):
+        self.input_name = input_name
+        self.input_shape = input_shape
+        self.frames = iter(frames)
+
+    def get_next(self):
+        frame = next(self.frames, None)
+        if frame is None:
+            return None
+        return { self.input_name: frame.reshape(self.input_shape).astype(np.float32) }
+
+    def rewind(self):
+        return
+
+
+def convert_model(fp_model, fp_output, precision, frames=None):
+    import onnx
+
+    if precision == "fp16":
+        from onnxruntime.transformers.float16 import convert_float_to_float16
+        # Inputs and outputs stay float32, so the model is a drop-in replacement
+        model = convert_float_to_float16(onnx.load(fp_model), keep_io_types=True)
+        onnx.save(model, fp_output)
+    elif precision == "int8":
+        from onnxruntime.quantization import quantize_static, QuantFormat, QuantType
+        from onnxruntime.quantization.shape_inference import quant_pre_process
+        # Shape inference and graph optimizations before quantizing
+        fp_preprocessed = f"{os.path.splitext(fp_output)[0]}_preprocessed.onnx"
+        quant_pre_process(fp_model, fp_preprocessed, skip_symbolic_shape=True)
+        model_input = onnx.load(fp_preprocessed).graph.input[0]
+        # Fixed dimensions of the input, spatial ones default to the frame size
+        input_shape = [
+            dim.dim_value if dim.dim_value > 0 else default
+            for dim, default in zip(model_input.type.tensor_type.shape.dim, (1, 1, *frames.shape[1:]))
+        ]
+        frames = center_crop(frames, input_shape[2:])
+        data_reader = RecordingDataReader(model_input.name, input_shape, frames)
+        quantize_static(
+            fp_preprocessed, fp_output, data_reader,
+            quant_format=QuantFormat.QDQ,
+            activation_type=QuantType.QUInt8,
+            weight_type=QuantType.QInt8,
+            per_channel=True
+        )
+        os.remove(fp_preprocessed)
+    else:
+        raise ValueError(f"Unknown precision: {precision}, should be one of {PRECISIONS}")
+    return
+
+
+def convert(gui_fp, model_key, precision, fp_recording, n_frames):
+    fp_models_json = os.path.join(gui_fp, 'models.json')
+    with open(fp_models_json, "r") as in_file:
+        models_json = json.load(in_file)
+    entry = models_json[model_key]
+    if precision == "int8" and fp_recording is None:
+        raise ValueError("INT8 conversion needs a recording to calibrate on")
+    frames = load_recording_frames(fp_recording, n_frames) if precision == "int8" else None
+
+    path_output = "{}_{}.onnx".format(os.path.splitext(entry['path'])[0], precision)
+    convert_model(
+        os.path.join(gui_fp, entry['path']),
+        os.path.join(gui_fp, path_output),
+        precision,
+        frames=frames
+    )
+
+    # Same fields as the float model, e.g. `sign` or `crop_size`
+    entry_output = dict(entry)
+    entry_output['dsecription'] = f"{precision} variant of {model_key}"
+    entry_output['path'] = path_output
+    entry_output['precision'] = precision
+    entry_output['source'] = model_key
+    models_json[f"{model_key}_{precision}"] = entry_output
+    with open(fp_models_json, "w") as out_file:
+        json.dump(models_json, out_file, indent=4)
+    print(f"Saved {path_output} as {model_key}_{precision}")
+    return
+
+
+def benchmark(gui_fp, model_key, fp_recording, n_frames, reference=None, intra_op_threads=0):
+    with open(os.path.join(gui_fp, 'models.json'), "r") as in_file:
+        models_json = json.load(in_file)
+    entry = models_json[model_key]
+    reference = reference or entry.get('source')
+    if reference is None:
+        raise ValueError(f"No reference model for {model_key}, use --reference")
+    frames = load_recording_frames(fp_recording, n_frames)
+
+    session_kwargs = dict(intra_op_threads=intra_op_threads)
+    ort_runtimes = {
+        key: OnnxModel(
+            os.path.join(gui_fp, models_json[key]['path']),
+            session_kwargs=session_kwargs,
+            image_shape=frames.shape[1:],
+            n_durations=len(frames)
+        )
+        for key in (reference, model_key)
+    }
+    for ort_runtime in ort_runtimes.values():
+        ort_runtime.warm_up()
+
+    # Tracking models output (x, y) in pixels, focus models a single value
+    errors = np.zeros(len(frames))
+    frames_reference = center_crop(frames, ort_runtimes[reference].image_shape)
+    frames = center_crop(frames, ort_runtimes[model_key].image_shape)
+    for i, (frame_reference, frame) in enumerate(zip(frames_reference, frames)):
+        output_reference = ort_runtimes[reference].run(frame_reference).astype(np.float64).ravel()
+        output = ort_runtimes[model_key].run(frame).astype(np.float64).ravel()
+        errors[i] = np.linalg.norm(output - output_reference)
+
+    print(f"{len(frames)} frames from {fp_recording}")
+    for key, ort_runtime in ort_runtimes.items():
+        p50, p90, p99 = ort_runtime.latency_percentiles((50, 90, 99))
+        print("{:<50} {:>6} latency p50/p90/p99: {:>7.3f}/{:>7.3f}/{:>7.3f} (ms)".format(
+            key, models_json[key].get('precision', 'fp32'), p50, p90, p99
+        ))
+    error_name = "pixel error" if model_key.startswith("tracking_") else "error"
+    p50, p90, p99 = np.percentile(errors, (50, 90, 99))
+    print("{} vs {} mean/p50/p90/p99/max: {:.3f}/{:.3f}/{:.3f}/{:.3f}/{:.3f}".format(
+        error_name, reference, errors.mean(), p50, p90, p99, errors.max()
+    ))
+    return errors
+
+
+def main():
+    args = docopt(__doc__)
+    if args["convert"]:
+        convert(
+            gui_fp=args["--gui_fp"],
+            model_key=args["<model_key>"],
+            precision=args["<precision>"].lower(),
+            fp_recording=args["<recording>"],
+            n_frames=int(args["--n_frames"])
+        )
+    elif args["benchmark"]:
+        benchmark(
+            gui_fp=args["--gui_fp"],
+            model_key=args["<model_key>"],
+            fp_recording=args["<recording>"],
+            n_frames=int(args["--n_frames"]),
+            reference=args["--reference"] or None,
+            intra_op_threads=int(args["--intra_op_threads"])
+        )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+# Copyright 2025
+# Authors: Sina Rasouli, Mahdi Torkashvand
+
+"""This module wraps ONNX runtime sessions used by the tracking models."""
+
+import os
+import time
+from collections import deque
+from typing import Tuple
+
+import numpy as np
+import onnxruntime
+
+GRAPH_OPTIMIZATION_LEVELS = {
+    "disable": onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+EXECUTION_MODES = {
+    "sequential": onnxruntime.ExecutionMode.ORT_SEQUENTIAL,
+    "parallel": onnxruntime.ExecutionMode.ORT_PARALLEL,
+}
+
+# Quantized models keep float32 inputs/outputs, FP16 models may not
+TENSOR_DTYPES = {
+    "tensor(float)": np.float32,
+    "tensor(float16)": np.float16,
+}
+
+
+def make_session_options(
+        intra_op_threads: int = 0,
+        inter_op_threads: int = 0,
+        graph_optimization: str = "all",
+        execution_mode: str = "sequential"
+    ) -> onnxruntime.SessionOptions:
+    """Create ONNX runtime session options, 0 threads lets the runtime decide."""
+
+    sess_options = onnxruntime.SessionOptions()
+    sess_options.intra_op_num_threads = int(intra_op_threads)
+    sess_options.inter_op_num_threads = int(inter_op_threads)
+    sess_options.graph_optimization_level = GRAPH_OPTIMIZATION_LEVELS[graph_optimization.lower()]
+    sess_options.execution_mode = EXECUTION_MODES[execution_mode.lower()]
+    return sess_options
+
+
+def load_session(
+        fp_model: str,
+        session_kwargs: dict = None,
+        optimized_model_dir: str = None
+    ) -> onnxruntime.InferenceSession:
+    """Create an inference session. If `optimized_model_dir` is given, the
+    optimized graph is saved there on first load and reused afterwards."""
+
+    session_kwargs = dict() if session_kwargs is None else session_kwargs
+    sess_options = make_session_options(**session_kwargs)
+    if not optimized_model_dir:
+        return onnxruntime.InferenceSession(fp_model, sess_options)
+
+    if not os.path.exists(optimized_model_dir):
+        os.makedirs(optimized_model_dir)
+    stem = os.path.splitext(os.path.basename(fp_model))[0]
+    graph_optimization = session_kwargs.get("graph_optimization", "all").lower()
+    fp_optimized = os.path.join(optimized_model_dir, f"{stem}_{graph_optimization}.onnx")
+    if os.path.exists(fp_optimized) and os.path.getmtime(fp_optimized) >= os.path.getmtime(fp_model):
+        # Already optimized, skip optimizing it again
+        sess_options.graph_optimization_level = GRAPH_OPTIMIZATION_LEVELS["disable"]
+        return onnxruntime.InferenceSession(fp_optimized, sess_options)
+    sess_options.optimized_model_filepath = fp_optimized
+    return onnxruntime.InferenceSession(fp_model, sess_options)
+
+
+class OnnxModel():
+    """Runs a single-input ONNX model on preallocated buffers bound to the
+    session, and keeps a history of inference durations. All outputs are
+    available in `outputs`, the first one also as `output`."""
+
+    def __init__(
+            self,
+            fp_model: str,
+            session_kwargs: dict = None,
+            optimized_model_dir: str = None,
+            image_shape: Tuple[int, int] = (512, 512),
+            batch_size: int = 1,
+            n_durations: int = 300):
+
+        self.fp_model = fp_model
+        self.nbytes = os.path.getsize(fp_model)  # rough estimate of the memory held by the session
+        self.session = load_session(fp_model, session_kwargs, optimized_model_dir)
+
+        input_meta = self.session.get_inputs()[0]
+        outputs_meta = self.session.get_outputs()
+        # Dynamic dimensions are named, e.g. 'batch_size'
+        input_shape = [
+            dim if isinstance(dim, int) else default
+            for dim, default in zip(input_meta.shape, (batch_size, 1, *image_shape))
+        ]
+        self.input = np.zeros(input_shape, dtype=TENSOR_DTYPES[input_meta.type])
+        self.outputs = {
+            output_meta.name: np.zeros(
+                [dim if isinstance(dim, int) else batch_size for dim in output_meta.shape],
+                dtype=TENSOR_DTYPES[output_meta.type]
+            )
+            for output_meta in outputs_meta
+        }
+        self.output = self.outputs[outputs_meta[0].name]
+
+        self.io_binding = self.session.io_binding()
+        self.io_binding.bind_cpu_input(input_meta.name, self.input)
+        for output_name, output in self.outputs.items():
+            self.io_binding.bind_output(
+                output_name, "cpu", 0,
+                output.dtype, output.shape, output.ctypes.data
+            )
+
+        self.durations = deque(maxlen=n_durations)
+
+    @property
+    def image_shape(self) -> Tuple[int, int]:
+        return tuple(self.input.shape[2:])
+
+    def run(self, img: np.ndarray) -> np.ndarray:
+        """Run the model on a single image and return the first output. Output
+        buffers are overwritten by the next call."""
+
+        np.copyto(self.input[0, 0], img)
+        _start = time.time()
+        self.session.run_with_iobinding(self.io_binding)
+        self.durations.append(time.time() - _start)
+        return self.output
+
+    def run_batch(self, imgs: np.ndarray) -> np.ndarray:
+        """Run the model on a stack of images, `batch_size` images per
+        inference, and return a copy of the first output for all of them."""
+
+        batch_size = self.input.shape[0]
+        outputs = np.zeros((len(imgs), *self.output.shape[1:]), dtype=self.output.dtype)
+        for i in range(0, len(imgs), batch_size):
+            n = min(batch_size, len(imgs) - i)
+            np.copyto(self.input[:n, 0], imgs[i:i+n])
+            _start = time.time()
+            self.session.run_with_iobinding(self.io_binding)
+            self.durations.append(time.time() - _start)
+            outputs[i:i+n] = self.output[:n]
+        return outputs
+
+    def warm_up(self):
+        """Run one inference so the first real frame does not pay for memory
+        allocation and kernel selection."""
+
+        self.input[:] = 0.0
+        self.session.run_with_iobinding(self.io_binding)
+
+    def latency_percentiles(self, percentiles=(50, 90, 99)) -> np.ndarray:
+        """Percentiles of recent inference durations in milliseconds."""
+
+        if len(self.durations) == 0:
+            return np.full(len(percentiles), np.nan)
+        return 1000 * np.percentile(self.durations, percentiles)
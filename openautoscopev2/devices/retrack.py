@@ -0,0 +1,168 @@
+# Copyright 2025
+# Authors: Sina Rasouli, Mahdi Torkashvand
+
+"""
+Re-tracks recorded sessions offline with the tracking and focus models of
+`models.json`, e.g. after training improved models.
+
+Each `.h5` file of a recording, e.g. `<data_directory>/<timestamp>_flircamera_behavior`,
+gets a results file with the same name in `<recording>/retracked_<tracking>_<focus>`,
+with worm coordinates and focus values aligned with the recorded `times`.
+Interrupted runs continue from the last saved batch, and finished files are skipped.
+
+Usage:
+    retrack.py <recording>... [options]
+
+Options:
+    -h --help                           Show this help.
+    --gui_fp=DIR                        GUI directory with `models.json`.
+                                            [default: .]
+    --tracking_model=NAME               Tracking model, e.g. `xy4x_all_with_noise`, empty for none.
+                                            [default: ]
+    --focus_model=NAME                  Focus model, e.g. `4x`, empty for none.
+                                            [default: ]
+    --batch_size=N                      Number of frames per inference.
+                                            [default: 16]
+    --n_workers=N                       Number of files processed in parallel.
+                                            [default: 2]
+    --intra_op_threads=N                ONNX runtime threads used within an operator, per worker.
+                                            [default: 1]
+"""
+
+import os
+import json
+from glob import glob
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import h5py
+import cv2 as cv
+import hdf5plugin  # compression filters of recordings, e.g. Blosc
+import numpy as np
+from docopt import docopt
+
+from openautoscopev2.devices.onnx_model import OnnxModel
+from openautoscopev2.devices.tracking_models import is_close_to_arena_boundary, TRACKING_MODELS_IMAGE_SHAPE
+
+# Models loaded by this worker process, by path
+_ORT_RUNTIMES = dict()
+
+
+def get_ort_runtime(fp_model, batch_size, image_shape, session_kwargs):
+    key = (fp_model, batch_size, image_shape)
+    if key not in _ORT_RUNTIMES:
+        _ORT_RUNTIMES[key] = OnnxModel(
+            fp_model,
+            session_kwargs=session_kwargs,
+            image_shape=image_shape,
+            batch_size=batch_size
+        )
+    return _ORT_RUNTIMES[key]
+
+
+def resize_batch(imgs):
+    """Frames resized for the models the same way `tracker.py` does before
+    the live models."""
+    if tuple(imgs.shape[1:]) == TRACKING_MODELS_IMAGE_SHAPE:
+        return imgs
+    return np.stack([
+        cv.resize(img, TRACKING_MODELS_IMAGE_SHAPE[::-1], interpolation=cv.INTER_AREA)
+        for img in imgs
+    ])
+
+
+def retrack_file(fp_file, fp_results, models, batch_size, session_kwargs):
+    """Re-track one recorded file, `models` maps `tracking`/`focus` to a
+    models.json entry. Returns the number of frames processed in this call.
+    Worm coordinates are in pixels of the recorded frames."""
+
+    with h5py.File(fp_file, "r") as in_file, h5py.File(fp_results, "a") as out_file:
+        data, times = in_file['data'], in_file['times']
+        n_frames, image_shape = len(data), TRACKING_MODELS_IMAGE_SHAPE
+        # Models see frames resized to `image_shape`
+        scale_y = data.shape[1] / image_shape[0]
+        scale_x = data.shape[2] / image_shape[1]
+        if 'times' not in out_file:
+            out_file.create_dataset('times', data=times[:n_frames])
+            for name in ('x_worm', 'y_worm', 'z_worm_focus'):
+                out_file.create_dataset(name, shape=(n_frames,), dtype=np.float32, fillvalue=np.nan)
+            out_file.attrs['source'] = fp_file
+            out_file.attrs['n_done'] = 0
+            for key, entry in models.items():
+                out_file.attrs[f"{key}_model"] = entry['path']
+        n_done = int(out_file.attrs['n_done'])
+
+        ort_runtimes = {
+            key: get_ort_runtime(entry['fp_model'], batch_size, image_shape, session_kwargs)
+            for key, entry in models.items()
+        }
+        for i in range(n_done, n_frames, batch_size):
+            imgs = resize_batch(data[i:i+batch_size])
+            n = len(imgs)
+            if 'tracking' in ort_runtimes:
+                xy = ort_runtimes['tracking'].run_batch(imgs)
+                out_file['x_worm'][i:i+n] = xy[:, 0] * scale_x
+                out_file['y_worm'][i:i+n] = xy[:, 1] * scale_y
+            if 'focus' in ort_runtimes:
+                z_focus = ort_runtimes['focus'].run_batch(imgs)[:, 0] * float(models['focus']['sign'])
+                # Close to arena boundary -> don't change focus, same as live tracking
+                z_focus[[ is_close_to_arena_boundary(img) for img in imgs ]] = 0.0
+                out_file['z_worm_focus'][i:i+n] = z_focus
+            # Progress is saved per batch to continue from there if interrupted
+            out_file.attrs['n_done'] = i + n
+            out_file.flush()
+    return n_frames - n_done
+
+
+def main():
+    args = docopt(__doc__)
+    gui_fp = args["--gui_fp"]
+    batch_size = int(args["--batch_size"])
+    session_kwargs = dict(intra_op_threads=int(args["--intra_op_threads"]))
+
+    with open(os.path.join(gui_fp, 'models.json'), "r") as in_file:
+        models_json = json.load(in_file)
+    models = dict()
+    for key in ('tracking', 'focus'):
+        name = args[f"--{key}_model"]
+        if not name:
+            continue
+        entry = dict(models_json[f"{key}_{name}"])
+        if entry['path'].strip() == "" or 'crop_size' in entry:
+            raise ValueError(f"Only full-frame network models can be re-tracked in batches: {key}_{name}")
+        entry['fp_model'] = os.path.join(gui_fp, entry['path'])
+        models[key] = entry
+    if len(models) == 0:
+        raise ValueError("No tracking or focus model selected")
+
+    # Results of all files to process
+    jobs = []
+    folder_results = "retracked_{}_{}".format(args["--tracking_model"] or "none", args["--focus_model"] or "none")
+    for fp_recording in args["<recording>"]:
+        fp_recording_results = os.path.join(fp_recording, folder_results)
+        if not os.path.exists(fp_recording_results):
+            os.makedirs(fp_recording_results)
+        for fp_file in sorted(glob(os.path.join(fp_recording, "*.h5"))):
+            fp_results = os.path.join(fp_recording_results, os.path.basename(fp_file))
+            if os.path.exists(fp_results):
+                with h5py.File(fp_results, "r") as results_file:
+                    is_done = 'times' in results_file and results_file.attrs['n_done'] >= len(results_file['times'])
+                if is_done:
+                    print(f"Already re-tracked: {fp_file}")
+                    continue
+            jobs.append((fp_file, fp_results))
+
+    with ProcessPoolExecutor(max_workers=int(args["--n_workers"])) as executor:
+        futures = {
+            executor.submit(retrack_file, fp_file, fp_results, models, batch_size, session_kwargs): fp_file
+            for fp_file, fp_results in jobs
+        }
+        for i, future in enumerate(as_completed(futures)):
+            fp_file = futures[future]
+            try:
+                n_frames = future.result()
+                print(f"[{i+1}/{len(jobs)}] {n_frames} frames re-tracked: {fp_file}")
+            except Exception as e:
+                print(f"[{i+1}/{len(jobs)}] Error in re-tracking {fp_file}: {e}")
+
+if __name__ == "__main__":
+    main()
@@ -16,6 +16,8 @@ Options:
                                     [default: COM4]
     --name=NAME                 Name used by the hub to send commands.
                                     [default: teensy_commands]
+    --combined_velocity=BOOL    Use the firmware `sv` command to set all axes at once.
+                                    [default: True]
 """
 
 import json
@@ -36,6 +38,7 @@ class TeensyCommandsDevice():
         "sx":"sx{xvel}\n",
         "sy":"sy{yvel}\n",
         "sz":"sz{zvel}\n",
+        "sv":"sv{xvel} {yvel} {zvel}\n",
         "disable":"sf\n",
         "enable":"sn\n",
         "set_led":"l{led_name}{state}\n",
@@ -48,11 +51,13 @@ class TeensyCommandsDevice():
             inbound: Tuple[str, int, bool],
             outbound: Tuple[str, int, bool],
             port,
-            name="teensy_commands"):
+            name="teensy_commands",
+            combined_velocity=True):
 
         self.status = {}
         self.port = port
         self.name = name
+        self.combined_velocity = combined_velocity.lower() == 'true' if isinstance(combined_velocity, str) else combined_velocity
         self.device_status = 1
         self.zspeed = 1
         self.led_b_state = False
@@ -92,6 +97,22 @@ class TeensyCommandsDevice():
     def movez(self, zvel):
         self._execute("sz", zvel=zvel)
 
+    def set_velocity(self, xvel, yvel, zvel):
+        # Non-numeric values, e.g. 'None', leave the axis unchanged
+        vels = [
+            vel if isinstance(vel, (int, float)) else None
+            for vel in (xvel, yvel, zvel)
+        ]
+        if all(vel is None for vel in vels):
+            return
+        if self.combined_velocity:  # One serial round trip, `n` is skipped by the firmware
+            xvel, yvel, zvel = ['n' if vel is None else vel for vel in vels]
+            self._execute("sv", xvel=xvel, yvel=yvel, zvel=zvel)
+        else:
+            for move, vel in zip((self.movex, self.movey, self.movez), vels):
+                if vel is not None:
+                    move(vel)
+
     def update_coordinates(self):
         self.status_publisher.send("logger " + json.dumps({"position": [self.x, self.y, self.z]}, default=int))
 
@@ -160,9 +181,7 @@ class TeensyCommandsDevice():
         self.movez(sign * self.zspeed)
 
     def shutdown(self):
-        self.movex(0)
-        self.movey(0)
-        self.movez(0)
+        self.set_velocity(0, 0, 0)
         self.reset_leds()
         self.disable()
         self.serial_obj.close()
@@ -193,7 +212,8 @@ def main():
         inbound=parse_host_and_port(arguments["--inbound"]),
         outbound=parse_host_and_port(arguments["--outbound"]),
         port=arguments["--port"],
-        name=arguments["--name"])
+        name=arguments["--name"],
+        combined_velocity=arguments["--combined_velocity"])
 
     if device is not None:
         device._run()
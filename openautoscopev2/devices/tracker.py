@@ -29,14 +29,23 @@ Options:
                                             [default: False]
     --z_autofocus_tracking=BOOL       Uses a pre-trained model to estimate focus.
                                             [default: False]
+    --predictive_tracking=BOOL        Uses a constant-velocity Kalman filter to compensate tracking latency.
+                                          Needs `--pixels_per_step`, stays off otherwise.
+                                            [default: False]
+    --pixels_per_step=N               Worm displacement in the 512 by 512 image per stage step, calibrated per objective.
+                                            [default: 0.0]
     --gui_fp=DIR                        GUI directory used to load model names.
                                             [default: .]
     --flip_image                        Flip x in recieved image before publishing.
+    --hwm=N                             Number of frames held by ZMQ from the camera and to the writer before dropping them,
+                                        e.g. for `oas_writer --lossless=True`. Empty for the ZMQ default of 1000.
+                                            [default: ]
 """
 
 import time
 import json
-from typing import Tuple
+from typing import Tuple, Optional
+from collections import deque
 
 
 import zmq
@@ -44,8 +53,9 @@ import cv2 as cv
 import numpy as np
 from docopt import docopt
 from openautoscopev2.devices.pid_controller import PIDController
+from openautoscopev2.devices.kalman_filter import KalmanFilter
 
-from openautoscopev2.zmq.array import TimestampedPublisher, TimestampedSubscriber
+from openautoscopev2.zmq.array import TimestampedPublisher, FrameIndexedPublisher, FrameIndexedSubscriber
 from openautoscopev2.zmq.publisher import Publisher
 from openautoscopev2.zmq.subscriber import ObjectSubscriber
 from openautoscopev2.zmq.utils import parse_host_and_port
@@ -73,9 +83,12 @@ class TrackerDevice:
             fmt: str,
             interpolation_tracking:bool,
             z_autofocus_tracking:bool,
+            predictive_tracking:bool,
+            pixels_per_step: float,
             name: str,
             gui_fp: str,
-            flip_image: bool
+            flip_image: bool,
+            hwm: Optional[int] = None
         ):
 
         self.flip_image = flip_image
@@ -87,8 +100,18 @@ class TrackerDevice:
         self.TRACKING_RETRACTION_FACTOR_XY = 0.87  # 256*x^40 = 1 -> getting to sub 1 pixel close to image center after 40 frames
         self.TRACKING_RETRACTION_FACTOR_Z  = 0.93  # x^40 = 0.05 -> getting to sub 0.05 in terms of focus estimation after 40 frames
 
+        self.KALMAN_PIXELS_PER_STEP = float(pixels_per_step)  # worm displacement in the image per stage step, calibrated per objective. 0 disables predictive tracking
+        self.KALMAN_ACTUATION_DELAY = 0.005  # seconds between publishing velocities and the teensy executing them
+        self.KALMAN_MAX_PREDICTION_DURATION = 1.0  # seconds without detections before falling back to retraction
+        self.MAX_DETECTION_AGE = 0.25  # seconds after capture before results from tracking models are discarded
+
         self.interpolation_tracking = interpolation_tracking.lower() == 'true' if isinstance(interpolation_tracking, str) else interpolation_tracking
         self.z_autofocus_tracking = z_autofocus_tracking.lower() == 'true' if isinstance(z_autofocus_tracking, str) else z_autofocus_tracking
+        self.predictive_tracking = predictive_tracking.lower() == 'true' if isinstance(predictive_tracking, str) else predictive_tracking
+        if self.predictive_tracking and self.KALMAN_PIXELS_PER_STEP == 0.0:
+            # Without the stage displacement the filter extrapolates the worm motion caused by the stage itself
+            print("Predictive tracking needs --pixels_per_step, disabled")
+            self.predictive_tracking = False
         self.points = np.zeros((3, 3)) * np.nan
         self.curr_point = np.zeros(3)
         self.N = np.zeros(3) * np.nan
@@ -117,6 +140,17 @@ class TrackerDevice:
             SPy=self.img_y_center, SPx=self.img_x_center
         )
         self.verbose_z_focus_counter = 0
+        self.kalman_filter = KalmanFilter()
+        self.velocity_history = deque(maxlen=64)  # (time, vx, vy) of the commanded stage velocities
+        self.frame_counter = 0  # goes up with each tracked frame, also when the camera restarts and its frame index with it
+        self.frames_tracking_models = deque(maxlen=64)  # (camera frame index, frame_counter) of the frames sent to tracking models
+        self.timestamp_tracking_models = None  # capture time of the last frame sent to tracking models
+        self.timestamp_xy_worm = None  # capture time of the frame the worm coordinates belong to
+        self.frame_id_xy_worm = -1  # camera frame index, as in `frame_ids` of recordings
+        self.frame_counter_xy_worm = -1
+        self.frame_counter_z_worm = -1
+        self.latency_xy_worm = 0.0
+        self.n_stale_detections = 0
 
         self.found_trackedworm = False
 
@@ -128,12 +162,13 @@ class TrackerDevice:
             port=commands_out[1],
             bound=commands_out[2])
         
-        self.data_publisher_writer = TimestampedPublisher(
+        self.data_publisher_writer = FrameIndexedPublisher(
             host=data_out_writer[0],
             port=data_out_writer[1],
             bound=data_out_writer[2],
             shape=self.shape,
-            datatype=dtype)
+            datatype=dtype,
+            hwm=hwm)
         
         self.data_publisher_displayer = TimestampedPublisher(
             host=data_out_displayer[0],
@@ -142,7 +177,7 @@ class TrackerDevice:
             shape=self.shape,
             datatype=dtype)
 
-        self.data_publisher_tracking_models = TimestampedPublisher(
+        self.data_publisher_tracking_models = FrameIndexedPublisher(
             host=data_out_tracking_model[0],
             port=data_out_tracking_model[1],
             bound=data_out_tracking_model[2],
@@ -157,12 +192,13 @@ class TrackerDevice:
             port=commands_in[1],
             bound=commands_in[2])
 
-        self.data_subscriber = TimestampedSubscriber(
+        self.data_subscriber = FrameIndexedSubscriber(
             host=data_in[0],
             port=data_in[1],
             bound=data_in[2],
             shape=self.shape,
-            datatype=dtype)
+            datatype=dtype,
+            hwm=hwm)
 
         self.poller = zmq.Poller()
         self.poller.register(self.command_subscriber.socket, zmq.POLLIN)
@@ -263,6 +299,7 @@ class TrackerDevice:
         else:  # Consume the set coordinates
             self.is_xy_worm_set = False
             self._log_worm_positions()
+            self._update_kalman_filter()
         ## Z Focusing
         if self.focus_mode is None:
             pass
@@ -297,19 +334,52 @@ class TrackerDevice:
             )
         return img_annotated
 
-    def set_z_worm_focus(self, z_worm_focus):
+    def _frame_counter(self, frame_id):
+        # Counter of the latest frame with this camera frame index sent to tracking models, -1 if it is too old
+        for _frame_id, frame_counter in reversed(self.frames_tracking_models):
+            if _frame_id == frame_id:
+                return frame_counter
+        return -1
+
+    def _is_stale_detection(self, frame_counter, timestamp, frame_counter_last):
+        # Results older than the last consumed one, or captured too long ago, are not used for control
+        if frame_counter is None or timestamp is None:
+            return False
+        is_stale = frame_counter <= frame_counter_last or (time.time() - timestamp) > self.MAX_DETECTION_AGE
+        if is_stale:
+            self.n_stale_detections += 1
+        return is_stale
+    def set_z_worm_focus(self, z_worm_focus, frame_id=None, timestamp=None):
+        frame_counter = self._frame_counter(frame_id) if frame_id is not None else None
+        if self._is_stale_detection(frame_counter, timestamp, self.frame_counter_z_worm):
+            return
+        if frame_counter is not None:
+            self.frame_counter_z_worm = frame_counter
         if isinstance(z_worm_focus, str):  # argument is not an int or a float, e.g. ObjectSubscriber failed to convert it -> it should be 'None' string
             self.z_worm_focus = None
         else:
             self.z_worm_focus = z_worm_focus
             self.is_z_worm_set = True
         return
-    def set_xy_worm(self, x_worm, y_worm):
+    def set_xy_worm(self, x_worm, y_worm, frame_id=None, timestamp=None):
+        frame_counter = self._frame_counter(frame_id) if frame_id is not None else None
+        if self._is_stale_detection(frame_counter, timestamp, self.frame_counter_xy_worm):
+            return
+        if frame_counter is not None:
+            self.frame_id_xy_worm = frame_id
+            self.frame_counter_xy_worm = frame_counter
         if isinstance(x_worm, str) or isinstance(y_worm, str):  # argument is not an int or a float, e.g. ObjectSubscriber failed to convert it -> it should be 'None' string
             self.x_worm, self.y_worm = None, None
         else:
             self.x_worm, self.y_worm = x_worm, y_worm
             self.is_xy_worm_set = True
+            # Untagged results are assumed to belong to the most recent frame sent to the tracking models
+            if timestamp is not None:
+                self.timestamp_xy_worm = timestamp
+            elif self.timestamp_tracking_models is not None:
+                self.timestamp_xy_worm = self.timestamp_tracking_models
+            else:
+                self.timestamp_xy_worm = time.time()
         return
     def set_boundingbox_worm(self, xmin, xmax, ymin, ymax):
         if isinstance(xmin, str) or isinstance(xmax, str) or isinstance(ymin, str) or isinstance(ymax, str):
@@ -337,6 +407,7 @@ class TrackerDevice:
             self.bbox_worm_xmin, self.bbox_worm_xmax = None, None
             self.bbox_worm_ymin, self.bbox_worm_ymax = None, None
             self.tracking_mode = None
+            self.kalman_filter.reset()
             self.command_publisher.send("tracking_models_behavior set_tracking_mode {}".format( None ))
         # elif self.tracking_mode == "xy_threshold":
         #     # Send signal to tracking device to stop
@@ -361,16 +432,57 @@ class TrackerDevice:
         # Return
         return
 
-    def send_img_to_tracking_models(self, img):
+    def send_img_to_tracking_models(self, img, frame_id, timestamp):
         if self.data_publisher_tracking_models is not None:
             # Don't send data over if not necessary
             # if (self.tracking_mode == "xy_threshold" or self.tracking_mode is None) and self.focus_mode is None:
             if self.tracking_mode is None and self.focus_mode is None:
                 pass
             else:  # Send the image to device and wait for the call-back from there
-                self.data_publisher_tracking_models.send(img)
+                self.data_publisher_tracking_models.send(img, frame_id, timestamp)
+                self.frames_tracking_models.append((frame_id, self.frame_counter))
+                self.timestamp_tracking_models = timestamp
         return
 
+    def _stage_displacement(self, t_start, t_end):
+        # Worm displacement in the image caused by the commanded stage velocities between `t_start` and `t_end`
+        displacement = np.zeros(2)
+        if self.KALMAN_PIXELS_PER_STEP == 0.0 or t_end <= t_start:
+            return displacement
+        history = list(self.velocity_history)
+        for i, (t_command, vx, vy) in enumerate(history):
+            t_from = max(t_command + self.KALMAN_ACTUATION_DELAY, t_start)
+            t_to = min(history[i+1][0] + self.KALMAN_ACTUATION_DELAY, t_end) if i+1 < len(history) else t_end
+            if t_to > t_from:
+                # Positive vx moves the worm toward +x, positive vy toward -y (see `PIDController.get_velocity`)
+                displacement += (t_to - t_from) * np.array([vx, -vy])
+        return self.KALMAN_PIXELS_PER_STEP * displacement
+
+    def _update_kalman_filter(self):
+        if not self.predictive_tracking or is_nan(self.x_worm) or is_nan(self.y_worm):
+            return
+        t_detection = self.timestamp_xy_worm
+        displacement = self._stage_displacement(self.kalman_filter.t, t_detection) if self.kalman_filter.initialized else 0.0
+        self.kalman_filter.update(t_detection, (self.x_worm, self.y_worm), displacement)
+        self.latency_xy_worm = 0.9*self.latency_xy_worm + 0.1*(time.time() - t_detection)
+        return
+
+    def _estimate_worm_position(self):
+        # Predict where the worm is when the stage executes the next velocity command
+        if not self.predictive_tracking or not self.kalman_filter.initialized:
+            return self.x_worm, self.y_worm
+        t_actuation = time.time() + self.KALMAN_ACTUATION_DELAY
+        if t_actuation - self.kalman_filter.t > self.KALMAN_MAX_PREDICTION_DURATION:  # Lost for too long, retract instead
+            self.kalman_filter.reset()
+            return self.x_worm, self.y_worm
+        x_worm, y_worm = self.kalman_filter.extrapolate(
+            t_actuation,
+            self._stage_displacement(self.kalman_filter.t, t_actuation)
+        )
+        x_worm = np.clip(x_worm, 0, 2*self.img_x_center - 1)
+        y_worm = np.clip(y_worm, 0, 2*self.img_y_center - 1)
+        return x_worm, y_worm
+
     def _process(self):
         ###################### DEBUG
         self.DEBUG_timestamp_start_process = time.time()
@@ -380,13 +492,14 @@ class TrackerDevice:
             self.DEBUG_duration_process = 0.0
         ######################
 
-        msg_timestamp, msg = self.data_subscriber.get_last()
-        if msg is not None:
-            self.data = msg[:,::-1] if self.flip_image else msg
-        else:
+        msgs = self.data_subscriber.get_all()
+        if len(msgs) == 0:
             return
-
-        self.data_publisher_writer.send(self.data, msg_timestamp)
+        # Every frame goes to the writer with its camera frame index, only the last one is tracked
+        for msg_frame_id, msg_timestamp, msg in msgs:
+            self.data = msg[:,::-1] if self.flip_image else msg
+            self.data_publisher_writer.send(self.data, msg_frame_id, msg_timestamp)
+        self.frame_counter += 1
 
         if tuple(self.data.shape) != (512, 512):
             data = cv.resize(self.data, (512, 512), interpolation=cv.INTER_AREA)
@@ -401,7 +514,7 @@ class TrackerDevice:
             return
 
         # Detecting the tracking point and z-focus
-        self.send_img_to_tracking_models(data)
+        self.send_img_to_tracking_models(data, msg_frame_id, msg_timestamp)
         img_annotated = self.detect(data)
 
         self.data_publisher_displayer.send(img_annotated)
@@ -426,7 +539,8 @@ class TrackerDevice:
                     self.vy, self.vx = None, None
             elif self.found_trackedworm:  # Tracking and worm found
                 self.missing_worm_idx = 0
-                self.vy, self.vx = self.pid_controller.get_velocity(self.y_worm, self.x_worm)
+                x_worm, y_worm = self._estimate_worm_position()
+                self.vy, self.vx = self.pid_controller.get_velocity(y_worm, x_worm)
         else:  # Disabled tracking
             self.vx, self.vy, self.vz = None, None, None
 
@@ -438,6 +552,12 @@ class TrackerDevice:
             self.DEBUG_timestamp_end = time.time()
             self.DEBUG_duration_overall = ( self.DEBUG_timestamp_end - self.DEBUG_timestamp_start )
             print(f"Duration for 100 frames overall/processed: {(self.DEBUG_duration_overall*10):>5.2f}ms / {(self.DEBUG_duration_process*10):>5.2f}ms")
+            if self.predictive_tracking:
+                print(f"Detection latency: {(self.latency_xy_worm*1000):>5.2f}ms")
+            if self.n_stale_detections > 0:
+                print(f"Discarded {self.n_stale_detections} stale detections")
+                self._send_log(f"discarded {self.n_stale_detections} stale detections older than {self.MAX_DETECTION_AGE}s")
+                self.n_stale_detections = 0
         self.DEBUG_counter += 1
         ######################
         return
@@ -449,6 +569,7 @@ class TrackerDevice:
             self.tracking = True
             self.command_publisher.send("tracking_models_behavior start_tracking")
             self.pid_controller.reset()
+            self.kalman_filter.reset()
         return
 
     def stop(self):
@@ -459,6 +580,7 @@ class TrackerDevice:
             self.tracking = False
             self.command_publisher.send("tracking_models_behavior stop_tracking")
             self.pid_controller.reset()
+            self.kalman_filter.reset()
         return
 
     def shutdown(self):
@@ -478,7 +600,7 @@ class TrackerDevice:
 
     def _log_worm_positions(self):
         x,y = (self.x_worm, self.y_worm) if self.found_trackedworm else (-1, -1)
-        msg = f"<TRACKER-WORM-COORDS> x-y coords: ({x},{y})"
+        msg = f"<TRACKER-WORM-COORDS> frame {self.frame_id_xy_worm} x-y coords: ({x},{y})"
         self._send_log(msg)
         return
 
@@ -518,6 +640,19 @@ class TrackerDevice:
         self.z_worm_focus_offset = float(offset)
         return
 
+    def set_predictive_tracking(self, yes_no):
+        if isinstance(yes_no, bool):
+            self.predictive_tracking = yes_no
+        elif isinstance(yes_no, int):
+            self.predictive_tracking = yes_no == 1
+        else:
+            self.predictive_tracking = yes_no.lower() == 'true'
+        if self.predictive_tracking and self.KALMAN_PIXELS_PER_STEP == 0.0:
+            self._send_log("predictive tracking needs pixels_per_step calibrated for the objective, disabled")
+            self.predictive_tracking = False
+        self.kalman_filter.reset()
+        return
+
     def _run(self):
 
         while self.running:
@@ -530,13 +665,16 @@ class TrackerDevice:
         return
 
     def _set_velocities(self, vx, vy, vz):
-    
-        if vx is not None:
-            self.command_publisher.send("hub _teensy_commands_movex {}".format(vx))
-        if vy is not None:
-            self.command_publisher.send("hub _teensy_commands_movey {}".format(vy))
-        if vz is not None:
-            self.command_publisher.send("hub _teensy_commands_movez {}".format(vz))
+        # All three axes go out in one message, `None` leaves that axis unchanged
+        if vx is not None or vy is not None or vz is not None:
+            self.command_publisher.send("hub _teensy_commands_set_velocity {} {} {}".format(vx, vy, vz))
+        if vx is not None or vy is not None:
+            _, vx_last, vy_last = self.velocity_history[-1] if len(self.velocity_history) > 0 else (None, 0, 0)
+            self.velocity_history.append((
+                time.time(),
+                vx if vx is not None else vx_last,
+                vy if vy is not None else vy_last
+            ))
         self._send_log(f"set velocities ({vx},{vy},{vz})")
         self.get_curr_pos()
         return
@@ -554,9 +692,12 @@ def main():
         fmt=arguments["--format"],
         interpolation_tracking=arguments["--interpolation_tracking"],
         z_autofocus_tracking=arguments["--z_autofocus_tracking"],
+        predictive_tracking=arguments["--predictive_tracking"],
+        pixels_per_step=float(arguments["--pixels_per_step"]),
         name=arguments["--name"],
         gui_fp=arguments["--gui_fp"],
-        flip_image=arguments["--flip_image"])
+        flip_image=arguments["--flip_image"],
+        hwm=int(arguments["--hwm"]) if arguments["--hwm"] else None)
 
     device._run()
 
@@ -19,25 +19,48 @@ Options:
                                             [default: tracking_models]
     --gui_fp=DIR                        GUI directory used to load model names.
                                             [default: .]
+    --intra_op_threads=N                ONNX runtime threads used within an operator, 0 lets the runtime decide.
+                                            [default: 0]
+    --inter_op_threads=N                ONNX runtime threads used across operators, 0 lets the runtime decide.
+                                            [default: 0]
+    --graph_optimization=LEVEL          ONNX graph optimization level: disable, basic, extended or all.
+                                            [default: all]
+    --execution_mode=MODE               ONNX execution mode: sequential or parallel.
+                                            [default: sequential]
+    --optimized_model_dir=DIR           Directory to cache optimized models in, empty to disable.
+                                            [default: ]
+    --concurrent_inference=BOOL         Runs the focus and XY-tracking models concurrently on a thread pool.
+                                            [default: False]
+    --max_loaded_models_mb=MB           Memory cap for loaded models, least recently used ones are unloaded first. 0 for no cap.
+                                            [default: 0]
+    --otsu_every_n_frames=N             Recompute the threshold of the xy_threshold mode every N frames, or when the histogram drifts.
+                                            [default: 10]
+    --otsu_smoothing=ALPHA              Weight of the previous threshold when averaging it across frames, 0 for no smoothing.
+                                            [default: 0.0]
+    --motion_gating_threshold=T         Re-use the last estimates if the mean absolute change of the downsampled frame is below T gray levels, 0 to disable.
+                                            [default: 0]
+    --motion_gating_max_skip=N          Maximum number of consecutive frames to re-use the last estimates for.
+                                            [default: 10]
 """
 
 from docopt import docopt
 from typing import Tuple
 from openautoscopev2.zmq.utils import parse_host_and_port
 import zmq
-from openautoscopev2.zmq.array import TimestampedSubscriber
+from openautoscopev2.zmq.array import FrameIndexedSubscriber
 from openautoscopev2.zmq.publisher import Publisher
 from openautoscopev2.zmq.subscriber import ObjectSubscriber
+from openautoscopev2.devices.onnx_model import OnnxModel
 
 
 
 import numpy as np
 import os
 import json
-import onnxruntime
 import cv2 as cv
-from skimage import filters
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 # Threshold tracking parameters
 XY_TRACKING_BLUR_SIZE = 5
@@ -47,23 +70,48 @@ XY_TRACKING_SMALLEST_TRACKING_OBJECT = 200
 XY_TRACKING_SIZE_FLUCTUATIONS = 0.25
 XY_TRACKING_CENTER_SPEED = 100
 XY_TRACKING_MASK_KERNEL_BLUR = 5
-
-def minmax(arr):
-    return np.min(arr), np.max(arr)
-
-def img_to_object_mask_threshold(img, threshold):
+XY_TRACKING_OTSU_HISTOGRAM_DRIFT = 0.1  # fraction of pixels moved to other intensities since the last threshold
+
+# Crop inference parameters, estimates closer than this to an edge of the crop are re-estimated on the full frame
+XY_CROP_EDGE_MARGIN = 32
+
+# Motion gating compares frames downsampled by this factor
+MOTION_GATING_DOWNSAMPLE = 8
+
+def is_close_to_arena_boundary(img):
+    return np.mean( img < 50 ) >= 0.05
+
+def threshold_otsu_histogram(hist):
+    # Otsu threshold of a uint8 image from its 256 bin histogram, same as `skimage.filters.threshold_otsu`
+    hist = hist.astype(np.float64).ravel()
+    bins = np.flatnonzero(hist)
+    if bins.size == 0:
+        return 0
+    if bins.size == 1:
+        return int(bins[0])
+    # Only intensities between min and max of the image, class weights are never zero
+    hist = hist[bins[0]:bins[-1]+1]
+    bin_centers = np.arange(bins[0], bins[-1]+1)
+    weight1 = np.cumsum(hist)
+    weight2 = np.cumsum(hist[::-1])[::-1]
+    mean1 = np.cumsum(hist * bin_centers) / weight1
+    mean2 = (np.cumsum((hist * bin_centers)[::-1]) / weight2[::-1])[::-1]
+    variance12 = weight1[:-1] * weight2[1:] * (mean1[:-1] - mean2[1:]) ** 2
+    return int(bin_centers[np.argmax(variance12)])
+
+def img_to_objects_threshold(img, threshold):
+    # Stats (x, y, width, height, area) and centroids (y, x) of foreground objects larger than a specific size
     img_blurred = cv.blur(img, (XY_TRACKING_BLUR_SIZE, XY_TRACKING_BLUR_SIZE))
-    img_objects = (img_blurred < threshold).astype(np.float32)
-    img_objects_eroded = cv.erode(img_objects, XY_TRACKING_KERNEL_ERODE).astype(np.float32)
-    img_objects_dilated = cv.dilate(img_objects_eroded, XY_TRACKING_KERNEL_DILATE).astype(np.float32)
-    _, labels, rectangles, _ = cv.connectedComponentsWithStats(img_objects_dilated.astype(np.uint8))
-    for i, rectangle in enumerate(rectangles):
-        _size = rectangle[-1]
-        if _size <= XY_TRACKING_SMALLEST_TRACKING_OBJECT:
-            indices = labels == i
-            labels[indices] = 0
-    mask = labels > 0
-    return mask
+    img_objects = (img_blurred < threshold).astype(np.uint8)
+    img_objects_eroded = cv.erode(img_objects, XY_TRACKING_KERNEL_ERODE)
+    img_objects_dilated = cv.dilate(img_objects_eroded, XY_TRACKING_KERNEL_DILATE)
+    _, _, stats, centroids = cv.connectedComponentsWithStats(img_objects_dilated)
+    is_object = stats[:, cv.CC_STAT_AREA] > XY_TRACKING_SMALLEST_TRACKING_OBJECT
+    is_object[0] = False  # label 0 is the background
+    if stats[0, cv.CC_STAT_AREA] == 0:
+        # No background pixel, the only object is the whole frame, not a worm
+        is_object[:] = False
+    return stats[is_object], centroids[is_object, ::-1]  # swap x-y to match with `numpy.where` conventions
 
 # Hard coded parameters for data channel/connection between tracker and tracking_models
 TRACKING_MODELS_IMAGE_SHAPE = (512, 512)
@@ -78,20 +126,42 @@ class TrackingModels:
             commands_out: Tuple[str, int, bool],
             data_in: Tuple[str, int, bool],
             gui_fp: str,
-            name: str = "oas_tracking_models"
+            name: str = "oas_tracking_models",
+            intra_op_threads: int = 0,
+            inter_op_threads: int = 0,
+            graph_optimization: str = "all",
+            execution_mode: str = "sequential",
+            optimized_model_dir: str = None,
+            concurrent_inference: bool = False,
+            max_loaded_models_mb: float = 0,
+            otsu_every_n_frames: int = 10,
+            otsu_smoothing: float = 0.0,
+            motion_gating_threshold: float = 0,
+            motion_gating_max_skip: int = 10
         ):
         self.name = name
         self.gui_fp = gui_fp
-        # Initial load
+        self.session_kwargs = dict(
+            intra_op_threads=intra_op_threads,
+            inter_op_threads=inter_op_threads,
+            graph_optimization=graph_optimization,
+            execution_mode=execution_mode,
+        )
+        self.optimized_model_dir = optimized_model_dir
+        self.concurrent_inference = concurrent_inference.lower() == 'true' if isinstance(concurrent_inference, str) else concurrent_inference
+        # ONNX runtime releases the GIL, focus model runs here while XY-tracking runs on the main thread
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        # Models are loaded on demand in the background, `ort_dict` is kept in least recently used order
+        self.loader = ThreadPoolExecutor(max_workers=1)
+        self.max_loaded_models_mb = float(max_loaded_models_mb)
         self.models_json = dict()
-        self.ort_dict = dict()
+        self.ort_dict = OrderedDict()
+        self.models_loading = dict()
         self.selected_tracking_mode = None
         self.selected_focus_mode = None
-        self.load_models()
+        self.selected_fused_model = None
         # Reporting prcessing time
         self.verbose_cycle_counter = 0
-        self.verbose_total_time_XYtracker = 0.0
-        self.verbose_total_time_autofocus = 0.0
 
         # Initialize all connections
         self.data = np.zeros(TRACKING_MODELS_IMAGE_SHAPE)
@@ -102,6 +172,21 @@ class TrackingModels:
         self.z_worm_focus = None
         self.trackedworm_size = None
         self.trackedworm_center = None
+        self.n_crop_inferences = 0
+        self.n_crop_fallbacks = 0
+        # Threshold of the xy_threshold mode
+        self.otsu_every_n_frames = int(otsu_every_n_frames)
+        self.otsu_smoothing = float(otsu_smoothing)
+        self.otsu = None
+        self.otsu_hist = None
+        self.otsu_counter = 0
+        # Motion gating, skip inference if the frame did not change since the last estimates
+        self.motion_gating_threshold = float(motion_gating_threshold)
+        self.motion_gating_max_skip = int(motion_gating_max_skip)
+        self.gating_reference = None
+        self.n_skipped_consecutive = 0
+        self.n_gated_frames = 0
+        self.n_gated_skips = 0
 
         # Run parameters
         self.tracking = True  # if tracking is active  DEBUG! IT WAS `FALSE`
@@ -121,7 +206,7 @@ class TrackingModels:
             bound=commands_in[2]
         )
 
-        self.data_subscriber = TimestampedSubscriber(
+        self.data_subscriber = FrameIndexedSubscriber(
             host=data_in[0],
             port=data_in[1],
             bound=data_in[2],
@@ -133,11 +218,14 @@ class TrackingModels:
         self.poller.register(self.command_subscriber.socket, zmq.POLLIN)
         self.poller.register(self.data_subscriber.socket, zmq.POLLIN)
 
+        # Initial load
+        self.load_models()
+
         # Return
         return
 
     def load_models(self):
-        # Load `models.json`
+        # Load `models.json`, sessions are created when a model is selected
         fp_models_json = os.path.join(self.gui_fp, 'models.json')
         if not os.path.exists(fp_models_json):
             self._send_log( f"<TrackingModels> File does not exist! {fp_models_json}" )
@@ -145,78 +233,253 @@ class TrackingModels:
         ## Load models info
         with open(fp_models_json, "r") as in_file:
             self.models_json = json.load(in_file)
-        ## Load ONNX sessions
-        for model_key, entry in self.models_json.items():
-            # Skip thresholding model
-            if entry['path'].strip() == "":
+        # Return
+        return
+
+    def get_model_path(self, model_key):
+        # Path of an existing ONNX model for the entry, `None` for thresholding or missing models
+        entry = self.models_json.get(model_key)
+        if entry is None or entry['path'].strip() == "":
+            return None
+        fp_model = os.path.join(self.gui_fp, entry['path'])
+        if not os.path.exists(fp_model):
+            self._send_log( f"<TrackingModels> Model file does not exist! {fp_model}" )
+            return None
+        return fp_model
+
+    def get_selected_model_keys(self):
+        if self.selected_fused_model is not None:
+            return [ self.selected_fused_model ]
+        model_keys = []
+        if self.selected_tracking_mode is not None and self.selected_tracking_mode != "xy_threshold":
+            model_key = f"tracking_{self.selected_tracking_mode}"
+            model_keys.append(model_key)
+            # Crop models fall back to a full-frame model
+            if 'full_frame' in self.models_json.get(model_key, {}):
+                model_keys.append(self.models_json[model_key]['full_frame'])
+        if self.selected_focus_mode is not None:
+            model_keys.append(f"focus_{self.selected_focus_mode}")
+        return model_keys
+
+    def _load_model(self, fp_model, image_shape):
+        # Runs on the loader thread
+        ort_runtime = OnnxModel(
+            fp_model,
+            session_kwargs=self.session_kwargs,
+            optimized_model_dir=self.optimized_model_dir,
+            image_shape=image_shape
+        )
+        ort_runtime.warm_up()
+        return ort_runtime
+
+    def request_model(self, model_key):
+        if model_key in self.ort_dict:
+            self.ort_dict.move_to_end(model_key)
+            self.send_model_status(model_key, "ready")
+            return
+        if model_key in self.models_loading:
+            return
+        fp_model = self.get_model_path(model_key)
+        if fp_model is None:
+            self.send_model_status(model_key, "missing")
+            return
+        crop_size = self.models_json[model_key].get('crop_size')
+        image_shape = TRACKING_MODELS_IMAGE_SHAPE if crop_size is None else (int(crop_size), int(crop_size))
+        self.models_loading[model_key] = self.loader.submit(self._load_model, fp_model, image_shape)
+        self.send_model_status(model_key, "loading")
+        return
+
+    def check_loaded_models(self):
+        # Collect models finished loading in the background
+        for model_key, future in list(self.models_loading.items()):
+            if not future.done():
                 continue
-            # Check model path
-            fp_model = os.path.join(self.gui_fp, entry['path'])
-            if not os.path.exists(fp_model):
-                self._send_log( f"<TrackingModels> Model file does not exist! {fp_model}" )
+            del self.models_loading[model_key]
+            try:
+                self.ort_dict[model_key] = future.result()
+            except Exception as e:
+                self._send_log( f"<TrackingModels> Failed to load {model_key}: {e}" )
+                self.send_model_status(model_key, "failed")
                 continue
-            # Load inference runtime
-            self.ort_dict[model_key] = onnxruntime.InferenceSession(fp_model)
-        # Return
+            self._send_log( "<TrackingModels> Loaded {} ({})".format(model_key, self.models_json[model_key].get('precision', 'fp32')) )
+            self.evict_models()
+            self.gating_reference = None
+            self.send_model_status(model_key, "ready")
         return
 
-    def send_z_worm_focus(self, z_worm_focus):
-        self.command_publisher.send("tracker_behavior set_z_worm_focus {}".format( z_worm_focus ))
+    def evict_models(self):
+        # Unload least recently used models, except the selected ones, until under the memory cap
+        if self.max_loaded_models_mb <= 0:
+            return
+        model_keys_selected = self.get_selected_model_keys()
+        for model_key in list(self.ort_dict.keys()):
+            loaded_mb = sum(ort_runtime.nbytes for ort_runtime in self.ort_dict.values()) / 2**20
+            if loaded_mb <= self.max_loaded_models_mb:
+                break
+            if model_key in model_keys_selected:
+                continue
+            del self.ort_dict[model_key]
+            self.send_model_status(model_key, "unloaded")
+        return
+
+    def send_model_status(self, model_key, status):
+        self.command_publisher.send("hub _tracking_models_set_model_status {} {}".format( model_key, status ))
+        self._send_log( f"<TrackingModels> {model_key} {status}" )
         return
 
-    def send_xy_worm(self, x_worm, y_worm):
-        self.command_publisher.send("tracker_behavior set_xy_worm {} {}".format( x_worm, y_worm ))
+    # Results are tagged with the frame index and capture timestamp of the image they belong to
+    def send_z_worm_focus(self, z_worm_focus, frame_id, timestamp):
+        self.command_publisher.send("tracker_behavior set_z_worm_focus {} {} {}".format( z_worm_focus, frame_id, timestamp ))
+        return
+
+    def send_xy_worm(self, x_worm, y_worm, frame_id, timestamp):
+        self.command_publisher.send("tracker_behavior set_xy_worm {} {} {} {}".format( x_worm, y_worm, frame_id, timestamp ))
         return
 
     def send_boundingbox_worm(self, xmin, xmax, ymin, ymax):
         self.command_publisher.send("tracker_behavior set_boundingbox_worm {} {} {} {}".format( xmin, xmax, ymin, ymax ))
         return
 
-    def detect(self, img):
+    def detect(self, img, frame_id, timestamp):
+        if self.is_frame_unchanged(img):
+            self.send_last_estimates(frame_id, timestamp)
+        else:
+            self.estimate(img, frame_id, timestamp)
+
+        # Reports
+        self.verbose_cycle_counter += 1
+        if self.verbose_cycle_counter%300 == 0:
+            self.report_latencies()
+            # Reset
+            self.verbose_cycle_counter = 0
+
+        # Return
+        return
+
+    def is_frame_unchanged(self, img):
+        if self.motion_gating_threshold <= 0:
+            return False
+        img_small = cv.resize(
+            img, None,
+            fx=1/MOTION_GATING_DOWNSAMPLE, fy=1/MOTION_GATING_DOWNSAMPLE,
+            interpolation=cv.INTER_AREA
+        )
+        self.n_gated_frames += 1
+        # Compared with the last frame that was estimated, so slow changes add up
+        is_unchanged = self.gating_reference is not None and \
+            self.n_skipped_consecutive < self.motion_gating_max_skip and \
+            cv.norm(img_small, self.gating_reference, cv.NORM_L1) / img_small.size < self.motion_gating_threshold
+        if is_unchanged:
+            self.n_skipped_consecutive += 1
+            self.n_gated_skips += 1
+        else:
+            self.gating_reference = img_small
+            self.n_skipped_consecutive = 0
+        return is_unchanged
+
+    def send_last_estimates(self, frame_id, timestamp):
+        # Last estimates, tagged with the current frame
+        if self.selected_focus_mode is not None and self.z_worm_focus is not None:
+            self.send_z_worm_focus( self.z_worm_focus, frame_id, timestamp )
+        if self.selected_tracking_mode is not None and self.x_worm is not None and self.y_worm is not None:
+            self.send_xy_worm( self.x_worm, self.y_worm, frame_id, timestamp )
+        return
+
+    def estimate(self, img, frame_id, timestamp):
+        is_focus_selected = not (self.selected_focus_mode is None or self.selected_focus_mode == "" or self.selected_focus_mode == "none")
+        is_tracking_selected = not (self.selected_tracking_mode is None or self.selected_tracking_mode == "" or self.selected_tracking_mode == "none")
+        # Models still loading are skipped
+        is_focus_ready = f"focus_{self.selected_focus_mode}" in self.ort_dict
+        is_tracking_ready = self.selected_tracking_mode == "xy_threshold" or f"tracking_{self.selected_tracking_mode}" in self.ort_dict
+        is_fused_ready = self.selected_fused_model in self.ort_dict
+        z_worm_focus_future = None
         # Z focus
         # print(f"DEBUG sending z-worm-focus: {z_worm_focus}")
-        if self.selected_focus_mode is None or self.selected_focus_mode == "" or self.selected_focus_mode == "none":
+        if not is_focus_selected:
             self.z_worm_focus = None
+        elif self.selected_fused_model is not None or not is_focus_ready:  # Estimated together with XY, or not loaded yet
+            pass
+        elif self.concurrent_inference and is_tracking_selected and is_tracking_ready:
+            z_worm_focus_future = self.executor.submit(self.detect_z_worm_focus, img)
         else:
-            model_key = f"focus_{self.selected_focus_mode}"
-            z_focus_sign = float(self.models_json[model_key]['sign'])
-            ort_runtime = self.ort_dict[model_key]
-            z_worm_focus = self.z_focus_single_channel_full_image(img, ort_runtime, sign=z_focus_sign)
-            self.send_z_worm_focus( z_worm_focus )
+            z_worm_focus = self.detect_z_worm_focus(img)
+            self.send_z_worm_focus( z_worm_focus, frame_id, timestamp )
             
 
         # XY tracking
-        if self.selected_tracking_mode is None or self.selected_tracking_mode == "" or self.selected_tracking_mode == "none":
+        if not is_tracking_selected:
             self.x_worm, self.y_worm = None, None
+        elif self.selected_fused_model is not None:
+            if is_fused_ready:
+                x_worm, y_worm, z_worm_focus = self.xy_tracking_z_focus_fused_full_image(img, self.selected_fused_model)
+                self.send_z_worm_focus( z_worm_focus, frame_id, timestamp )
+                self.send_xy_worm( x_worm, y_worm, frame_id, timestamp )
         elif self.selected_tracking_mode == "xy_threshold":
             x_worm, y_worm, x_min, x_max, y_min, y_max = self.track_xy_using_threshold(img)
-            self.send_xy_worm( x_worm, y_worm )
+            self.send_xy_worm( x_worm, y_worm, frame_id, timestamp )
             self.send_boundingbox_worm( x_min, x_max, y_min, y_max )
-        else:
+        elif is_tracking_ready:
             model_key = f"tracking_{self.selected_tracking_mode}"
             ort_runtime = self.ort_dict[model_key]
-            x_worm, y_worm = self.xy_tracking_single_channel_full_image(img, ort_runtime)
-            self.send_xy_worm( x_worm, y_worm )
+            if 'crop_size' in self.models_json[model_key]:
+                x_worm, y_worm = self.xy_tracking_single_channel_cropped(img, model_key)
+            else:
+                x_worm, y_worm = self.xy_tracking_single_channel_full_image(img, ort_runtime)
+            self.send_xy_worm( x_worm, y_worm, frame_id, timestamp )
 
-        # Reports
-        self.verbose_cycle_counter += 1
-        if self.verbose_cycle_counter%300 == 0:
-            # Print to CMD
-            print("Average inference XY/focus: {:>5.3f}/{:>5.3f} (ms)".format(
-                1000*self.verbose_total_time_XYtracker/self.verbose_cycle_counter,
-                1000*self.verbose_total_time_autofocus/self.verbose_cycle_counter
-            ))
-            # Reset
-            self.verbose_cycle_counter = 0
-            self.verbose_total_time_XYtracker = 0.0
-            self.verbose_total_time_autofocus = 0.0
+        # Z focus computed on the thread pool, sockets are only used from this thread
+        if z_worm_focus_future is not None:
+            self.send_z_worm_focus( z_worm_focus_future.result(), frame_id, timestamp )
 
         # Return
         return
 
+    def detect_z_worm_focus(self, img):
+        model_key = f"focus_{self.selected_focus_mode}"
+        z_focus_sign = float(self.models_json[model_key]['sign'])
+        ort_runtime = self.ort_dict[model_key]
+        return self.z_focus_single_channel_full_image(img, ort_runtime, sign=z_focus_sign)
+
+    def update_fused_model(self):
+        # Use a `fused_*` entry of `models.json` if it covers the selected tracking and focus modes
+        self.selected_fused_model = None
+        for model_key, entry in self.models_json.items():
+            if not model_key.startswith("fused_") or self.get_model_path(model_key) is None:
+                continue
+            if entry.get('tracking') == self.selected_tracking_mode and entry.get('focus') == self.selected_focus_mode:
+                self.selected_fused_model = model_key
+                break
+        return
+
+    def report_latencies(self):
+        # Inference latency percentiles of the selected models
+        for model_key in self.get_selected_model_keys():
+            if model_key not in self.ort_dict:
+                continue
+            p50, p90, p99 = self.ort_dict[model_key].latency_percentiles((50, 90, 99))
+            msg = "Inference latency {} p50/p90/p99: {:>5.3f}/{:>5.3f}/{:>5.3f} (ms)".format(model_key, p50, p90, p99)
+            print(msg)
+            self._send_log(msg)
+        if self.n_crop_inferences > 0:
+            msg = "Crop inference fallbacks to full frame: {}/{}".format(self.n_crop_fallbacks, self.n_crop_inferences)
+            print(msg)
+            self._send_log(msg)
+            self.n_crop_inferences, self.n_crop_fallbacks = 0, 0
+        if self.n_gated_frames > 0:
+            msg = "Motion gating skipped inference: {}/{} ({:.1f}%)".format(
+                self.n_gated_skips, self.n_gated_frames, 100 * self.n_gated_skips / self.n_gated_frames
+            )
+            print(msg)
+            self._send_log(msg)
+            self.n_gated_frames, self.n_gated_skips = 0, 0
+        return
+
     def start_tracking(self):
         self.trackedworm_center = None
         self.trackedworm_size = None
+        self.otsu = None
+        self.otsu_hist = None
+        self.gating_reference = None
         self.tracking = True
         return
 
@@ -230,12 +493,20 @@ class TrackingModels:
         self.selected_tracking_mode = tracking_mode
         if tracking_mode == "" or tracking_mode.lower() == "none":
             self.selected_tracking_mode = None
+        self.gating_reference = None
+        self.update_fused_model()
+        for model_key in self.get_selected_model_keys():
+            self.request_model(model_key)
         return
 
     def set_focus_mode(self, focus_mode):
         self.selected_focus_mode = focus_mode
         if focus_mode == "" or focus_mode.lower() == "none":
             self.selected_focus_mode = None
+        self.gating_reference = None
+        self.update_fused_model()
+        for model_key in self.get_selected_model_keys():
+            self.request_model(model_key)
         print(f"DEBUG focus mode set! {self.selected_focus_mode}")
         return
 
@@ -243,101 +514,129 @@ class TrackingModels:
         # Image size for center finding
         ny, nx = img.shape[:2]
         # Threshold for distinguishing foreground and background
-        otsu = filters.threshold_otsu(img)
+        otsu = self.update_otsu(img)
         threshold = 1.2 * otsu if otsu > 50 else 110
-        # Mask foreground objects
-        img_mask_objects = img_to_object_mask_threshold(img, threshold=threshold)
-        _ys, _xs = np.where(~img_mask_objects)
-        _, labels, _, centroids = cv.connectedComponentsWithStats(
-            img_mask_objects.astype(np.uint8)
-        )
-        # Find foreground candidates larger than a specific size
-        centroids = centroids[:,::-1]  # swap i-j indices to match with `numpy.where` conventions
-        labels_background = set(labels[_ys, _xs])
-        label_values, label_counts = np.unique(labels.flatten(), return_counts=True)
-        candidates_info = []
-        for label_value, label_count, centroid in zip(label_values, label_counts, centroids):
-            if label_value in labels_background:
-                continue
-            if label_count >= XY_TRACKING_SMALLEST_TRACKING_OBJECT:
-                candidates_info.append([
-                    labels == label_value,
-                    centroid
-                ])
+        # Foreground candidates larger than a specific size, from a single labeling pass
+        stats, centroids = img_to_objects_threshold(img, threshold=threshold)
+        sizes = stats[:, cv.CC_STAT_AREA]
         # Find closest candidate to center if the size is whithin a range of previous frame size
-        found_trackedworm = False
-        img_mask_trackedworm = None
-        _d_center_closest = None
-        if len(candidates_info) > 0:
-            _center_previous = self.trackedworm_center \
-                if self.tracking and self.trackedworm_center is not None else np.array([ny/2, nx/2])
-            _size_lower = self.trackedworm_size*(1.0-XY_TRACKING_SIZE_FLUCTUATIONS) if self.tracking and self.trackedworm_size is not None else 0.0
-            _size_upper = self.trackedworm_size*(1.0+XY_TRACKING_SIZE_FLUCTUATIONS) if self.tracking and self.trackedworm_size is not None else 0.0
-            for _, (mask, center) in enumerate(candidates_info):
-                _size = mask.sum()
-                _d_center = np.max(np.abs(center - _center_previous))
-                is_close_enough = _d_center <= XY_TRACKING_CENTER_SPEED
-                if _size_upper != 0.0:
-                    is_close_enough = is_close_enough and (_size_lower <= _size <= _size_upper)
-                if is_close_enough:
-                    found_trackedworm = True
-                    if _d_center_closest is None or _d_center < _d_center_closest:
-                        _d_center_closest = _d_center
-                        img_mask_trackedworm = mask
-                        if self.tracking:
-                                self.trackedworm_size = _size
-                                self.trackedworm_center = center.copy()
+        _center_previous = self.trackedworm_center \
+            if self.tracking and self.trackedworm_center is not None else np.array([ny/2, nx/2])
+        _size_lower = self.trackedworm_size*(1.0-XY_TRACKING_SIZE_FLUCTUATIONS) if self.tracking and self.trackedworm_size is not None else 0.0
+        _size_upper = self.trackedworm_size*(1.0+XY_TRACKING_SIZE_FLUCTUATIONS) if self.tracking and self.trackedworm_size is not None else 0.0
+        _d_centers = np.max(np.abs(centroids - _center_previous), axis=1)
+        is_close_enough = _d_centers <= XY_TRACKING_CENTER_SPEED
+        if _size_upper != 0.0:
+            is_close_enough &= (_size_lower <= sizes) & (sizes <= _size_upper)
         # Send coords and bbox if worm was found
         y_min, y_max = None, None
         x_min, x_max = None, None
         self.x_worm, self.y_worm = None, None
-        if found_trackedworm:
-            img_mask_trackedworm_blurred = cv.blur(
-                img_mask_trackedworm.astype(np.float32),
-                (XY_TRACKING_MASK_KERNEL_BLUR, XY_TRACKING_MASK_KERNEL_BLUR)
-            ) > 1e-4
-            ys, xs = np.where(img_mask_trackedworm_blurred)
-            y_min, y_max = minmax(ys)
-            x_min, x_max = minmax(xs)
+        if np.any(is_close_enough):
+            i_trackedworm = np.flatnonzero(is_close_enough)[np.argmin(_d_centers[is_close_enough])]
+            if self.tracking:
+                self.trackedworm_size = sizes[i_trackedworm]
+                self.trackedworm_center = centroids[i_trackedworm].copy()
+            # Bounding box of the worm, grown by the mask blur kernel
+            x, y, w, h = stats[i_trackedworm, :4]
+            _margin = XY_TRACKING_MASK_KERNEL_BLUR//2
+            x_min, x_max = int(max(x - _margin, 0)), int(min(x + w - 1 + _margin, nx - 1))
+            y_min, y_max = int(max(y - _margin, 0)), int(min(y + h - 1 + _margin, ny - 1))
             self.x_worm = (x_min + x_max)//2
             self.y_worm = (y_min + y_max)//2
             self.is_xy_worm_set = True
         # Return the original image in case no worm detected
         return self.x_worm, self.y_worm, x_min, x_max, y_min, y_max
 
+    def update_otsu(self, img):
+        # Intensity histogram, normalized to fractions of pixels
+        hist = cv.calcHist([img], [0], None, [256], [0, 256]).ravel()
+        hist /= hist.sum()
+        self.otsu_counter += 1
+        is_drifted = self.otsu_hist is not None and \
+            0.5 * np.abs(hist - self.otsu_hist).sum() > XY_TRACKING_OTSU_HISTOGRAM_DRIFT
+        if self.otsu is None or is_drifted or self.otsu_counter >= self.otsu_every_n_frames:
+            otsu = threshold_otsu_histogram(hist)
+            if self.otsu is not None:
+                otsu = self.otsu_smoothing * self.otsu + (1.0 - self.otsu_smoothing) * otsu
+            self.otsu = otsu
+            self.otsu_hist = hist
+            self.otsu_counter = 0
+        return self.otsu
+
     def xy_tracking_single_channel_full_image(self, img, ort_runtime):
-        batch_1_512_512 = {
-            'input': img[np.newaxis, np.newaxis, :, :].astype(np.float32),
-        }
         # The network is trained to output (x, y)
-        _start = time.time()
-        ort_outs = ort_runtime.run( None, batch_1_512_512 )
-        self.x_worm, self.y_worm = ort_outs[0][0].astype(np.int64)
-        _duration = time.time() - _start
-        self.verbose_total_time_XYtracker += _duration
+        ort_out = ort_runtime.run( img )
+        self.x_worm, self.y_worm = ort_out[0].astype(np.int64)
+        # Return
+        return self.x_worm, self.y_worm
+
+    def xy_tracking_single_channel_cropped(self, img, model_key):
+        # Crop around the last worm position, the stage keeps it close to the center
+        entry = self.models_json[model_key]
+        ort_runtime = self.ort_dict[model_key]
+        ny, nx = img.shape[:2]
+        ny_crop, nx_crop = ort_runtime.image_shape
+        has_full_frame = entry.get('full_frame') in self.ort_dict
+        x_worm, y_worm = None, None
+        x_center, y_center = self.x_worm, self.y_worm
+        if (x_center is None or y_center is None) and not has_full_frame:
+            # No full-frame model to find the worm, the stage keeps it close to the center
+            x_center, y_center = nx//2, ny//2
+        if x_center is not None and y_center is not None:
+            self.n_crop_inferences += 1
+            x_offset = int(np.clip(int(x_center) - nx_crop//2, 0, nx - nx_crop))
+            y_offset = int(np.clip(int(y_center) - ny_crop//2, 0, ny - ny_crop))
+            ort_out = ort_runtime.run( img[y_offset:y_offset+ny_crop, x_offset:x_offset+nx_crop] )
+            x_crop, y_crop = ort_out[0].astype(np.int64)
+            # Close to an edge of the crop that is not an edge of the image -> worm may be partially outside
+            is_inside = (x_crop >= XY_CROP_EDGE_MARGIN or x_offset == 0) and \
+                (x_crop < nx_crop - XY_CROP_EDGE_MARGIN or x_offset == nx - nx_crop) and \
+                (y_crop >= XY_CROP_EDGE_MARGIN or y_offset == 0) and \
+                (y_crop < ny_crop - XY_CROP_EDGE_MARGIN or y_offset == ny - ny_crop)
+            is_confident = True
+            if 'output_confidence' in entry:
+                confidence = float(ort_runtime.outputs[entry['output_confidence']].ravel()[0])
+                is_confident = confidence >= float(entry.get('min_confidence', 0.5))
+            if is_inside and is_confident:
+                x_worm, y_worm = x_crop + x_offset, y_crop + y_offset
+            else:
+                self.n_crop_fallbacks += 1
+        # Worm lost or not found in the crop -> full frame
+        if x_worm is None and has_full_frame:
+            return self.xy_tracking_single_channel_full_image(img, self.ort_dict[entry['full_frame']])
+        self.x_worm, self.y_worm = x_worm, y_worm
         # Return
         return self.x_worm, self.y_worm
 
+    def xy_tracking_z_focus_fused_full_image(self, img, model_key):
+        # One network with a shared backbone outputs both (x, y) and z-focus
+        entry = self.models_json[model_key]
+        ort_runtime = self.ort_dict[model_key]
+        ort_runtime.run( img )
+        self.x_worm, self.y_worm = ort_runtime.outputs[entry['output_xy']][0].astype(np.int64)
+        if is_close_to_arena_boundary(img):
+            self.z_worm_focus = 0.0
+        else:
+            self.z_worm_focus = np.float32(ort_runtime.outputs[entry['output_focus']][0][0]) * float(entry['sign'])
+        return self.x_worm, self.y_worm, self.z_worm_focus
+
     def z_focus_single_channel_full_image(self, img, ort_runtime, sign):
         # Close to arena boundary -> don't change focus
-        if np.mean( img < 50 ) >= 0.05:  # Too close to the arena boundaries
+        if is_close_to_arena_boundary(img):  # Too close to the arena boundaries
             self.z_worm_focus = 0.0
             return self.z_worm_focus
         # Network predicts z-focus
-        batch_1_512_512 = {
-            'input': img[np.newaxis, np.newaxis, :, :].astype(np.float32),
-        }
-        _start = time.time()
-        ort_outs = ort_runtime.run( None, batch_1_512_512 )
-        self.z_worm_focus = np.float32(ort_outs[0][0][0]) * sign
-        _duration = time.time() - _start
-        self.verbose_total_time_autofocus += _duration
+        ort_out = ort_runtime.run( img )
+        self.z_worm_focus = np.float32(ort_out[0][0]) * sign
         return self.z_worm_focus
 
     # Running loop
     def _run(self):
         while self.running:
-            sockets = dict(self.poller.poll())
+            # Wake up periodically while models are loading in the background
+            sockets = dict(self.poller.poll(timeout=100 if self.models_loading else None))
+            self.check_loaded_models()
             # Listen for commands
             if self.command_subscriber.socket in sockets:
                 self.command_subscriber.handle()
@@ -346,8 +645,8 @@ class TrackingModels:
                 msg = self.data_subscriber.get_last()
                 if msg is None:  # no new images received -> queue is empty
                     continue
-                self.data = msg[1]  # only the image part
-                self.detect( img = self.data )
+                frame_id, timestamp, self.data = msg
+                self.detect( img = self.data, frame_id = frame_id, timestamp = timestamp )
         # Return
         return
 
@@ -355,6 +654,8 @@ class TrackingModels:
         self._send_log("shutdown command received")
         self.tracking = False
         self.running = False
+        self.executor.shutdown(wait=False)
+        self.loader.shutdown(wait=False)
         return
 
     def _send_log(self, msg_obj):
@@ -377,6 +678,17 @@ def main():
         data_in=parse_host_and_port(arguments["--data_in"]),
         gui_fp=arguments["--gui_fp"],
         name=arguments["--name"],
+        intra_op_threads=int(arguments["--intra_op_threads"]),
+        inter_op_threads=int(arguments["--inter_op_threads"]),
+        graph_optimization=arguments["--graph_optimization"],
+        execution_mode=arguments["--execution_mode"],
+        optimized_model_dir=arguments["--optimized_model_dir"] or None,
+        concurrent_inference=arguments["--concurrent_inference"],
+        max_loaded_models_mb=float(arguments["--max_loaded_models_mb"]),
+        otsu_every_n_frames=int(arguments["--otsu_every_n_frames"]),
+        otsu_smoothing=float(arguments["--otsu_smoothing"]),
+        motion_gating_threshold=float(arguments["--motion_gating_threshold"]),
+        motion_gating_max_skip=int(arguments["--motion_gating_max_skip"]),
     )
     device._run()
 
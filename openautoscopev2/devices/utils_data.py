@@ -9,139 +9,202 @@ from tqdm import tqdm
 
 import numpy as np
 from h5py import File as h5File
+import hdf5plugin  # compression filters of recordings, e.g. Blosc
 
-import gc, sys, os
+from openautoscopev2.devices.frame_metadata import METADATA_FIELDS
+from openautoscopev2.writers.log_writer import load_log, LOG_EXTENSION, LOG_RECORD_DTYPE
+
+import os, re
 from os.path import join
-import subprocess
+from concurrent.futures import ProcessPoolExecutor
 
-from functools import lru_cache
+from time import monotonic, sleep
 
 
 
 # Methods
 ############################################################################################################
-## CMD
-def run_cmd(cmd):
-    if isinstance(cmd, str):
-        resp = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    elif isinstance(cmd, list):
-        resp = subprocess.run(
-            cmd,
-            check=True,
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE
-        )
-    else:
-        raise NotImplementedError()
-    stdout, stderr = resp.stdout.decode('utf-8'), resp.stderr.decode('utf-8')
-    return resp, stdout, stderr
-## Get line count for log-files
-@lru_cache
-def get_file_linecount(fp):
-    # Based on OS
-    if sys.platform.lower() == 'linux' or sys.platform.lower() == 'darwin':  # Linux or OSX
-        _, stdout, _ = run_cmd(["wc", "-l", fp])
-        n, _ = stdout.split(maxsplit=1)
-    elif sys.platform.lower().startswith('win'):  # Windows
-        _, stdout, _ = run_cmd(f'find /c /v "" {fp}')
-        n = stdout.strip().split()[-1]
-    else:
-        raise NotImplementedError()
-    return int(n)
 ## Load and process log-files based on their writing conventions
 LOG_STATE_NAMES = [ 'x', 'y', 'z', 'sx', 'sy', 'sz', 'ledb', 'ledg', 'ledo', 'wormx', 'wormy' ]
-def load_process_log_files(fp_folder, time_lower=None, time_upper=None):
-    # Parameters
-    event_to_idx = {
-        'x': 0, 'y': 1, 'z': 2,
-        'sx': 3, 'sy': 4, 'sz': 5,
-        'ledb': 6, 'ledg': 7, 'ledo': 8,
-        'wormx': 9, 'wormy': 10,
-    }
-    # Process Log Files
-    fp_logs = sorted(glob(f"{fp_folder}/*_log.txt"))
-    state = np.zeros(len(event_to_idx), dtype=np.float32)
-    ## Allocate Numpy Arrays
-    n_logs_total = 0
-    for fp_log in fp_logs:
-        print(f"Getting linecounts for: {fp_log}")
-        n_logs_total += get_file_linecount(fp_log)
-    ## Load States
-    print(f"Starting with Total Log records: {n_logs_total}")
-    states = np.zeros((n_logs_total, len(event_to_idx)), dtype=np.float32)
-    times_states = np.zeros(n_logs_total, dtype=np.float64)
-    state_idx = 0
-    for fp_log in fp_logs:
-        print(f"Getting linecounts for: {fp_log}")
-        linecount = get_file_linecount(fp_log)
-        with open(fp_log, 'r') as in_file:
-            for line in tqdm(in_file.readlines(), total=linecount, desc=f"loading --> {fp_log}"):
-                # Preprocess
-                line = line.strip()
-                if len(line) == 0:
-                    continue
-                # Extract
-                time, event = line.split(maxsplit=1)
-                time = float(time)
-                # Parse
-                ## Some events have two timestamps in the beginning! :facepalm:
-                if event[0].isdigit():
-                    event = event.split(maxsplit=1)[1]
-                ## Parse Event
-                if '{"position":' in event:  # sample event: {"position": [26848, -4874, -21668]}
-                    x,y,z = event[14:-2].split(',')
-                    update = {
-                        'x': int(x),
-                        'y': int(y),
-                        'z': int(z)
-                    }
-                elif event.startswith("<TEENSY COMMANDS> executing: sx"):
-                    update = {
-                        'sx': int(event[31:])
-                    }
-                elif event.startswith("<TEENSY COMMANDS> executing: sy"):
-                    update = {
-                        'sy': int(event[31:])
-                    }
-                elif event.startswith("<TEENSY COMMANDS> executing: sz"):
-                    update = {
-                        'sz': int(event[31:])
-                    }
-                elif event.startswith('<CLIENT WITH GUI> command sent: DO _teensy_commands_set_toggle_led'):
-                    update = {
-                        'ledi': 1 if event[-1] == 'n' else 0
-                    }
-                elif event.startswith('<CLIENT WITH GUI> command sent: DO _teensy_commands_set_led'):
-                    led_name, power = event[60:].split()
-                    update = {
-                        f"led{led_name}": int(power),
-                    }
-                elif '<TRACKER-WORM-COORDS>' in event:
-                    parsed = event[event.rfind('(')+1:-1].split(',')
-                    wormx, wormy = float(parsed[0]), float(parsed[1])
-                    update = {
-                        'wormx': wormx,
-                        'wormy': wormy,
-                    }
-                else:
-                    update = dict()
-                ## Update State
-                for key, value in update.items():
-                    idx = event_to_idx[key]
-                    state[idx] = value
-                # Store State
-                ## Skip bounds
-                if time_lower is not None and time < time_lower:
+LOG_BLOCK_SIZE = 32*1024*1024  # Bytes parsed at a time
+LOG_RANGE_SIZE = 64*1024*1024  # Bytes of a log file parsed by each worker
+LOG_TIME_WIDTH = 32  # Longest timestamp at the start of lines
+## Events of log lines: state names, a pattern capturing their values where 'n' values are skipped,
+## and whether the event follows the timestamp. Some events have two timestamps in the beginning! :facepalm:
+_LOG_PREFIX = re.compile(rb'[ \t]*\S+[ \t]+(?:\d\S*[ \t]+)?')
+_LOG_NUMBER = rb'[ \t]*([^\s,\]]+)[ \t\r]*'
+_LOG_LINE_END = rb'(?=\n|\Z)'
+LOG_EVENT_PATTERNS = [
+    # sample event: {"position": [26848, -4874, -21668]}
+    ( ('x', 'y', 'z'), rb'\{"position": \[' + _LOG_NUMBER + b',' + _LOG_NUMBER + b',' + _LOG_NUMBER + rb'\]\}', True ),
+    # sample events: <TEENSY COMMANDS> executing: sx12, <TEENSY COMMANDS> executing: sv12 -4 n
+    ( ('sx', 'sy', 'sz', 'sx', 'sy', 'sz'), rb'<TEENSY COMMANDS> executing: s(?:' +
+        rb'x' + _LOG_NUMBER + _LOG_LINE_END + rb'|y' + _LOG_NUMBER + _LOG_LINE_END + rb'|z' + _LOG_NUMBER + _LOG_LINE_END +
+        rb'|v(\S+)[ \t]+(\S+)[ \t]+(\S+))', True ),
+    ( ('ledb', 'ledg', 'ledo'), rb'<CLIENT WITH GUI> command sent: DO _teensy_commands_set_led (?:b[ \t]+(\S+)|g[ \t]+(\S+)|o[ \t]+(\S+))', True ),
+    # sample event: <TRACKER-WORM-COORDS> frame 12 x-y coords: (250,261)
+    ( ('wormx', 'wormy'), rb'<TRACKER-WORM-COORDS>[^\n]*\(([^(),\n]*),([^(),\n]*)\)[ \t\r]*' + _LOG_LINE_END, False ),
+]
+LOG_EVENT_PATTERNS = [
+    ( [ LOG_STATE_NAMES.index(name) for name in names ], re.compile(pattern), follows_time )
+    for names, pattern, follows_time in LOG_EVENT_PATTERNS
+]
+## Parse log lines in a block of bytes, returns times and state updates of each line, NaN where unchanged
+def parse_log_block(block):
+    # Lines start with their timestamp, empty lines are skipped
+    buffer = np.frombuffer(block + bytes(LOG_TIME_WIDTH), dtype=np.uint8)
+    line_starts = np.concatenate([ [0], np.flatnonzero(buffer[:len(block)] == ord('\n')) + 1 ])
+    heads = np.lib.stride_tricks.sliding_window_view(buffer, LOG_TIME_WIDTH)[line_starts]
+    is_space = np.isin(heads, np.frombuffer(b' \t\r\n\x00', dtype=np.uint8))
+    time_lengths = np.where(is_space.any(axis=1), is_space.argmax(axis=1), LOG_TIME_WIDTH)
+    heads[np.arange(LOG_TIME_WIDTH) >= time_lengths[:, None]] = 0
+    is_line = time_lengths > 0
+    times = heads[is_line].view(f"S{LOG_TIME_WIDTH}").ravel().astype(np.float64)
+    rows_of_lines = np.cumsum(is_line) - 1
+    # Events, found by their markers
+    updates = np.full((len(times), len(LOG_STATE_NAMES)), np.nan, dtype=np.float32)
+    for idxs, pattern, follows_time in LOG_EVENT_PATTERNS:
+        matches = list(pattern.finditer(block))
+        if len(matches) == 0:
+            continue
+        positions = np.fromiter(( match.start() for match in matches ), dtype=np.int64, count=len(matches))
+        values = [ match.groups(b'') for match in matches ]
+        lines = np.searchsorted(line_starts, positions, side='right') - 1
+        if follows_time:
+            # Usually right after the timestamp and a space, otherwise checked with the pattern
+            is_event = positions - line_starts[lines] == time_lengths[lines] + 1
+            for i in np.flatnonzero(~is_event):
+                is_event[i] = _LOG_PREFIX.fullmatch(block, line_starts[lines[i]], positions[i]) is not None
+            if not is_event.all():
+                lines, values = lines[is_event], [ v for v, e in zip(values, is_event) if e ]
+                if len(lines) == 0:
                     continue
-                if time_upper is not None and time > time_upper:
-                    continue
-                ## Store
-                states[state_idx] = state.copy()
-                times_states[state_idx] = time
-                state_idx += 1
-            # GC
-            _ = gc.collect()
-    _ = gc.collect()
-    return states[:state_idx], times_states[:state_idx]
+        rows = rows_of_lines[lines]
+        values = np.array(values)
+        for i, idx in enumerate(idxs):
+            is_set = (values[:, i] != b'n') & (values[:, i] != b'')
+            updates[rows[is_set], idx] = values[is_set, i].astype(np.float64)
+    return times, updates
+## Parse bytes `start` to `end` of a log file, both at the start of a line, in blocks
+def parse_log_range(fp_log, start, end):
+    times, updates = [], []
+    with open(fp_log, 'rb') as in_file:
+        in_file.seek(start)
+        rest = b''
+        while start < end:
+            block = rest + in_file.read(min(LOG_BLOCK_SIZE, end - start))
+            start += LOG_BLOCK_SIZE
+            # Lines split by the block boundary are parsed with the next block
+            i_last = block.rfind(b'\n') + 1 if start < end else len(block)
+            block, rest = block[:i_last], block[i_last:]
+            _times, _updates = parse_log_block(block)
+            times.append(_times)
+            updates.append(_updates)
+    if len(times) == 0:
+        return np.zeros(0, dtype=np.float64), np.zeros((0, len(LOG_STATE_NAMES)), dtype=np.float32)
+    return np.concatenate(times), np.concatenate(updates)
+## Split a log file into ranges of about `range_size` bytes at line starts
+def get_log_ranges(fp_log, range_size=LOG_RANGE_SIZE):
+    size = os.path.getsize(fp_log)
+    starts = [0]
+    with open(fp_log, 'rb') as in_file:
+        while starts[-1] + range_size < size:
+            in_file.seek(starts[-1] + range_size)
+            in_file.readline()
+            if in_file.tell() >= size:
+                break
+            starts.append(in_file.tell())
+    return list(zip(starts, starts[1:] + [size]))
+## Cache of the parsed log next to it, valid while the log file has the same size and modification time
+LOG_CACHE_VERSION = 1  # Increase when parsing changes
+def get_log_cache_filename(fp_log):
+    return os.path.splitext(fp_log)[0] + "_states.npz"
+def load_log_cache(fp_log):
+    fp_cache = get_log_cache_filename(fp_log)
+    if not os.path.exists(fp_cache):
+        return None
+    stat = os.stat(fp_log)
+    try:
+        with np.load(fp_cache) as cache:
+            if int(cache['version']) != LOG_CACHE_VERSION or int(cache['size']) != stat.st_size or float(cache['mtime']) != stat.st_mtime:
+                return None
+            return cache['times'], cache['updates']
+    except Exception as e:
+        print(f"Error in loading cache of: {fp_log}\n{e}")
+        return None
+def save_log_cache(fp_log, times, updates):
+    stat = os.stat(fp_log)
+    try:
+        np.savez(get_log_cache_filename(fp_log), version=LOG_CACHE_VERSION, size=stat.st_size, mtime=stat.st_mtime, times=times, updates=updates)
+    except OSError as e:
+        print(f"Error in saving cache of: {fp_log}\n{e}")
+## Forward fill state updates, states start from zeros
+def fill_log_states(updates):
+    states = np.zeros_like(updates)
+    lines = np.arange(len(updates))
+    for idx in range(updates.shape[1]):
+        is_set = ~np.isnan(updates[:, idx])
+        # Last line setting the state, -1 before the first one
+        last = np.maximum.accumulate(np.where(is_set, lines, -1))
+        has_value = last >= 0
+        states[has_value, idx] = updates[last[has_value], idx]
+    return states
+def load_process_log_files(fp_folder, time_lower=None, time_upper=None, n_workers=None, use_cache=True):
+    # Parse log files, or load them from their caches
+    fp_logs = sorted(glob(f"{fp_folder}/*_log.txt"))
+    parsed = dict()
+    if use_cache:
+        for fp_log in fp_logs:
+            cache = load_log_cache(fp_log)
+            if cache is not None:
+                print(f"Loaded cache of: {fp_log}")
+                parsed[fp_log] = cache
+    jobs = [
+        (fp_log, start, end)
+        for fp_log in fp_logs if fp_log not in parsed
+        for start, end in get_log_ranges(fp_log)
+    ]
+    if len(jobs) > 0:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(tqdm(executor.map(parse_log_range, *zip(*jobs)), total=len(jobs), desc="parsing log files"))
+        for fp_log in fp_logs:
+            if fp_log in parsed:
+                continue
+            ranges = [ result for job, result in zip(jobs, results) if job[0] == fp_log ]
+            parsed[fp_log] = ( np.concatenate([ r[0] for r in ranges ]), np.concatenate([ r[1] for r in ranges ]) )
+            if use_cache:
+                save_log_cache(fp_log, *parsed[fp_log])
+    if len(fp_logs) == 0:
+        return np.zeros((0, len(LOG_STATE_NAMES)), dtype=np.float32), np.zeros(0, dtype=np.float64)
+    # States of all lines, carried over from previous files
+    times_states = np.concatenate([ parsed[fp_log][0] for fp_log in fp_logs ])
+    states = fill_log_states(np.concatenate([ parsed[fp_log][1] for fp_log in fp_logs ]))
+    ## Skip bounds
+    in_bounds = np.ones(len(times_states), dtype=bool)
+    if time_lower is not None:
+        in_bounds &= times_states >= time_lower
+    if time_upper is not None:
+        in_bounds &= times_states <= time_upper
+    return states[in_bounds], times_states[in_bounds]
+## Load structured log records saved by the logger, for all `*_log.bin` files
+## Sources, events and message lines of all files are combined, `events[records['event']]` are the event names
+def load_log_records(fp_folder):
+    records_all, messages, sources, events = [], [], [], []
+    for fp_log in sorted(glob(f"{fp_folder}/*_log{LOG_EXTENSION}")):
+        records, sidecar, messages_file = load_log(fp_log)
+        records = records.copy()
+        for field, names_all in ( ('source', sources), ('event', events) ):
+            names = sidecar[field + 's']
+            names_all.extend( n for n in names if n not in names_all )
+            mapping = np.array([ names_all.index(n) for n in names ], dtype=np.uint16)
+            if len(mapping) > 0:
+                records[field] = mapping[records[field]]
+        is_message = records['event'] == events.index('message')
+        records['values'][is_message, 0] += len(messages)
+        messages.extend(messages_file)
+        records_all.append(records)
+    records = np.concatenate(records_all) if len(records_all) > 0 else np.zeros(0, dtype=LOG_RECORD_DTYPE)
+    return records, sources, events, messages
 ############################################################################################################
 # Load all H5 files and return them as a list
 def load_files_data_times(fp_folder):
@@ -158,6 +221,50 @@ def load_files_data_times(fp_folder):
         file['times'] for file in files
     ]
     return files, datas, times
+# Load per-frame metadata saved by the writer next to `times`, e.g. `stage_x`, for all H5 files
+def load_files_metadata(fp_folder, fields=METADATA_FIELDS):
+    metadata = { field: [] for field in fields }
+    for fp in sorted(glob(f"{fp_folder}/*.h5")):
+        with h5File(fp, 'r') as file:
+            n = len(file['times'])
+            for field in fields:
+                # Files recorded without metadata
+                metadata[field].append( file[field][:] if field in file else np.full(n, np.nan, dtype=np.float32) )
+    return {
+        field: np.concatenate(values) if len(values) > 0 else np.zeros(0, dtype=np.float32)
+        for field, values in metadata.items()
+    }
+# Load crop offsets and context images of files recorded with `oas_writer --crop_size=N`, for all H5 files
+def load_files_crops(fp_folder):
+    offsets, context, context_frame_ids = [], [], []
+    frame_shape = None
+    for fp in sorted(glob(f"{fp_folder}/*.h5")):
+        with h5File(fp, 'r') as file:
+            frame_shape = tuple( int(n) for n in file.attrs['frame_shape'] )
+            offsets.append( file['offsets'][:] )
+            if 'context' in file:
+                context.append( file['context'][:] )
+                context_frame_ids.append( file['context_frame_ids'][:] )
+    return {
+        'frame_shape': frame_shape,
+        'offsets': np.concatenate(offsets) if len(offsets) > 0 else np.zeros((0, 2), dtype=np.int32),
+        'context': np.concatenate(context) if len(context) > 0 else None,
+        'context_frame_ids': np.concatenate(context_frame_ids) if len(context_frame_ids) > 0 else np.zeros(0, dtype=np.int64),
+    }
+# Coordinates in crops to coordinates in whole frames, `offsets` has the (y, x) offset of the crop of each coordinate
+def crop_to_frame_coords(ys, xs, offsets):
+    offsets = np.asarray(offsets)
+    return np.asarray(ys) + offsets[..., 0], np.asarray(xs) + offsets[..., 1]
+# Coordinates in whole frames to coordinates in crops
+def frame_to_crop_coords(ys, xs, offsets):
+    offsets = np.asarray(offsets)
+    return np.asarray(ys) - offsets[..., 0], np.asarray(xs) - offsets[..., 1]
+# Paste a crop into an empty whole frame, e.g. to overlay it on the upsampled context image
+def crop_to_frame(crop, offset, frame_shape, fill_value=0):
+    frame = np.full(frame_shape, fill_value, dtype=crop.dtype)
+    y, x = offset
+    frame[..., y:y+crop.shape[-2], x:x+crop.shape[-1]] = crop
+    return frame
 # Combine all file connections to a single object to ease of manipulations
 class SerializeDatas:
     # Constructur
@@ -180,6 +287,50 @@ class SerializeDatas:
             t -= self.ns[idx]
             idx += 1
         return self.data_list[idx][t]
+## SWMRReader
+# Read frames of a file while `oas_writer --swmr=True` is writing it
+class SWMRReader:
+    # Constructor
+    def __init__(self, fp, fields=METADATA_FIELDS):
+        self.file = h5File(fp, 'r', libver='latest', swmr=True)
+        self.data = self.file['data']
+        self.times = self.file['times']
+        self.fields = [ field for field in fields if field in self.file ]
+        self.n_read = 0
+        return
+    # Number of frames written so far
+    def refresh(self):
+        datasets = [ self.data, self.times ] + [ self.file[field] for field in self.fields ]
+        for dataset in datasets:
+            dataset.refresh()
+        n = min( len(dataset) for dataset in datasets )
+        # Frames of the last write may be flushed before their times
+        times = self.times[self.n_read:n]
+        while n > self.n_read and times[n-self.n_read-1] == 0.0:
+            n -= 1
+        return n
+    def __len__(self):
+        return self.refresh()
+    # Frames, times and metadata written since the last call
+    def read_new(self):
+        n = self.refresh()
+        new = slice(self.n_read, n)
+        self.n_read = n
+        return self.data[new], self.times[new], { field: self.file[field][new] for field in self.fields }
+    # Yield new frames until none arrive for `timeout` seconds
+    def follow(self, poll_interval=0.5, timeout=10.0):
+        time_last = monotonic()
+        while monotonic() - time_last < timeout:
+            frames, times, metadata = self.read_new()
+            if len(frames) > 0:
+                time_last = monotonic()
+                yield frames, times, metadata
+            else:
+                sleep(poll_interval)
+        return
+    def close(self):
+        self.file.close()
+        return
 ## ImgToProcess
 class ImgToProcess:
     def __init__(self, data, fn_process, rescale=False):
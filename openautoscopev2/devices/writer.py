@@ -23,25 +23,193 @@ Options:
                                             [default: data]
     --name=NAME                         Device name.
                                             [default: writer]
+    --buffer_size=N                     Number of frames buffered in memory before writing them to the file.
+                                            [default: 16]
+    --chunk_frames=N                    Number of frames in each HDF5 chunk.
+                                            [default: 1]
+    --queue_depth=N                     Number of received frames waiting to be written.
+                                            [default: 64]
+    --queue_policy=POLICY               What to do when the queue is full: block, drop_oldest or drop_newest.
+                                            [default: block]
+    --lossless=BOOL                     Write every received frame in order, ignoring `write_every_n_frames` and the queue policy.
+                                            [default: False]
+    --receive_hwm=N                     Number of frames held by ZMQ before dropping them, in lossless mode. Only
+                                        this connection, start the camera and tracker with `--hwm` for the ones before it.
+                                            [default: 10000]
+    --compression=CODEC                 Compression of frames: none, lzf, gzip, blosc_lz4, blosc_zstd, blosc_lz4_bitshuffle,
+                                        blosc_zstd_bitshuffle, bitshuffle_lz4, bitshuffle_zstd, lz4 or zstd.
+                                            [default: lzf]
+    --compression_level=N               Compression level, empty for the default level of the codec.
+                                            [default: ]
+    --compression_threads=N             Number of threads used by Blosc codecs.
+                                            [default: 1]
+    --compression_workers=N             Number of processes compressing chunks in parallel, 0 compresses on the writer thread.
+                                            [default: 0]
+    --backend=BACKEND                   File format: hdf5, or raw memory-mapped segments converted to HDF5 later
+                                        with `oas_convert_segments`.
+                                            [default: hdf5]
+    --max_frames_per_file=N             Number of received frames before starting a new file.
+                                            [default: 3600]
+    --max_file_size_mb=N                Size of written frames before starting a new file, before compression. 0 disables it.
+                                            [default: 0]
+    --max_file_duration=SECONDS         Duration of recording before starting a new file. 0 disables it.
+                                            [default: 0]
+    --swmr=BOOL                         Write HDF5 files in single-writer/multiple-reader mode, so they can be read while recording.
+                                            [default: False]
+    --swmr_flush_interval=SECONDS       Interval between flushes of SWMR files, i.e. how far behind readers are.
+                                            [default: 1]
+    --metadata=BOOL                     Save stage, LED, tracking and camera values with each frame.
+                                            [default: True]
+    --camera=NAME                       Camera whose exposure and gain are saved with each frame.
+                                            [default: ]
+    --crop_size=N                       Save N*N crops of frames centred on the tracked worm instead of whole frames,
+                                        0 saves whole frames. Needs `--metadata=True` and the hdf5 backend.
+                                            [default: 0]
+    --context_every_n_frames=N          Save a downsampled whole frame every N frames with crops, 0 disables it.
+                                            [default: 0]
+    --context_binning=N                 Downsampling factor of saved whole frames.
+                                            [default: 8]
+    --monitor_interval=SECONDS          Interval of measuring write throughput, latency and free space.
+                                            [default: 5]
+    --warn_free_space_gb=GB             Warn when free space of the directory is below this.
+                                            [default: 20]
+    --min_free_space_gb=GB              Stop recording when free space of the directory is below this.
+                                            [default: 2]
+    --max_append_latency_ms=MS          Warn when writing a frame takes longer than this on average.
+                                            [default: 20]
+    --backpressure=BOOL                 Raise `write_every_n_frames` while writing falls behind, outside LED periods,
+                                        and lower it back when writing catches up.
+                                            [default: False]
+    --max_write_every_n_frames=N        Largest `write_every_n_frames` set by backpressure.
+                                            [default: 80]
 """
 
 import os
+import time
+import json
+import shutil
+import threading
 from os.path import join, exists
+from concurrent.futures import ThreadPoolExecutor
 from typing import Tuple
 import multiprocessing
-from collections import defaultdict
+from collections import defaultdict, deque
 
 import zmq
+import numpy as np
 from docopt import docopt
 
-from openautoscopev2.writers.array_writer import TimestampedArrayWriter
-from openautoscopev2.zmq.array import TimestampedSubscriber
-from openautoscopev2.zmq.subscriber import ObjectSubscriber
+from openautoscopev2.writers.array_writer import (
+    CroppedArrayWriter,
+    FrameIndexedArrayWriter,
+    compression_options,
+    set_compression_threads,
+    make_compression_executor
+)
+from openautoscopev2.writers.segment_writer import SegmentWriter, SEGMENT_EXTENSION, sidecar_filename
+from openautoscopev2.zmq.array import FrameIndexedSubscriber
+from openautoscopev2.zmq.subscriber import ObjectSubscriber, Subscriber
 from openautoscopev2.zmq.publisher import Publisher
 from openautoscopev2.devices.utils import make_timestamped_filename
-from openautoscopev2.zmq.utils import parse_host_and_port
+from openautoscopev2.zmq.utils import parse_host_and_port, get_all
+from openautoscopev2.devices.frame_metadata import FrameMetadata
+from openautoscopev2.devices.frame_crop import FrameCropper
 from openautoscopev2.devices.utils import array_props_from_string
 
+QUEUE_POLICIES = ("block", "drop_oldest", "drop_newest")
+BACKENDS = ("hdf5", "raw")
+
+class WriteQueue():
+    """Bounded queue between the receiving and the writing threads. File
+    operations are queued in order with the frames and are never dropped."""
+
+    def __init__(self, depth: int, policy: str = "block"):
+        assert policy in QUEUE_POLICIES, "Unknown queue policy: {}, should be one of {}".format( policy, QUEUE_POLICIES )
+        self.depth = depth
+        self.policy = policy
+        self.items = deque()
+        self.n_frames = 0
+        self.n_overflows = 0
+        self.condition = threading.Condition()
+
+    def put_frame(self, msg, *args):
+        with self.condition:
+            if self.n_frames >= self.depth:
+                self.n_overflows += 1
+                if self.policy == "drop_newest":
+                    return
+                elif self.policy == "drop_oldest":
+                    for i, (operation, _) in enumerate(self.items):
+                        if operation == "frame":
+                            del self.items[i]
+                            self.n_frames -= 1
+                            break
+                else:
+                    while self.n_frames >= self.depth:
+                        self.condition.wait()
+            self.items.append(("frame", (msg, *args)))
+            self.n_frames += 1
+            self.condition.notify_all()
+
+    def put_operation(self, operation, *args):
+        with self.condition:
+            self.items.append((operation, args))
+            self.condition.notify_all()
+
+    def get(self):
+        with self.condition:
+            while len(self.items) == 0:
+                self.condition.wait()
+            operation, args = self.items.popleft()
+            if operation == "frame":
+                self.n_frames -= 1
+            self.condition.notify_all()
+            return operation, args
+
+def get_free_space_gb(directory: str) -> float:
+    try:
+        return shutil.disk_usage(directory or ".").free / 1e9
+    except OSError:
+        return float("nan")
+
+class StorageMonitor():
+    """Write throughput and latency of the writing thread, and free space of
+    the recording directory, measured over windows of `interval` seconds."""
+
+    def __init__(self, interval: float = 5.0):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.nbytes = 0
+        self.n_appends = 0
+        self.duration_appends = 0.0
+        self.time_window = 0.0  # The first update only measures free space
+        self.write_mbps = 0.0
+        self.append_latency_ms = 0.0
+        self.write_busy = 0.0  # Fraction of the time spent writing frames
+        self.free_space_gb = float("nan")
+
+    def add_append(self, nbytes: int, duration: float):
+        # Called from the writing thread
+        with self.lock:
+            self.nbytes += nbytes
+            self.n_appends += 1
+            self.duration_appends += duration
+
+    def update(self, directory: str) -> bool:
+        """Measure a window if it is over, returns whether it was."""
+        now = time.time()
+        duration = now - self.time_window
+        if duration < self.interval:
+            return False
+        with self.lock:
+            self.write_mbps = self.nbytes / duration / 1e6
+            self.append_latency_ms = 1e3 * self.duration_appends / self.n_appends if self.n_appends > 0 else 0.0
+            self.write_busy = self.duration_appends / duration
+            self.nbytes, self.n_appends, self.duration_appends = 0, 0, 0.0
+            self.time_window = now
+        self.free_space_gb = get_free_space_gb(directory)
+        return True
+
 class  WriteSession(multiprocessing.Process):
     def __init__(
             self,
@@ -51,23 +219,78 @@ class  WriteSession(multiprocessing.Process):
             fmt: str,
             directory: str,
             name="writer",
-            video_name="data"):
+            video_name="data",
+            buffer_size=16,
+            chunk_frames=1,
+            queue_depth=64,
+            queue_policy="block",
+            lossless=False,
+            receive_hwm=10000,
+            compression="lzf",
+            compression_level=None,
+            compression_threads=1,
+            compression_workers=0,
+            backend="hdf5",
+            max_frames_per_file=3*60*20,
+            max_file_size_mb=0,
+            max_file_duration=0,
+            metadata=True,
+            camera=None,
+            swmr=False,
+            swmr_flush_interval=1.0,
+            crop_size=0,
+            context_every_n_frames=0,
+            context_binning=8,
+            monitor_interval=5.0,
+            warn_free_space_gb=20.0,
+            min_free_space_gb=2.0,
+            max_append_latency_ms=20.0,
+            backpressure=False,
+            max_write_every_n_frames=80):
 
         multiprocessing.Process.__init__(self)
 
         self.status = {}
         self.device_status = 1
         self.subscription_status = 0
-        self.max_frames_per_file = 3*60*20
+        self.max_frames_per_file = int(max_frames_per_file)
+        self.max_file_nbytes = int(1e6 * float(max_file_size_mb))  # 0 disables it
+        self.max_file_duration = float(max_file_duration)  # 0 disables it
         self.write_every_n_frames = 10  # Long-term imagings
+        self.write_every_n_frames_requested = self.write_every_n_frames
         self.led_states = defaultdict(bool)
 
         self.name = name
         self.video_name = video_name
+        assert backend in BACKENDS, "Unknown backend: {}, should be one of {}".format( backend, BACKENDS )
+        self.backend = backend
+        self.lossless = lossless.lower() == 'true' if isinstance(lossless, str) else lossless
+        if self.lossless:
+            queue_policy = "block"
+        # Missing frame indices, e.g. dropped by the camera or ZMQ
+        self.frame_id_last = None
+        self.n_gaps = 0
+        self.n_missing_frames = 0
+        self.swmr = swmr.lower() == 'true' if isinstance(swmr, str) else swmr
+        self.writer_kwargs = dict(
+            buffer_size=int(buffer_size),
+            chunk_frames=int(chunk_frames),
+            swmr=self.swmr,
+            swmr_flush_interval=float(swmr_flush_interval)
+        )
+        self.time_flush_last = time.time()
+        self.compression = None
+        self.set_compression(compression, compression_level)
+        set_compression_threads(compression_threads)
+        # Whole chunks are compressed on worker processes and written as they are
+        self.compression_executor = make_compression_executor(int(compression_workers)) if int(compression_workers) > 0 else None
+        self.writer_kwargs['executor'] = self.compression_executor
 
         (self.dtype, _, self.shape) = array_props_from_string(fmt)
         self.file_idx = 0
         self.n_frames_this_file = 0
+        self.nbytes_this_file = 0
+        self.time_first_this_file = None
         self.fp_base = "TBS"
 
         self.directory = directory
@@ -85,19 +308,66 @@ class  WriteSession(multiprocessing.Process):
             port=commands_in[1],
             bound=commands_in[2])
 
-        self.data_subscriber = TimestampedSubscriber(
+        self.data_subscriber = FrameIndexedSubscriber(
             host=data_in[0],
             port=data_in[1],
             shape=self.shape,
             datatype=self.dtype,
-            bound=data_in[2])
+            bound=data_in[2],
+            hwm=int(receive_hwm) if self.lossless else None)
 
         self.poller.register(self.command_subscriber.socket, zmq.POLLIN)
         self.poller.register(self.data_subscriber.socket, zmq.POLLIN)
 
+        # Latest values from the messages to the logger, saved with each frame
+        self.metadata = None
+        self.metadata_subscriber = None
+        if (metadata.lower() == 'true' if isinstance(metadata, str) else metadata):
+            self.metadata = FrameMetadata(camera_name=camera)
+            self.metadata_subscriber = Subscriber(
+                host=commands_in[0],
+                port=commands_in[1],
+                bound=commands_in[2])
+            self.metadata_subscriber.remove_subscription("")
+            self.metadata_subscriber.add_subscription("logger")
+            self.poller.register(self.metadata_subscriber.socket, zmq.POLLIN)
+
+        # Crops around the worm, positioned with the tracked worm coordinates from the metadata
+        self.cropper = None
+        self.context_every_n_frames = int(context_every_n_frames)
+        self.frame_nbytes = self.data_subscriber.nbytes
+        if int(crop_size) > 0:
+            assert self.metadata is not None, "Cropping frames needs the worm coordinates of the metadata"
+            assert backend == "hdf5", "Cropping frames needs the hdf5 backend"
+            self.cropper = FrameCropper(self.shape, int(crop_size), int(context_binning))
+            self.frame_nbytes = int(np.prod(self.cropper.shape)) * np.dtype(self.dtype).itemsize
+
+        # Warn when writing falls behind or the disk fills up, and stop before it is full
+        self.storage_monitor = StorageMonitor(float(monitor_interval))
+        self.warn_free_space_gb = float(warn_free_space_gb)
+        self.min_free_space_gb = float(min_free_space_gb)
+        self.max_append_latency_ms = float(max_append_latency_ms)
+        self.backpressure = backpressure.lower() == 'true' if isinstance(backpressure, str) else backpressure
+        self.max_write_every_n_frames = int(max_write_every_n_frames)
+        self.storage_warnings = []
+
+        # Frames are written on a separate thread, so slow writes don't stall receiving them
+        self.writer = None
+        # The next file is created and old ones are closed on another thread,
+        # so switching files doesn't stall writing
+        self.file_executor = ThreadPoolExecutor(max_workers=1)
+        self.writer_next = None  # (filename, future) of the next file
+        self.queue = WriteQueue(int(queue_depth), queue_policy)
+        self.time_status_last = time.time()
+        self.write_thread = threading.Thread(target=self._write, daemon=True)
+        self.write_thread.start()
+
     @property
     def filename(self) -> str:
-        return join( self.fp_base, str(self.file_idx).zfill(6)+".h5" )
+        return self.get_filename(self.file_idx)
+    def get_filename(self, file_idx) -> str:
+        extension = SEGMENT_EXTENSION if self.backend == "raw" else ".h5"
+        return join( self.fp_base, str(file_idx).zfill(6)+extension )
     @property
     def any_led_on(self) -> bool:
         if len(self.led_states) == 0:
@@ -116,64 +386,309 @@ class  WriteSession(multiprocessing.Process):
     
     def set_write_every_n_frames(self, write_every_n_frames):
         self.write_every_n_frames = write_every_n_frames
+        self.write_every_n_frames_requested = write_every_n_frames
+        return
+
+    def set_compression(self, codec, level=None):
+        # Used from the next file on
+        self.writer_kwargs = dict(self.writer_kwargs, **compression_options(codec, level))
+        self.compression = codec
+        if self.subscription_status:
+            # The next file was already prepared with the previous options
+            self.queue.put_operation("prepare", self.get_filename(self.file_idx + 1))
         return
 
     def start(self):
+        free_space_gb = get_free_space_gb(self.directory)
+        if free_space_gb < self.min_free_space_gb:
+            self._send_log("<WRITER-STORAGE> not starting, free space {:.1f} GB is below {} GB".format( free_space_gb, self.min_free_space_gb ))
+            return
         if not self.subscription_status:
             _ = self.data_subscriber.get_last()
             self.file_idx = 0
             self.n_frames_this_file = 0
+            self.nbytes_this_file = 0
+            self.time_first_this_file = None
+            self.frame_id_last = None
             self.fp_base = make_timestamped_filename(
                 self.directory,
                 self.video_name, "h5"
             )[:-3]
             if not exists(self.fp_base):
                 os.mkdir( self.fp_base )
-            self.writer = TimestampedArrayWriter.from_source(self.data_subscriber,
-                                                             self.filename)
+            self.queue.put_operation("open", self.filename)
+            self.queue.put_operation("prepare", self.get_filename(self.file_idx + 1))
             self.subscription_status = 1
 
     def stop(self):
         if self.subscription_status:
             _ = self.data_subscriber.get_last()
             self.subscription_status = 0
-            self.writer.close()
+            self.queue.put_operation("close")
+            self.queue.put_operation("discard")
 
     def shutdown(self):
         self.stop()
         self.device_status = 0
+        # Write the frames left in the queue
+        self.queue.put_operation("exit")
+        self.write_thread.join()
+        if self.compression_executor is not None:
+            self.compression_executor.shutdown()
 
     def _run(self):
 
         while self.device_status:
 
-            sockets = dict(self.poller.poll())
+            sockets = dict(self.poller.poll(timeout=1000))
 
             if self.command_subscriber.socket in sockets:
                 self.command_subscriber.handle()
 
             elif self.data_subscriber.socket in sockets:
-                msg = self.data_subscriber.get_last()
-                if self.subscription_status and msg is not None:
-                    if self.n_frames_this_file < self.max_frames_per_file:
-                        if self.any_led_on or ((self.n_frames_this_file % self.write_every_n_frames) == 0):
-                            self.writer.append_data(msg)
-                        self.n_frames_this_file += 1
-                    else:
-                        self.writer.close()
-                        self.file_idx += 1
-                        self.writer = TimestampedArrayWriter.from_source(
-                            self.data_subscriber,
-                            self.filename
-                        )
-                        self.writer.append_data(msg)
-                        self.n_frames_this_file = 1
+                # Every received frame, not only the last one
+                for msg in self.data_subscriber.get_all():
+                    if self.subscription_status:
+                        self.handle_frame(msg)
 
-    def set_directory(self, directory):
+            if self.metadata_subscriber is not None and self.metadata_subscriber.socket in sockets:
+                for msg in get_all(self.metadata_subscriber.socket.recv_string):
+                    try:
+                        self.metadata.update(msg[7:])
+                    except Exception as e:
+                        print("<{}> metadata error in {}: {}".format( self.name, msg, e ))
+
+            self.request_flush()
+            self.check_storage()
+            self.publish_status()
+
+    def check_storage(self):
+        if not self.storage_monitor.update(self.directory):
+            return
+        monitor = self.storage_monitor
+        if monitor.free_space_gb < self.min_free_space_gb:
+            if self.subscription_status:
+                self._send_log("<WRITER-STORAGE> stopping, free space {:.1f} GB is below {} GB".format( monitor.free_space_gb, self.min_free_space_gb ))
+                self.stop()
+            return
+
+        self.storage_warnings = []
+        if monitor.free_space_gb < self.warn_free_space_gb:
+            self.storage_warnings.append("low free space {:.1f} GB".format( monitor.free_space_gb ))
+        if monitor.append_latency_ms > self.max_append_latency_ms:
+            self.storage_warnings.append("slow writes {:.1f} ms per frame".format( monitor.append_latency_ms ))
+        # Frames arrive faster than they are written
+        behind = self.queue.n_frames > self.queue.depth // 2 or monitor.write_busy > 0.8
+        if behind:
+            self.storage_warnings.append("falling behind, {} frames queued, {:.0f}% busy writing at {:.1f} MB/s".format(
+                self.queue.n_frames, 100 * monitor.write_busy, monitor.write_mbps
+            ))
+        if not self.subscription_status:
+            return
+        if len(self.storage_warnings) > 0:
+            self._send_log("<WRITER-STORAGE> " + ", ".join(self.storage_warnings))
+
+        # Save fewer frames outside LED periods until writing catches up, lossless mode writes all frames anyway
+        if not self.backpressure or self.lossless:
+            return
+        write_every_n_frames = self.write_every_n_frames
+        if behind:
+            write_every_n_frames = min(2 * self.write_every_n_frames, self.max_write_every_n_frames)
+        elif self.queue.n_frames < self.queue.depth // 8 and monitor.write_busy < 0.5:
+            write_every_n_frames = max(self.write_every_n_frames // 2, self.write_every_n_frames_requested)
+        if write_every_n_frames != self.write_every_n_frames:
+            self._send_log("<WRITER-STORAGE> write_every_n_frames {} -> {}".format( self.write_every_n_frames, write_every_n_frames ))
+            self.write_every_n_frames = write_every_n_frames
+
+    def _send_log(self, msg):
+        msg = "{} {} {}".format( time.time(), self.name, msg )
+        self.status_publisher.send("logger " + msg)
+
+    def request_flush(self):
+        # Readers of SWMR files see the frames buffered by the writer, also when frames are not coming in
+        if not self.swmr or not self.subscription_status:
+            return
+        if time.time() < self.time_flush_last + self.writer_kwargs['swmr_flush_interval']:
+            return
+        self.time_flush_last = time.time()
+        self.queue.put_operation("flush")
+
+    def is_file_full(self, timestamp) -> bool:
+        if self.n_frames_this_file >= self.max_frames_per_file:
+            return True
+        if self.max_file_nbytes > 0 and self.nbytes_this_file + self.frame_nbytes > self.max_file_nbytes:
+            return True
+        if self.max_file_duration > 0 and self.time_first_this_file is not None and \
+                timestamp - self.time_first_this_file >= self.max_file_duration:
+            return True
+        return False
+
+    def handle_frame(self, msg):
+        if self.is_file_full(msg[1]):
+            self.queue.put_operation("close")
+            self.file_idx += 1
+            self.queue.put_operation("open", self.filename)
+            self.queue.put_operation("prepare", self.get_filename(self.file_idx + 1))
+            self.n_frames_this_file = 0
+            self.nbytes_this_file = 0
+            self.time_first_this_file = None
+        if self.time_first_this_file is None:
+            self.time_first_this_file = msg[1]
+        self.check_gap(msg[0])
+        if self.cropper is not None and self.context_every_n_frames > 0 and \
+                (self.n_frames_this_file % self.context_every_n_frames) == 0:
+            self.queue.put_operation("context", msg[0], self.cropper.context(msg[2]))
+        if self.lossless or self.any_led_on or ((self.n_frames_this_file % self.write_every_n_frames) == 0):
+            if self.cropper is not None:
+                frame_id, timestamp, frame = msg
+                crop, offset = self.cropper.crop(frame, self.metadata.value("worm_x"), self.metadata.value("worm_y"))
+                self.queue.put_frame((frame_id, timestamp, crop), self.metadata.get(), offset)
+            elif self.metadata is not None:
+                self.queue.put_frame(msg, self.metadata.get())
+            else:
+                self.queue.put_frame(msg)
+            self.nbytes_this_file += self.frame_nbytes
+        self.n_frames_this_file += 1
+
+    def check_gap(self, frame_id):
+        # Frame indices go back when the camera restarts, that's not a gap
+        if self.frame_id_last is not None and frame_id > self.frame_id_last + 1:
+            self.queue.put_operation("gap", self.frame_id_last + 1, frame_id - 1)
+            self.n_gaps += 1
+            self.n_missing_frames += frame_id - self.frame_id_last - 1
+        self.frame_id_last = frame_id
+
+    def _write(self):
+        # Runs on the writer thread, the only one using `self.writer`
+        while True:
+            operation, args = self.queue.get()
+            try:
+                if operation == "frame":
+                    if self.writer is not None:
+                        _start = time.time()
+                        self.writer.append_data(*args)
+                        self.storage_monitor.add_append(args[0][2].nbytes, time.time() - _start)
+                elif operation == "gap":
+                    if self.writer is not None:
+                        self.writer.add_gap(*args)
+                elif operation == "context":
+                    if self.writer is not None:
+                        self.writer.add_context(*args)
+                elif operation == "flush":
+                    if self.writer is not None:
+                        self.writer.flush()
+                elif operation == "open":
+                    self.writer = self.open_writer(*args)
+                elif operation == "prepare":
+                    self.discard_writer_next()
+                    self.writer_next = (args[0], self.file_executor.submit(self.make_writer, *args))
+                elif operation == "discard":
+                    self.discard_writer_next()
+                elif operation in ("close", "exit"):
+                    if self.writer is not None:
+                        self.file_executor.submit(self.close_writer, self.writer)
+                        self.writer = None
+                    if operation == "exit":
+                        self.discard_writer_next()
+                        self.file_executor.shutdown(wait=True)
+                        return
+            except Exception as e:
+                print("<{}> writer thread error in {}: {}".format( self.name, operation, e ))
+
+    def make_writer(self, filename):
+        if self.backend == "raw":
+            return SegmentWriter.from_source(
+                self.data_subscriber,
+                filename,
+                n_frames=self.max_frames_per_file,
+                metadata_fields=self.metadata_fields
+            )
+        if self.cropper is not None:
+            return CroppedArrayWriter(
+                self.data_subscriber,
+                filename,
+                self.cropper.shape,
+                self.dtype,
+                **self.writer_kwargs,
+                metadata_fields=self.metadata_fields,
+                frame_shape=self.shape,
+                context_shape=self.cropper.context_shape if self.context_every_n_frames > 0 else None
+            )
+        return FrameIndexedArrayWriter.from_source(
+            self.data_subscriber,
+            filename,
+            **self.writer_kwargs,
+            metadata_fields=self.metadata_fields
+        )
+
+    @property
+    def metadata_fields(self):
+        return self.metadata.fields if self.metadata is not None else ()
+
+    def open_writer(self, filename):
+        # Usually the file prepared while writing the previous one
+        if self.writer_next is not None and self.writer_next[0] == filename:
+            _, future = self.writer_next
+            self.writer_next = None
+            try:
+                return future.result()
+            except Exception as e:
+                print("<{}> file thread error in preparing {}: {}".format( self.name, filename, e ))
+        self.discard_writer_next()
+        return self.make_writer(filename)
+
+    def close_writer(self, writer, remove=False):
+        # Runs on the file thread
         try:
-            self.writer.close()
-        except:
-            pass
+            writer.close()
+            if remove:
+                os.remove(writer.filename)
+                if isinstance(writer, SegmentWriter):
+                    os.remove(sidecar_filename(writer.filename))
+        except Exception as e:
+            print("<{}> file thread error in closing {}: {}".format( self.name, writer.filename, e ))
+
+    def discard_writer_next(self):
+        # The prepared file was not needed, e.g. the recording stopped
+        if self.writer_next is None:
+            return
+        _, future = self.writer_next
+        self.writer_next = None
+        self.file_executor.submit(self.remove_writer, future)
+
+    def remove_writer(self, future):
+        # Runs on the file thread, after the writer was made
+        if future.exception() is None:
+            self.close_writer(future.result(), remove=True)
+
+    def publish_status(self):
+        if time.time() < self.time_status_last + 1.0:
+            return
+        self.time_status_last = time.time()
+        self.status = {
+            "device": self.name,
+            "queue_depth": self.queue.n_frames,
+            "queue_overflows": self.queue.n_overflows,
+            "queue_policy": self.queue.policy,
+            "lossless": self.lossless,
+            "backend": self.backend,
+            "compression": self.compression,
+            "gaps": self.n_gaps,
+            "missing_frames": self.n_missing_frames,
+            "crop_size": self.cropper.crop_size if self.cropper is not None else 0,
+            "write_every_n_frames": self.write_every_n_frames,
+            "write_mbps": self.storage_monitor.write_mbps,
+            "append_latency_ms": self.storage_monitor.append_latency_ms,
+            "free_space_gb": self.storage_monitor.free_space_gb,
+            "storage_warnings": self.storage_warnings,
+        }
+        self.status_publisher.send("logger " + json.dumps(self.status, default=int))
+
+    def set_directory(self, directory):
+        # Files of a recording stay in one directory, it continues there only when started again
+        if self.subscription_status:
+            self._send_log("stopping the recording to change the directory to {}".format(directory))
+        self.stop()
         self.directory = directory
 
 def main():
@@ -187,7 +702,34 @@ def main():
         fmt=args["--format"],
         directory=args["--directory"],
         name=args["--name"],
-        video_name=args["--video_name"])
+        video_name=args["--video_name"],
+        buffer_size=int(args["--buffer_size"]),
+        chunk_frames=int(args["--chunk_frames"]),
+        queue_depth=int(args["--queue_depth"]),
+        queue_policy=args["--queue_policy"],
+        lossless=args["--lossless"],
+        receive_hwm=int(args["--receive_hwm"]),
+        compression=args["--compression"],
+        compression_level=int(args["--compression_level"]) if args["--compression_level"] else None,
+        compression_threads=int(args["--compression_threads"]),
+        compression_workers=int(args["--compression_workers"]),
+        backend=args["--backend"],
+        max_frames_per_file=int(args["--max_frames_per_file"]),
+        max_file_size_mb=float(args["--max_file_size_mb"]),
+        max_file_duration=float(args["--max_file_duration"]),
+        metadata=args["--metadata"],
+        camera=args["--camera"] or None,
+        swmr=args["--swmr"],
+        swmr_flush_interval=float(args["--swmr_flush_interval"]),
+        crop_size=int(args["--crop_size"]),
+        context_every_n_frames=int(args["--context_every_n_frames"]),
+        context_binning=int(args["--context_binning"]),
+        monitor_interval=float(args["--monitor_interval"]),
+        warn_free_space_gb=float(args["--warn_free_space_gb"]),
+        min_free_space_gb=float(args["--min_free_space_gb"]),
+        max_append_latency_ms=float(args["--max_append_latency_ms"]),
+        backpressure=args["--backpressure"],
+        max_write_every_n_frames=int(args["--max_write_every_n_frames"]))
 
     writer._run()
 
@@ -52,6 +52,7 @@ class OASwithGUI:
         tracker_to_displayer_gcamp = self.kwargs['tracker_to_displayer_gcamp']
         interpolation_tracking =  self.kwargs['interpolation_tracking']
         z_autofocus_tracking =  self.kwargs['z_autofocus_tracking']
+        pixels_per_step = self.kwargs.get('pixels_per_step', 0.0)
         framerate = self.kwargs['framerate']
         format = self.kwargs['format']
         binsize = self.kwargs['binsize']
@@ -118,6 +119,7 @@ class OASwithGUI:
                         f"--format={format}",
                         f"--interpolation_tracking={interpolation_tracking}",
                         f"--z_autofocus_tracking={z_autofocus_tracking}",
+                        f"--pixels_per_step={pixels_per_step}",
                         f"--name=tracker_behavior",
                         f"--gui_fp={gui_fp}"]))
 
@@ -148,6 +150,7 @@ class OASwithGUI:
                         f"--format={format}",
                         f"--directory={data_directory}",
                         f"--video_name=flircamera_behavior",
+                        f"--camera=FlirCameraBehavior",
                         f"--name=writer_behavior"]))
 
         self.jobs.append(Popen(["oas_writer",
@@ -157,6 +160,7 @@ class OASwithGUI:
                         f"--format={format}",
                         f"--directory={data_directory}",
                         f"--video_name=flircamera_gcamp",
+                        f"--camera=FlirCameraGCaMP",
                         f"--name=writer_gcamp"]))
 
         self.jobs.append(Popen(["oas_logger",
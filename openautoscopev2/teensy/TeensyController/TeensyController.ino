@@ -209,6 +209,21 @@ void loop()
       {
         stepperZ.setSpeed(atof(comBuf + 2));
       }
+      else if ( subcmd == 'v')
+      {
+        // Combined velocity: `sv<vx> <vy> <vz>`, an `n` leaves that axis unchanged
+        comBuf[nChar < SIZE_COMMAND_BUFFER ? nChar : SIZE_COMMAND_BUFFER - 1] = '\0';
+        AccelStepper *steppers [] = { &stepperX, &stepperY, &stepperZ };
+        char *token = strtok(comBuf + 2, " ");
+        for (int i = 0; i < 3 && token != NULL; i++)
+        {
+          if ( token[0] != 'n' )
+          {
+            steppers[i]->setSpeed(atof(token));
+          }
+          token = strtok(NULL, " ");
+        }
+      }
     }
     else if ( cmd == 'g' )
     {
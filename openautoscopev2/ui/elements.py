@@ -883,9 +883,11 @@ class TrackingModelsCombo(AbstractElement):
         self.key_combo = f"{self.key}--COMBO"
         self.events = {
             self.key,
-            self.key_combo
+            self.key_combo,
+            "CLIENT-MODEL-STATUS"
         }
 
+        self.text_base = text
         self.text = sg.Text(text, background_color = BACKGROUND_COLOR)
         self.combo = sg.Combo(
             values=self.model_names,
@@ -903,6 +905,12 @@ class TrackingModelsCombo(AbstractElement):
             model = self.get()
             client_cli_cmd = "DO _tracker_set_tracking_mode {}".format(model)
             self.client.process(client_cli_cmd)
+        elif event == "CLIENT-MODEL-STATUS":
+            # Show the loading status of the selected model, or of a fused model covering it
+            model_key, status = kwargs[event]
+            if model_key == f"tracking_{self.get()}" or self.models_dict.get(model_key, {}).get("tracking") == self.get():
+                text = self.text_base if status == "ready" else f"{self.text_base} ({status})"
+                self.text.update(value=text)
     
     def get(self):
         return self.combo.get()
@@ -936,9 +944,11 @@ class FocusModelsCombo(AbstractElement):
         self.key_combo = f"{self.key}--COMBO"
         self.events = {
             self.key,
-            self.key_combo
+            self.key_combo,
+            "CLIENT-MODEL-STATUS"
         }
 
+        self.text_base = text
         self.text = sg.Text(text, background_color = BACKGROUND_COLOR)
         self.combo = sg.Combo(
             values=self.model_names,
@@ -956,6 +966,12 @@ class FocusModelsCombo(AbstractElement):
             model = self.get()
             client_cli_cmd = "DO _tracker_set_focus_mode {}".format(model)
             self.client.process(client_cli_cmd)
+        elif event == "CLIENT-MODEL-STATUS":
+            # Show the loading status of the selected model, or of a fused model covering it
+            model_key, status = kwargs[event]
+            if model_key == f"focus_{self.get()}" or self.models_dict.get(model_key, {}).get("focus") == self.get():
+                text = self.text_base if status == "ready" else f"{self.text_base} ({status})"
+                self.text.update(value=text)
     
     def get(self):
         return self.combo.get()
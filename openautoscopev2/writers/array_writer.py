@@ -3,11 +3,137 @@
 # Copyright 2021
 # Author: Vivek Venkatachalam
 
+import os
+import time
+import multiprocessing
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor
 from typing import Tuple, Union
 
 import h5py
 import numpy as np
 
+# Timestamps are tiny, one chunk holds many of them
+TIMES_CHUNK_SIZE = 1024
+
+# Compression codecs of recorded frames, all but `none`, `lzf` and `gzip` are
+# HDF5 filter plugins from `hdf5plugin`, which must also be imported to read them
+CODECS = (
+    "none",
+    "lzf",
+    "gzip",
+    "blosc_lz4",
+    "blosc_zstd",
+    "blosc_lz4_bitshuffle",
+    "blosc_zstd_bitshuffle",
+    "bitshuffle_lz4",
+    "bitshuffle_zstd",
+    "lz4",
+    "zstd",
+)
+
+
+def compression_options(codec: str = "lzf", level: Union[None, int] = None) -> dict:
+    """`compression` and `compression_opts` of a codec, `level` defaults to
+    the default level of the codec."""
+
+    if codec not in CODECS:
+        raise ValueError("Unknown codec: {}, should be one of {}".format(codec, CODECS))
+    if codec == "none":
+        return dict(compression=None, compression_opts=None)
+    elif codec == "lzf":
+        return dict(compression="lzf", compression_opts=None)
+    elif codec == "gzip":
+        return dict(compression="gzip", compression_opts=4 if level is None else int(level))
+
+    import hdf5plugin
+    kwargs = dict() if level is None else dict(clevel=int(level))
+    if codec == "lz4":
+        plugin = hdf5plugin.LZ4()
+    elif codec == "zstd":
+        plugin = hdf5plugin.Zstd(**kwargs)
+    elif codec.startswith("blosc_"):
+        _, cname, *bitshuffle = codec.split("_")
+        shuffle = hdf5plugin.Blosc.BITSHUFFLE if bitshuffle else hdf5plugin.Blosc.SHUFFLE
+        plugin = hdf5plugin.Blosc(cname=cname, shuffle=shuffle, **kwargs)
+    else:
+        _, cname = codec.split("_")
+        if cname == "lz4":
+            kwargs = dict()  # LZ4 has no levels in bitshuffle
+        plugin = hdf5plugin.Bitshuffle(cname=cname, **kwargs)
+    return dict(compression=plugin.filter_id, compression_opts=plugin.filter_options)
+
+
+def set_compression_threads(n_threads: int):
+    """Number of threads Blosc codecs use to compress and decompress each
+    chunk, read by Blosc on every call."""
+
+    os.environ["BLOSC_NTHREADS"] = str(int(n_threads))
+
+
+# In-memory datasets of a worker process that compress chunks, by chunk
+# shape, dtype and compression
+_CHUNK_DATASETS = dict()
+
+
+def compress_chunk(chunk: np.ndarray, compression, compression_opts) -> Tuple[int, bytes]:
+    """Compress a chunk with the HDF5 filters of a dataset, by writing it to
+    an in-memory file and reading it back raw. Returns the filter mask and the
+    bytes to store with `write_direct_chunk`, so files stay readable by the
+    standard filters. Meant to run on worker processes, which each have their
+    own HDF5 library and compress in parallel."""
+
+    key = (chunk.shape, chunk.dtype.str, compression, compression_opts)
+    if key not in _CHUNK_DATASETS:
+        if isinstance(compression, int):
+            import hdf5plugin  # registers the plugin filters in this process
+        file = h5py.File(f"chunk_{len(_CHUNK_DATASETS)}.h5", "w", driver="core", backing_store=False)
+        _CHUNK_DATASETS[key] = file.create_dataset(
+            "data", chunk.shape,
+            chunks=chunk.shape,
+            dtype=chunk.dtype,
+            compression=compression,
+            compression_opts=compression_opts)
+    dataset = _CHUNK_DATASETS[key]
+    dataset[...] = chunk
+    return dataset.id.read_direct_chunk((0, ) * chunk.ndim)
+
+
+def make_compression_executor(n_workers: int) -> ProcessPoolExecutor:
+    """Worker processes for `compress_chunk`. They are spawned, not forked,
+    so they don't inherit open HDF5 files and their locks."""
+
+    return ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+class ChunkCompressor():
+    """Compresses whole chunks of a dataset on an executor and writes them
+    with `write_direct_chunk`, in the order they were submitted."""
+
+    def __init__(self, dataset, executor: Executor, compression, compression_opts, max_pending: int = 16):
+        self.dataset = dataset
+        self.executor = executor
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.max_pending = max_pending
+        self.pending = deque()
+
+    def submit(self, start: int, chunk: np.ndarray):
+        # The chunk is copied, the buffer is reused before the chunk is compressed
+        future = self.executor.submit(compress_chunk, chunk.copy(), self.compression, self.compression_opts)
+        self.pending.append((start, future))
+        self.write(self.max_pending)
+
+    def write(self, max_pending: int = 0):
+        """Write compressed chunks, waiting for them until at most
+        `max_pending` are left."""
+
+        while len(self.pending) > 0 and (len(self.pending) > max_pending or self.pending[0][1].done()):
+            start, future = self.pending.popleft()
+            filter_mask, data = future.result()
+            offset = (start, ) + (0, ) * (self.dataset.ndim - 1)
+            self.dataset.id.write_direct_chunk(offset, data, filter_mask)
+
 
 class ArrayWriter():
     def __init__(self,
@@ -17,9 +143,24 @@ class ArrayWriter():
                  dtype: np.dtype,
                  groupname: Union[None, str] = None,
                  compression="lzf",
-                 compression_opts=None):
+                 compression_opts=None,
+                 buffer_size: int = 1,
+                 chunk_frames: int = 1,
+                 executor: Union[None, Executor] = None,
+                 swmr: bool = False,
+                 swmr_flush_interval: float = 1.0):
         """ src.recv must be a coroutine that returns numpy arrays of the
-        specified shape and type."""
+        specified shape and type.
+
+        Frames are kept in a preallocated buffer and written `buffer_size` at
+        a time. Datasets grow geometrically and are trimmed on close. Each
+        chunk of the dataset holds `chunk_frames` frames. If an executor is
+        given, whole chunks are compressed on it instead of inside h5py.
+
+        With `swmr`, the file can be read while it is written, see
+        `utils_data.SWMRReader`. Datasets then grow to the written frames
+        only, and the file is flushed at most every `swmr_flush_interval`
+        seconds."""
 
         self.src = src
 
@@ -27,9 +168,16 @@ class ArrayWriter():
         self.dtype = dtype
 
         self.N_complete = 0
+        self.N_buffered = 0
+        self.N_allocated = 0
+        self.buffer = np.zeros((buffer_size, *shape), dtype=dtype)
 
         self.filename = filename
-        self.file = h5py.File(filename, "a")
+        self.swmr = swmr
+        self.swmr_flush_interval = swmr_flush_interval
+        self.time_swmr_flush = time.time()
+        # SWMR needs the latest file format, it is enabled after all datasets are created
+        self.file = h5py.File(filename, "a", libver="latest" if swmr else None)
 
         if groupname is None:
             groupname = "/"
@@ -41,15 +189,61 @@ class ArrayWriter():
 
         self.data = self.group.create_dataset(
             "data", (0, *shape),
-            chunks=(1, *shape),
+            chunks=(chunk_frames, *shape),
             dtype=dtype,
             compression=compression,
             compression_opts=compression_opts,
             maxshape=(None, *shape))
 
+        self.chunk_frames = chunk_frames
+        self.compressor = None
+        if executor is not None and compression is not None:
+            self.compressor = ChunkCompressor(self.data, executor, compression, compression_opts)
+
     def close(self):
+        self.flush()
+        if self.compressor is not None:
+            self.compressor.write()
+        self._resize(self.N_complete)
         self.file.close()
 
+    def flush(self):
+        """Write buffered frames to the file."""
+
+        if self.swmr and not self.file.swmr_mode:
+            self.file.swmr_mode = True
+        if self.N_buffered > 0:
+            N_written = self.N_complete - self.N_buffered
+            if self.N_complete > self.N_allocated:
+                # Readers of SWMR files take the dataset size as the number of frames
+                self.N_allocated = self.N_complete if self.swmr else max(self.N_complete, 2 * self.N_allocated)
+                self._resize(self.N_allocated)
+            self._write_buffer(N_written, self.N_buffered)
+            self.N_buffered = 0
+        if self.swmr and time.time() - self.time_swmr_flush >= self.swmr_flush_interval:
+            if self.compressor is not None:
+                self.compressor.write()
+            self.file.flush()
+            self.time_swmr_flush = time.time()
+
+    def _resize(self, n):
+        self.data.resize((n, *self.shape))
+
+    def _write_buffer(self, start, n):
+        if self.compressor is None:
+            self.data[start:start + n, ...] = self.buffer[:n]
+            return
+        # Frames of partially filled chunks are written by h5py, whole chunks
+        # are compressed in parallel
+        i_first = min(-start % self.chunk_frames, n)
+        i_last = i_first + (n - i_first) // self.chunk_frames * self.chunk_frames
+        if i_first > 0:
+            self.data[start:start + i_first, ...] = self.buffer[:i_first]
+        for i in range(i_first, i_last, self.chunk_frames):
+            self.compressor.submit(start + i, self.buffer[i:i + self.chunk_frames])
+        if i_last < n:
+            self.data[start + i_last:start + n, ...] = self.buffer[i_last:n]
+
     def save_frame(self):
         x = self.src.get_last()
         self.append_data(x)
@@ -65,18 +259,21 @@ class ArrayWriter():
             self.append_data(msg)
 
     def append_data(self, x):
+        self.buffer[self.N_buffered, ...] = x
+        self.N_buffered += 1
         self.N_complete += 1
-        self.data.resize((self.N_complete, *self.shape))
-        self.data[self.N_complete - 1, ...] = x
+        if self.N_buffered == len(self.buffer):
+            self.flush()
 
     @classmethod
     def from_source(cls,
                     src,
                     filename: str,
-                    groupname: Union[None, str] = None):
+                    groupname: Union[None, str] = None,
+                    **kwargs):
         """If the source has shape and dtype fields, this can be used to
         construct the writer more succinctly."""
-        return cls(src, filename, src.shape, src.dtype, groupname)
+        return cls(src, filename, src.shape, src.dtype, groupname, **kwargs)
 
 
 class TimestampedArrayWriter(ArrayWriter):
@@ -87,26 +284,186 @@ class TimestampedArrayWriter(ArrayWriter):
                  dtype: np.dtype,
                  groupname: Union[None, str] = None,
                  compression="lzf",
-                 compression_opts=None):
+                 compression_opts=None,
+                 buffer_size: int = 1,
+                 chunk_frames: int = 1,
+                 executor: Union[None, Executor] = None,
+                 swmr: bool = False,
+                 swmr_flush_interval: float = 1.0):
         """ src must yield numpy arrays with shape and dtype matching the shape
         and dtype provided."""
 
+        self.times_buffer = np.zeros(buffer_size, dtype=np.dtype("float64"))
+
         ArrayWriter.__init__(self, src, filename, shape, dtype, groupname,
-                             compression, compression_opts)
+                             compression, compression_opts, buffer_size,
+                             chunk_frames, executor, swmr,
+                             swmr_flush_interval)
 
         self.times = self.group.create_dataset("times", (0, ),
-                                               chunks=(1, ),
+                                               chunks=(TIMES_CHUNK_SIZE, ),
                                                dtype=np.dtype("float64"),
                                                maxshape=(None, ))
 
+    def _resize(self, n):
+        ArrayWriter._resize(self, n)
+        self.times.resize((n, ))
+
+    def _write_buffer(self, start, n):
+        ArrayWriter._write_buffer(self, start, n)
+        self.times[start:start + n] = self.times_buffer[:n]
+
     def append_data(self, msg):
 
         (t, x) = msg
 
-        self.N_complete += 1
+        self.times_buffer[self.N_buffered] = t
+        ArrayWriter.append_data(self, x)
+
+
+class FrameIndexedArrayWriter(TimestampedArrayWriter):
+    def __init__(self,
+                 src,
+                 filename: str,
+                 shape: Tuple[int, ...],
+                 dtype: np.dtype,
+                 groupname: Union[None, str] = None,
+                 compression="lzf",
+                 compression_opts=None,
+                 buffer_size: int = 1,
+                 chunk_frames: int = 1,
+                 executor: Union[None, Executor] = None,
+                 swmr: bool = False,
+                 swmr_flush_interval: float = 1.0,
+                 metadata_fields: Tuple[str, ...] = ()):
+        """ src must yield frame indices, timestamps and numpy arrays with
+        shape and dtype matching the shape and dtype provided.
+
+        Ranges of missing frame indices are saved in `gaps`, as rows of the
+        first and the last missing index. Each of `metadata_fields` gets a
+        float32 dataset with a value per frame, passed to `append_data`."""
+
+        self.frame_ids_buffer = np.zeros(buffer_size, dtype=np.dtype("int64"))
+        self.metadata_fields = tuple(metadata_fields)
+        self.metadata_buffer = np.full((buffer_size, len(self.metadata_fields)), np.nan, dtype=np.dtype("float32"))
+
+        TimestampedArrayWriter.__init__(self, src, filename, shape, dtype,
+                                        groupname, compression,
+                                        compression_opts, buffer_size,
+                                        chunk_frames, executor, swmr,
+                                        swmr_flush_interval)
+
+        self.frame_ids = self.group.create_dataset("frame_ids", (0, ),
+                                                   chunks=(TIMES_CHUNK_SIZE, ),
+                                                   dtype=np.dtype("int64"),
+                                                   maxshape=(None, ))
+        self.gaps = self.group.create_dataset("gaps", (0, 2),
+                                              chunks=(TIMES_CHUNK_SIZE, 2),
+                                              dtype=np.dtype("int64"),
+                                              maxshape=(None, 2))
+        self.metadata = [
+            self.group.create_dataset(field, (0, ),
+                                      chunks=(TIMES_CHUNK_SIZE, ),
+                                      dtype=np.dtype("float32"),
+                                      maxshape=(None, ))
+            for field in self.metadata_fields
+        ]
+
+    def _resize(self, n):
+        TimestampedArrayWriter._resize(self, n)
+        self.frame_ids.resize((n, ))
+        for dataset in self.metadata:
+            dataset.resize((n, ))
+
+    def _write_buffer(self, start, n):
+        TimestampedArrayWriter._write_buffer(self, start, n)
+        self.frame_ids[start:start + n] = self.frame_ids_buffer[:n]
+        for i, dataset in enumerate(self.metadata):
+            dataset[start:start + n] = self.metadata_buffer[:n, i]
+
+    def add_gap(self, first: int, last: int):
+        n = len(self.gaps)
+        self.gaps.resize((n + 1, 2))
+        self.gaps[n] = (first, last)
+
+    def append_data(self, msg, metadata=None):
+
+        (frame_id, t, x) = msg
+
+        self.frame_ids_buffer[self.N_buffered] = frame_id
+        self.metadata_buffer[self.N_buffered] = np.nan if metadata is None else metadata
+        TimestampedArrayWriter.append_data(self, (t, x))
+
+
+class CroppedArrayWriter(FrameIndexedArrayWriter):
+    def __init__(self,
+                 src,
+                 filename: str,
+                 shape: Tuple[int, ...],
+                 dtype: np.dtype,
+                 groupname: Union[None, str] = None,
+                 compression="lzf",
+                 compression_opts=None,
+                 buffer_size: int = 1,
+                 chunk_frames: int = 1,
+                 executor: Union[None, Executor] = None,
+                 swmr: bool = False,
+                 swmr_flush_interval: float = 1.0,
+                 metadata_fields: Tuple[str, ...] = (),
+                 frame_shape: Union[None, Tuple[int, ...]] = None,
+                 context_shape: Union[None, Tuple[int, ...]] = None):
+        """ Frames are crops of `shape` from frames of `frame_shape`. The
+        offset of each crop in the frame, as (y, x) of its first pixel, is
+        saved in `offsets`.
+
+        If `context_shape` is given, downsampled whole frames passed to
+        `add_context` are saved in `context`, with their frame indices in
+        `context_frame_ids`."""
+
+        self.offsets_buffer = np.zeros((buffer_size, 2), dtype=np.dtype("int32"))
+
+        FrameIndexedArrayWriter.__init__(self, src, filename, shape, dtype,
+                                         groupname, compression,
+                                         compression_opts, buffer_size,
+                                         chunk_frames, executor, swmr,
+                                         swmr_flush_interval, metadata_fields)
+
+        self.group.attrs["frame_shape"] = frame_shape if frame_shape is not None else shape
+        self.offsets = self.group.create_dataset("offsets", (0, 2),
+                                                 chunks=(TIMES_CHUNK_SIZE, 2),
+                                                 dtype=np.dtype("int32"),
+                                                 maxshape=(None, 2))
+        self.context = None
+        if context_shape is not None:
+            context_shape = tuple(context_shape)
+            self.context = self.group.create_dataset(
+                "context", (0, *context_shape),
+                chunks=(1, *context_shape),
+                dtype=dtype,
+                compression=compression,
+                compression_opts=compression_opts,
+                maxshape=(None, *context_shape))
+            self.context_frame_ids = self.group.create_dataset("context_frame_ids", (0, ),
+                                                               chunks=(TIMES_CHUNK_SIZE, ),
+                                                               dtype=np.dtype("int64"),
+                                                               maxshape=(None, ))
+
+    def _resize(self, n):
+        FrameIndexedArrayWriter._resize(self, n)
+        self.offsets.resize((n, 2))
+
+    def _write_buffer(self, start, n):
+        FrameIndexedArrayWriter._write_buffer(self, start, n)
+        self.offsets[start:start + n] = self.offsets_buffer[:n]
+
+    def add_context(self, frame_id: int, x):
+        n = len(self.context)
+        self.context.resize((n + 1, *self.context.shape[1:]))
+        self.context_frame_ids.resize((n + 1, ))
+        self.context[n] = x
+        self.context_frame_ids[n] = frame_id
 
-        self.data.resize((self.N_complete, *self.shape))
-        self.times.resize((self.N_complete, ))
+    def append_data(self, msg, metadata=None, offset=(0, 0)):
 
-        self.data[self.N_complete - 1, ...] = x
-        self.times[self.N_complete - 1] = t
\ No newline at end of file
+        self.offsets_buffer[self.N_buffered] = offset
+        FrameIndexedArrayWriter.append_data(self, msg, metadata)
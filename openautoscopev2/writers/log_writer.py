@@ -0,0 +1,129 @@
+#! python
+#
+# Copyright 2025
+# Authors: Sina Rasouli, Mahdi Torkashvand
+
+"""Structured logs: fixed-size binary records (logger time, message time,
+source, event and numeric values) appended in batches, with a JSON sidecar
+naming the sources and events. Messages without numeric values are saved in a
+text file next to the records, and their records hold the line number."""
+
+import os
+import json
+import time
+from typing import Dict, Tuple
+
+import numpy as np
+
+LOG_EXTENSION = ".bin"
+MESSAGES_SUFFIX = "_messages.txt"
+N_LOG_VALUES = 4
+
+LOG_RECORD_DTYPE = np.dtype([
+    ("time", np.float64),          # When the logger received the message
+    ("time_message", np.float64),  # Timestamp in the message, NaN if it has none
+    ("source", np.uint16),         # Index in the `sources` of the sidecar
+    ("event", np.uint16),          # Index in the `events` of the sidecar
+    ("values", np.float64, (N_LOG_VALUES, )),  # NaN padded
+])
+
+
+def log_sidecar_filename(filename: str) -> str:
+    return os.path.splitext(filename)[0] + ".json"
+
+
+def log_messages_filename(filename: str) -> str:
+    return os.path.splitext(filename)[0] + MESSAGES_SUFFIX
+
+
+def load_log(filename: str):
+    """Records of a log, its sidecar and its messages. Logs that were not
+    closed hold the records written until the last flush."""
+
+    with open(log_sidecar_filename(filename), "r") as in_file:
+        sidecar = json.load(in_file)
+    n_records = os.path.getsize(filename) // LOG_RECORD_DTYPE.itemsize
+    records = np.fromfile(filename, dtype=LOG_RECORD_DTYPE, count=n_records)
+    with open(log_messages_filename(filename), "r") as in_file:
+        messages = in_file.read().splitlines()
+    return records, sidecar, messages
+
+
+class LogWriter():
+    def __init__(self,
+                 filename: str,
+                 events: Dict[str, Tuple[str, ...]],
+                 buffer_size: int = 4096,
+                 fsync_interval: float = 10.0):
+        """ `events` maps the name of each event type to the names of its
+        values. Records are kept in a buffer of `buffer_size` records and
+        written when it is full or on `flush`, and the files are synced to the
+        disk at most every `fsync_interval` seconds."""
+
+        self.filename = filename
+        self.events = dict(events)
+        self.event_idx = { event: i for i, event in enumerate(self.events) }
+        self.sources = []
+        self.source_idx = {}
+        self.n_messages = 0
+
+        self.buffer = np.zeros(buffer_size, dtype=LOG_RECORD_DTYPE)
+        self.N_buffered = 0
+        self.N_complete = 0
+
+        self.fsync_interval = fsync_interval
+        self.time_fsync = time.time()
+        self.file = open(filename, "wb")
+        self.messages_file = open(log_messages_filename(filename), "w")
+        self._write_sidecar()
+        self.sidecar_changed = False
+
+    def _write_sidecar(self):
+        with open(log_sidecar_filename(self.filename), "w") as out_file:
+            json.dump({
+                "events": list(self.events),
+                "event_values": self.events,
+                "sources": self.sources,
+            }, out_file, indent=4)
+
+    def append(self, t: float, time_message: float, source: str, event: str, values=(), text=None):
+        """Add a record. The text of messages is saved in the messages file and
+        its line number in the values."""
+
+        if source not in self.source_idx:
+            self.source_idx[source] = len(self.sources)
+            self.sources.append(source)
+            self.sidecar_changed = True
+        if text is not None:
+            print(text.replace("\n", "\\n"), file=self.messages_file)
+            values = (self.n_messages, )
+            self.n_messages += 1
+
+        values = tuple(values) + (np.nan, ) * (N_LOG_VALUES - len(values))
+        self.buffer[self.N_buffered] = (t, time_message, self.source_idx[source], self.event_idx[event], values)
+        self.N_buffered += 1
+        self.N_complete += 1
+        if self.N_buffered == len(self.buffer):
+            self.flush()
+
+    def flush(self, fsync: bool = False):
+        """Write buffered records to the file."""
+
+        # Messages first, records never point past them
+        self.messages_file.flush()
+        if self.sidecar_changed:
+            self._write_sidecar()
+            self.sidecar_changed = False
+        if self.N_buffered > 0:
+            self.file.write(self.buffer[:self.N_buffered].tobytes())
+            self.N_buffered = 0
+        self.file.flush()
+        if fsync or time.time() - self.time_fsync >= self.fsync_interval:
+            os.fsync(self.messages_file.fileno())
+            os.fsync(self.file.fileno())
+            self.time_fsync = time.time()
+
+    def close(self):
+        self.flush(fsync=True)
+        self.file.close()
+        self.messages_file.close()
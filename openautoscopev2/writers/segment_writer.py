@@ -0,0 +1,132 @@
+#! python
+#
+# Copyright 2025
+# Authors: Sina Rasouli, Mahdi Torkashvand
+
+"""Raw recording segments: preallocated, memory-mapped binary files of
+fixed-size records (timestamp, frame index, frame), with a JSON sidecar
+describing them. Converted to the HDF5 layout of `ArrayWriter` offline."""
+
+import os
+import json
+from typing import Tuple
+
+import numpy as np
+
+SEGMENT_EXTENSION = ".bin"
+SIDECAR_EXTENSION = ".json"
+
+
+def record_dtype(shape: Tuple[int, ...], dtype: np.dtype, n_metadata: int = 0) -> np.dtype:
+    fields = [
+        ("times", np.float64),
+        ("frame_ids", np.int64),
+        ("data", np.dtype(dtype), tuple(shape)),
+    ]
+    if n_metadata > 0:
+        fields.append(("metadata", np.float32, (n_metadata, )))
+    return np.dtype(fields)
+
+
+def sidecar_filename(filename: str) -> str:
+    return os.path.splitext(filename)[0] + SIDECAR_EXTENSION
+
+
+def load_segment(filename: str):
+    """Records of a segment and its sidecar. Segments that were not closed,
+    e.g. after a crash, hold the records until the first empty one."""
+
+    with open(sidecar_filename(filename), "r") as in_file:
+        sidecar = json.load(in_file)
+    dtype = record_dtype(sidecar["shape"], sidecar["dtype"], len(sidecar.get("metadata_fields", [])))
+    n_records = os.path.getsize(filename) // dtype.itemsize
+    records = np.memmap(filename, dtype=dtype, mode="r", shape=(n_records, ))
+    n_frames = sidecar["n_frames"]
+    if n_frames is None:
+        n_frames = int(np.argmax(records["times"] == 0.0)) if np.any(records["times"] == 0.0) else n_records
+    return records[:n_frames], sidecar
+
+
+class SegmentWriter():
+    def __init__(self,
+                 src,
+                 filename: str,
+                 shape: Tuple[int, ...],
+                 dtype: np.dtype,
+                 n_frames: int = 3600,
+                 metadata_fields: Tuple[str, ...] = ()):
+        """ src must yield frame indices, timestamps and numpy arrays with
+        shape and dtype matching the shape and dtype provided.
+
+        The segment holds up to `n_frames` frames, it is allocated when opened
+        and truncated to the written frames on close. Ranges of missing frame
+        indices are saved in the sidecar, and values of `metadata_fields` in
+        each record, as in `FrameIndexedArrayWriter`."""
+
+        self.src = src
+
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.N_complete = 0
+
+        self.filename = filename
+        self.gaps = []
+        self.metadata_fields = tuple(metadata_fields)
+        self.records = np.memmap(
+            filename,
+            dtype=record_dtype(self.shape, self.dtype, len(self.metadata_fields)),
+            mode="w+",
+            shape=(n_frames, )
+        )
+        self._write_sidecar(None)
+
+    def _write_sidecar(self, n_frames):
+        # Replaced in one step, a crash never leaves a partially written sidecar
+        fp_sidecar = sidecar_filename(self.filename)
+        with open(fp_sidecar + ".tmp", "w") as out_file:
+            json.dump({
+                "shape": self.shape,
+                "dtype": self.dtype.str,
+                "n_frames": n_frames,
+                "gaps": self.gaps,
+                "metadata_fields": self.metadata_fields,
+            }, out_file, indent=4)
+        os.replace(fp_sidecar + ".tmp", fp_sidecar)
+
+    def close(self):
+        self.flush()
+        itemsize = self.records.dtype.itemsize
+        del self.records
+        os.truncate(self.filename, self.N_complete * itemsize)
+        self._write_sidecar(self.N_complete)
+
+    def flush(self):
+        """Write mapped frames to the disk."""
+        self.records.flush()
+
+    def add_gap(self, first: int, last: int):
+        # Saved right away, segments that were not closed keep their gaps
+        self.gaps.append((first, last))
+        self._write_sidecar(None)
+
+    def append_data(self, msg, metadata=None):
+
+        (frame_id, t, x) = msg
+
+        if self.N_complete == len(self.records):
+            raise IndexError("Segment {} is full with {} frames".format(self.filename, self.N_complete))
+        self.records["times"][self.N_complete] = t
+        self.records["frame_ids"][self.N_complete] = frame_id
+        self.records["data"][self.N_complete] = x
+        if len(self.metadata_fields) > 0:
+            self.records["metadata"][self.N_complete] = np.nan if metadata is None else metadata
+        self.N_complete += 1
+
+    @classmethod
+    def from_source(cls,
+                    src,
+                    filename: str,
+                    **kwargs):
+        """If the source has shape and dtype fields, this can be used to
+        construct the writer more succinctly."""
+        return cls(src, filename, src.shape, src.dtype, **kwargs)
@@ -6,15 +6,18 @@
 """This contains tools to send arrays of numbers between processes using TCP
 and ZeroMQ's Pub/Sub."""
 
-from typing import Tuple, Optional
+from typing import Tuple, Optional, List
 
 import zmq
 import numpy as np
 
 from openautoscopev2.zmq.utils import (
     get_last,
+    get_all,
     push_timestamp,
-    pop_timestamp)
+    pop_timestamp,
+    push_frame_id,
+    pop_frame_id)
 
 class Publisher():
     """This publishes arrays over TCP using ZMQ."""
@@ -25,10 +28,13 @@ class Publisher():
             port: int,
             shape: Tuple[int, ...],
             datatype: np.dtype,
-            bound=False):
+            bound=False,
+            hwm: Optional[int] = None):
 
         self.context = zmq.Context.instance()
         self.socket = self.context.socket(zmq.PUB)
+        if hwm is not None:
+            self.socket.setsockopt(zmq.SNDHWM, hwm)
 
         self.bound = bound
         address = "tcp://{}:{}".format(host, port)
@@ -59,6 +65,15 @@ class TimestampedPublisher(Publisher):
         data = push_timestamp(bytes(data), timestamp)
         self.socket.send(data)
 
+class FrameIndexedPublisher(Publisher):
+    """This publishes arrays after appending a frame index as int64 and a
+    timestamp as float64."""
+
+    def send(self, data, frame_id: int, timestamp: float = None):
+        """Publish a time stamped array tagged with its frame index."""
+        data = push_timestamp(push_frame_id(bytes(data), frame_id), timestamp)
+        self.socket.send(data)
+
 class Subscriber():
     """This is a ZMQ subscriber that interprets messages as arrays."""
 
@@ -68,10 +83,15 @@ class Subscriber():
             port: int,
             shape: Tuple[int, ...],
             datatype: np.dtype,
-            bound=False):
+            bound=False,
+            hwm: Optional[int] = None):
 
         self.context = zmq.Context.instance()
         self.socket = self.context.socket(zmq.SUB)
+        # Number of messages queued before new ones are dropped, only applies
+        # to connections made after it is set
+        if hwm is not None:
+            self.socket.setsockopt(zmq.RCVHWM, hwm)
 
         self.bound = bound
         self.address = "tcp://{}:{}".format(host, port)
@@ -140,3 +160,31 @@ class TimestampedSubscriber(Subscriber):
         (timestamp, buf) = pop_timestamp(buf)
         data = self.array_from_bytes(buf)
         return (timestamp, data)
+
+class FrameIndexedSubscriber(TimestampedSubscriber):
+    """This subscribes to arrays generated by a FrameIndexedPublisher."""
+
+    def recv(self) -> Tuple[int, float, np.ndarray]:
+        buf = self.socket.recv()
+        return self.unpack_buffer(buf)
+
+    def get_last(self) -> Optional[Tuple[int, float, np.ndarray]]:
+        buf = get_last(self.socket.recv)
+
+        if buf is None:
+            return None
+
+        return self.unpack_buffer(buf)
+
+    def get_all(self) -> List[Tuple[int, float, np.ndarray]]:
+        """ This will return all messages present on the channel, in order."""
+        return [ self.unpack_buffer(buf) for buf in get_all(self.socket.recv) ]
+
+    def unpack_buffer(self, buf: bytes) -> Tuple[int, float, np.ndarray]:
+        """Convert a buffer containing an image, a frame index and a timestamp
+        into a tuple with all three."""
+
+        (timestamp, buf) = pop_timestamp(buf)
+        (frame_id, buf) = pop_frame_id(buf)
+        data = self.array_from_bytes(buf)
+        return (frame_id, timestamp, data)
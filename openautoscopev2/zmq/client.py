@@ -142,3 +142,7 @@ class GUIClient:
         self.send_event("CLIENT-STAGE-COORDS", self.stage_r_xyz+self.stage_v_xyz)
         self.log(f"<CLIENT WITH GUI> ping stage coordinates: {str(self.stage_r_xyz+self.stage_v_xyz)}")
         return
+    ## Loading status of tracking models
+    def set_model_status(self, model_key, status):
+        self.send_event("CLIENT-MODEL-STATUS", [model_key, status])
+        return
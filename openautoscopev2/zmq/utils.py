@@ -75,6 +75,22 @@ def get_last(receiver):
     return msg
 
 
+def get_all(receiver):
+    """This retrieves all messages sent to a socket by calling receiver, in
+    the order they were received. If no messages are available, this will
+    return an empty list."""
+
+    msgs = []
+
+    while True:
+        try:
+            msgs.append(receiver(flags=zmq.NOBLOCK))
+        except zmq.error.Again:
+            break
+
+    return msgs
+
+
 def parse_host_and_port(val: str) -> Tuple[str, int, bool]:
     """This takes a command line argument specifying a host/port and returns
     a tuple of (host, port, bound) to determine a TCP endpoint:
@@ -116,6 +132,18 @@ def push_timestamp(msg: bytes, timestamp: float = None) -> bytes:
     now = struct.pack('d', time.time()) if timestamp is None else struct.pack('d', timestamp)
     return msg + now
 
+def push_frame_id(msg: bytes, frame_id: int) -> bytes:
+    """ This appends a frame index as an int64 to the buffer specified by
+    msg."""
+    return msg + struct.pack('q', frame_id)
+
+def pop_frame_id(msg: bytes) -> Tuple[int, bytes]:
+    """ This pulls out a frame index appended by push_frame_id from the end
+    of a message."""
+    (frame_id, msg) = (msg[-8:], msg[:-8])
+    frame_id = struct.unpack('q', frame_id)[0]
+    return (frame_id, msg)
+
 def pop_timestamp(msg: bytes) -> Tuple[float, bytes]:
     """ This pulls out a timestamp as returned by python's time.time() from the
     front of a message."""
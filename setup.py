@@ -16,6 +16,10 @@ console_scripts = [
     'oas_logger=openautoscopev2.devices.logger:main',
     'oas_tracker=openautoscopev2.devices.tracker:main',
     'oas_tracking_models=openautoscopev2.devices.tracking_models:main',
+    'oas_model_precision=openautoscopev2.devices.model_precision:main',
+    'oas_retrack=openautoscopev2.devices.retrack:main',
+    'oas_compression_benchmark=openautoscopev2.devices.compression_benchmark:main',
+    'oas_convert_segments=openautoscopev2.devices.convert_segments:main',
     'oas_teensy_commands=openautoscopev2.devices.teensy_commands:main',
     'oas=openautoscopev2.gui:main',
 ]